@@ -0,0 +1,220 @@
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import time
+from typing import NamedTuple
+
+from fastapi import HTTPException, status
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Admission control ---
+# Two layers keep one heavy user from degrading everyone else's queries:
+# 1. Token buckets per user and endpoint group refuse requests above a sustained rate (429 with
+#    Retry-After). Uploads are charged per file.
+# 2. Every executor stage hands out its slots through a FairQueue instead of first come, first
+#    served. Work is tagged with a flow -- the user it is for and whether it is interactive
+#    (/ask) or bulk (ingestion jobs) -- and waiting calls are served in weighted fair order,
+#    interactive flows weighing ADMISSION_INTERACTIVE_WEIGHT times as much as bulk ones. Bulk
+#    work may hold at most ADMISSION_BULK_SHARE of a stage's slots, so a query never waits for
+#    a whole pool of ingestion batches to drain. Questions arriving while more than
+#    ADMISSION_MAX_QUEUE interactive calls wait at the embed, rerank or llm stage get a 429.
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() != "false"
+ADMISSION_INTERACTIVE_WEIGHT = float(os.getenv("ADMISSION_INTERACTIVE_WEIGHT", "8"))
+ADMISSION_BULK_SHARE = float(os.getenv("ADMISSION_BULK_SHARE", "0.75"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+
+# Token buckets: requests (uploads: files) per minute, and how many may come in a burst
+RATE_LIMITS = {
+    "ask": (float(os.getenv("ADMISSION_ASK_PER_MINUTE", "30")), float(os.getenv("ADMISSION_ASK_BURST", "10"))),
+    "upload": (float(os.getenv("ADMISSION_UPLOAD_FILES_PER_MINUTE", "6")), float(os.getenv("ADMISSION_UPLOAD_BURST", "20"))),
+    "documents": (float(os.getenv("ADMISSION_DOCUMENTS_PER_MINUTE", "60")), float(os.getenv("ADMISSION_DOCUMENTS_BURST", "20"))),
+}
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+WEIGHTS = {INTERACTIVE: ADMISSION_INTERACTIVE_WEIGHT, BULK: 1.0}
+MAX_BUCKETS = 10000  # idle, full buckets are dropped beyond this
+
+
+class Flow(NamedTuple):
+    key: str
+    priority: str
+
+
+# The flow the current task's executor calls are charged to; untagged work (startup,
+# authentication) counts as interactive system work.
+current_flow = contextvars.ContextVar("current_flow", default=Flow("system", INTERACTIVE))
+
+
+def set_flow(user_id: str, priority: str):
+    current_flow.set(Flow(f"{priority}:{user_id}", priority))
+
+
+# --- Weighted fair queueing ---
+
+class _Waiter:
+    __slots__ = ("flow", "start", "finish", "future")
+
+    def __init__(self, flow: Flow, start: float, finish: float, future: asyncio.Future):
+        self.flow = flow
+        self.start = start
+        self.finish = finish
+        self.future = future
+
+
+class FairQueue:
+    """
+    Hands out `slots` concurrent slots in start-time fair order. Each call is stamped with a
+    virtual finish time, its flow's previous finish (or the current virtual time, if later)
+    plus 1 / weight; the waiting call with the earliest finish goes next. A flow that has been
+    idle therefore competes on equal terms at once, and a flow with many calls queued only
+    gets its weighted share.
+    """
+
+    def __init__(self, slots: int, bulk_share: float = ADMISSION_BULK_SHARE):
+        self.slots = max(1, slots)
+        self.bulk_slots = self.slots if self.slots == 1 else max(1, min(self.slots - 1, int(self.slots * bulk_share)))
+        self.busy = {INTERACTIVE: 0, BULK: 0}
+        self.waiting = []
+        self._virtual = 0.0
+        self._finish = {}  # flow -> virtual finish time of its latest call
+        self.service_seconds = None  # moving average of one call's duration
+
+    def _can_start(self, priority: str) -> bool:
+        if self.busy[INTERACTIVE] + self.busy[BULK] >= self.slots:
+            return False
+        return priority != BULK or self.busy[BULK] < self.bulk_slots
+
+    def _stamp(self, flow: Flow) -> tuple[float, float]:
+        start = max(self._virtual, self._finish.get(flow, 0.0))
+        finish = start + 1 / WEIGHTS.get(flow.priority, 1.0)
+        self._finish[flow] = finish
+        if len(self._finish) > 1000:
+            self._finish = {f: t for f, t in self._finish.items() if t > self._virtual}
+        return start, finish
+
+    async def acquire(self, flow: Flow):
+        start, finish = self._stamp(flow)
+        if self._can_start(flow.priority):
+            self._virtual = max(self._virtual, start)
+            self.busy[flow.priority] += 1
+            return
+        waiter = _Waiter(flow, start, finish, asyncio.get_running_loop().create_future())
+        self.waiting.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(flow)  # granted just as the caller went away
+            elif waiter in self.waiting:
+                self.waiting.remove(waiter)
+            raise
+
+    def release(self, flow: Flow, seconds: float = None):
+        self.busy[flow.priority] -= 1
+        if seconds is not None:
+            self.service_seconds = seconds if self.service_seconds is None else 0.9 * self.service_seconds + 0.1 * seconds
+        while self.waiting:
+            eligible = [w for w in self.waiting if self._can_start(w.flow.priority)]
+            if not eligible:
+                return
+            waiter = min(eligible, key=lambda w: w.finish)
+            self.waiting.remove(waiter)
+            self._virtual = max(self._virtual, waiter.start)
+            self.busy[waiter.flow.priority] += 1
+            waiter.future.set_result(None)
+
+    def queued(self, priority: str = None) -> int:
+        return sum(1 for w in self.waiting if priority is None or w.flow.priority == priority)
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog has likely drained."""
+        per_call = self.service_seconds or 1.0
+        return max(1, math.ceil(self.queued() * per_call / self.slots))
+
+    def stats(self) -> dict:
+        return {
+            "bulk_slots": self.bulk_slots,
+            "busy": dict(self.busy),
+            "queued": {priority: self.queued(priority) for priority in (INTERACTIVE, BULK)},
+            "flows_waiting": len({w.flow for w in self.waiting}),
+        }
+
+
+# --- Token buckets ---
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, per_minute: float, burst: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """Takes `cost` tokens and returns 0, or returns the seconds until they are available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+class AdmissionControl:
+    """Per-user rate limits and stage backlog checks run before an endpoint does any work."""
+
+    def __init__(self, limits: dict = None, enabled: bool = ADMISSION_CONTROL, max_queue: int = ADMISSION_MAX_QUEUE):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.enabled = enabled
+        self.max_queue = max_queue
+        self._buckets = {}
+        self.rejected = {}
+
+    def reject(self, group: str, reason: str, retry_after: float, detail: str):
+        """Refuses the request with a 429 and a Retry-After header, counting it under `group` and `reason`."""
+        self.rejected[f"{group}:{reason}"] = self.rejected.get(f"{group}:{reason}", 0) + 1
+        metrics.admission_rejections.inc(group, reason)
+        retry_after = max(1, math.ceil(retry_after))
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"⏳ {detail} Please try again in {retry_after} second{'s' if retry_after > 1 else ''}.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def _bucket(self, group: str, user_id: str) -> TokenBucket:
+        bucket = self._buckets.get((group, user_id))
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                now = time.monotonic()
+                self._buckets = {
+                    key: b for key, b in self._buckets.items()
+                    if b.tokens + (now - b.updated) * b.rate < b.capacity
+                }
+            bucket = self._buckets[(group, user_id)] = TokenBucket(*self.limits[group])
+        return bucket
+
+    def admit(self, group: str, user_id: str, cost: float = 1, stages: dict = None):
+        """Raises a 429 HTTPException if the user is over their rate or `stages` are backed up."""
+        if not self.enabled:
+            return
+        for name, stage in (stages or {}).items():
+            if stage.fair_queue.queued(INTERACTIVE) >= self.max_queue:
+                logger.warning(f"Rejected a '{group}' request from user {user_id}: the {name} stage is backed up.")
+                self.reject(group, "overloaded", stage.fair_queue.retry_after(), "DocQuery is busy right now.")
+        if group in self.limits:
+            wait = self._bucket(group, user_id).take(cost)
+            if wait:
+                logger.info(f"Rate-limited a '{group}' request from user {user_id} for {wait:.1f}s.")
+                self.reject(group, "rate_limited", wait, "You are sending requests too quickly.")
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "buckets": len(self._buckets), "rejected": dict(self.rejected)}
@@ -0,0 +1,175 @@
+import logging
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_MAX_MB = int(os.getenv("ANSWER_CACHE_MAX_MB", "64"))
+ANSWER_CACHE_MAX_PER_USER = int(os.getenv("ANSWER_CACHE_MAX_PER_USER", "200"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+
+def normalize_question(question: str) -> str:
+    """Lowercases, collapses whitespace and drops trailing punctuation so trivially different phrasings match."""
+    text = re.sub(r"\s+", " ", question.strip().lower())
+    return text.rstrip(" ?!.")
+
+
+def identifier_tokens(text: str) -> frozenset:
+    """
+    The identifier-like terms of a question: anything containing a digit, or joined by "-", "."
+    or "/" (AB-1234, 4.2.1, v2, 2023/24). Embeddings barely tell these apart, so a semantic
+    hit is only served when both questions name exactly the same ones.
+    """
+    terms = re.findall(r"\w[\w\-./]*\w|\w", text.lower())
+    return frozenset(t for t in terms if re.search(r"\d|\w[\-./]\w", t))
+
+
+class _Entry:
+    __slots__ = ("user_id", "key", "answer", "vector", "identifiers", "generation", "expires_at", "size")
+
+    def __init__(self, user_id: str, key: str, answer: str, vector: np.ndarray, identifiers: frozenset,
+                 generation: int, expires_at: float):
+        self.user_id = user_id
+        self.key = key
+        self.answer = answer
+        self.vector = vector
+        self.identifiers = identifiers
+        self.generation = generation
+        self.expires_at = expires_at
+        self.size = len(answer.encode("utf-8")) + len(key) + vector.nbytes
+
+
+class AnswerCache:
+    """
+    Per-user cache of generated answers, looked up by normalized question text first and
+    then by cosine similarity of the question embedding.
+
+    Entries expire after `ttl` seconds and are evicted least-recently-used once the cache
+    holds more than `max_entries` answers or `max_bytes` of answer text and vectors.
+
+    Every entry remembers the user's document generation (tombstones.document_state) it
+    was built on, and lookups pass the current one: an entry from another generation is a
+    miss and is dropped. The generation lives in the database, so a change made through any
+    worker invalidates the copies every other worker holds in its own process memory.
+    """
+
+    def __init__(self, ttl: int = ANSWER_CACHE_TTL_SECONDS, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 max_bytes: int = ANSWER_CACHE_MAX_MB * 1024 * 1024, max_per_user: int = ANSWER_CACHE_MAX_PER_USER,
+                 similarity_threshold: float = ANSWER_CACHE_SIMILARITY):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_per_user = max_per_user
+        self.similarity_threshold = similarity_threshold
+        self._lru = OrderedDict()          # (user_id, key) -> _Entry, oldest first
+        self._by_user = defaultdict(OrderedDict)  # user_id -> {key: _Entry}, oldest first
+        self._bytes = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _remove(self, entry: _Entry):
+        self._lru.pop((entry.user_id, entry.key), None)
+        user_entries = self._by_user.get(entry.user_id)
+        if user_entries is not None:
+            user_entries.pop(entry.key, None)
+            if not user_entries:
+                del self._by_user[entry.user_id]
+        self._bytes -= entry.size
+
+    def _touch(self, entry: _Entry):
+        self._lru.move_to_end((entry.user_id, entry.key))
+        self._by_user[entry.user_id].move_to_end(entry.key)
+
+    def _expire(self, user_id: str, generation: int):
+        now = time.monotonic()
+        stale = [e for e in self._by_user.get(user_id, {}).values() if e.expires_at < now or e.generation != generation]
+        for entry in stale:
+            self._remove(entry)
+
+    def get_exact(self, user_id: str, question: str, generation: int) -> str | None:
+        entry = self._by_user.get(user_id, {}).get(normalize_question(question))
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic() or entry.generation != generation:
+            self._remove(entry)
+            return None
+        self._touch(entry)
+        self.exact_hits += 1
+        return entry.answer
+
+    def get_similar(self, user_id: str, vector: list[float], question: str, generation: int) -> str | None:
+        """
+        Returns the cached answer whose question embedding is closest to `vector`, if above the
+        threshold, among those whose question names the same identifiers as `question`.
+        """
+        self._expire(user_id, generation)
+        identifiers = identifier_tokens(question)
+        entries = [e for e in self._by_user.get(user_id, {}).values() if e.identifiers == identifiers]
+        if not entries:
+            self.misses += 1
+            return None
+
+        query = _unit(vector)
+        similarities = np.stack([entry.vector for entry in entries]) @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            self.misses += 1
+            return None
+
+        self._touch(entries[best])
+        self.semantic_hits += 1
+        logger.info(f"Semantic answer cache hit for user {user_id} (similarity {similarities[best]:.3f})")
+        return entries[best].answer
+
+    def put(self, user_id: str, question: str, vector: list[float], answer: str, generation: int):
+        """
+        `generation` must be read before retrieval: if the documents change while the answer
+        is generated, the entry is stored under the old generation and never served.
+        """
+        key = normalize_question(question)
+        existing = self._by_user.get(user_id, {}).get(key)
+        if existing is not None:
+            self._remove(existing)
+
+        entry = _Entry(user_id, key, answer, _unit(vector), identifier_tokens(question), generation,
+                       time.monotonic() + self.ttl)
+        self._lru[(user_id, key)] = entry
+        self._by_user[user_id][key] = entry
+        self._bytes += entry.size
+
+        user_entries = self._by_user[user_id]
+        while len(user_entries) > self.max_per_user:
+            self._remove(next(iter(user_entries.values())))
+        while self._lru and (len(self._lru) > self.max_entries or self._bytes > self.max_bytes):
+            _, oldest = next(iter(self._lru.items()))
+            self._remove(oldest)
+
+    def invalidate_user(self, user_id: str):
+        """Drops the user's cached answers from this worker early; the generation check makes it optional."""
+        for entry in list(self._by_user.get(user_id, {}).values()):
+            self._remove(entry)
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "bytes": self._bytes,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+def _unit(vector) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
@@ -1,15 +1,21 @@
 from authlib.integrations.starlette_client import OAuth
 from starlette.config import Config
+import json
+import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
-from sqlalchemy.orm import Session
 from database import SessionLocal 
+from executor import run_in_stage
 from models import User 
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 # --- OAuth2 Client Setup ---
 config_data = {
@@ -52,7 +58,107 @@ def get_db():
     finally:
         db.close()
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+
+# --- Authenticated user cache ---
+# Every API call resolves its bearer token to a User. Users are cached in process for
+# USER_CACHE_TTL_SECONDS so that only the first request after expiry reaches the database.
+# With USER_CACHE_REDIS_URL set (needs `pip install redis`), misses check a cache shared by
+# all workers before the database. auth_callback invalidates a user whose record it changes.
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_REDIS_URL = os.getenv("USER_CACHE_REDIS_URL")
+
+USER_FIELDS = ("id", "name", "email", "picture")
+
+
+class UserCache:
+    """
+    TTL + LRU cache of user records, keyed by user id. Records are plain dicts; callers get
+    a fresh detached User per lookup, so no ORM instance is shared between requests.
+    """
+
+    def __init__(self, ttl: int = USER_CACHE_TTL_SECONDS, max_entries: int = USER_CACHE_MAX_ENTRIES,
+                 redis_url: str = USER_CACHE_REDIS_URL):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> (expires_at, record), oldest first
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            try:
+                import redis.asyncio as redis
+                self._redis = redis.from_url(redis_url)
+            except ImportError:
+                logger.warning("USER_CACHE_REDIS_URL is set but the redis package is not installed; using the in-process cache only.")
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"docquery:user:{user_id}"
+
+    def _get_local(self, user_id: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def _put_local(self, record: dict):
+        with self._lock:
+            self._entries[record["id"]] = (time.monotonic() + self.ttl, record)
+            self._entries.move_to_end(record["id"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def get(self, user_id: str) -> dict | None:
+        record = self._get_local(user_id)
+        if record is not None or self._redis is None:
+            return record
+        try:
+            raw = await self._redis.get(self._key(user_id))
+        except Exception as e:
+            logger.warning(f"Shared user cache unavailable: {e}")
+            return None
+        if raw is None:
+            return None
+        record = json.loads(raw)
+        self._put_local(record)
+        return record
+
+    async def put(self, record: dict):
+        self._put_local(record)
+        if self._redis is not None:
+            try:
+                await self._redis.set(self._key(record["id"]), json.dumps(record), ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Shared user cache unavailable: {e}")
+
+    async def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if self._redis is not None:
+            try:
+                await self._redis.delete(self._key(user_id))
+            except Exception as e:
+                logger.warning(f"Shared user cache unavailable: {e}")
+
+
+user_cache = UserCache()
+
+
+def _load_user(user_id: str) -> dict | None:
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.id == user_id).first()
+        return {field: getattr(user, field) for field in USER_FIELDS} if user is not None else None
+    finally:
+        db.close()
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -66,10 +172,13 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError:
         raise credentials_exception
 
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is None:
-        raise credentials_exception
-    return user
+    record = await user_cache.get(user_id)
+    if record is None:
+        record = await run_in_stage("db", _load_user, user_id)
+        if record is None:
+            raise credentials_exception
+        await user_cache.put(record)
+    return User(**record)
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     return current_user
\ No newline at end of file
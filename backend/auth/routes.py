@@ -6,7 +6,7 @@ import os
 from dotenv import load_dotenv
 from database import SessionLocal
 from models import User
-from .oauth import oauth
+from .oauth import oauth, user_cache
 
 load_dotenv()
 router = APIRouter()
@@ -95,6 +95,13 @@ async def auth_callback(request: Request, db: Session = Depends(get_db)):
         db.add(user)
         db.commit()
         db.refresh(user)
+    elif (user.name, user.email, user.picture) != (user_info.get("name", user.name), user_info["email"], user_info.get("picture", user.picture)):
+        # Keep the profile in sync with Google, and drop the stale copy authenticated requests would use
+        user.name = user_info.get("name", user.name)
+        user.email = user_info["email"]
+        user.picture = user_info.get("picture", user.picture)
+        db.commit()
+        await user_cache.invalidate(user.id)
 
     # Create JWT token
     payload = {"sub": user.id, "name": user.name, "email": user.email}
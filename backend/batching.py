@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+
+import metrics
+from admission import Flow, current_flow
+from executor import run_in_stage
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for a batched model call over a short window.
+
+    Callers `await submit(item)`; items queue up until either `max_batch_size` is
+    reached (measured with `size_fn`, e.g. number of query/chunk pairs) or `max_wait_ms`
+    has passed since the first item arrived. The whole batch then goes through a single
+    `batch_fn(items)` call on the given executor stage, and each caller gets back the
+    result at its own position.
+
+    Batch sizes and the duration of each batched call are recorded under the batcher's
+    name; each caller's wait plus compute time goes into its request's Server-Timing.
+    A caller that cannot afford the window passes `flush=True` to send its item (with
+    whatever is pending) right away, and `timed=True` to also get the model time of its
+    batch per unit of `size_fn`, excluding queueing.
+    """
+
+    def __init__(self, name: str, batch_fn, stage: str, max_batch_size: int, max_wait_ms: float, size_fn=None):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.stage = stage
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.size_fn = size_fn or (lambda item: 1)
+        self._pending = []
+        self._pending_size = 0
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+        self.max_batch_seen = 0
+
+    async def submit(self, item, flush: bool = False, timed: bool = False):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        self._pending_size += self.size_fn(item)
+
+        if flush or self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        started = time.perf_counter()
+        try:
+            result, seconds_per_unit = await future
+            return (result, seconds_per_unit) if timed else result
+        finally:
+            metrics.add_request_timing(self.name, time.perf_counter() - started)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_size = self._pending, [], 0
+        task = asyncio.ensure_future(self._run(batch))
+        # Hold a reference so the task isn't garbage-collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        # A batch serves several users at once, so it is scheduled as a flow of its own
+        current_flow.set(Flow(f"batch:{self.name}", current_flow.get().priority))
+        items = [item for item, _ in batch]
+        size = sum(self.size_fn(item) for item in items) or 1
+        self.batches += 1
+        self.items += len(items)
+        self.max_batch_seen = max(self.max_batch_seen, len(items))
+        metrics.observe_batch(self.name, len(items))
+        started = time.perf_counter()
+        try:
+            results, compute = await run_in_stage(self.stage, _timed_call, self.batch_fn, items)
+            metrics.observe(self.name, time.perf_counter() - started)
+        except Exception as e:
+            metrics.observe(self.name, time.perf_counter() - started, error=True)
+            logger.error(f"Batched '{self.name}' call failed for {len(items)} requests: {e}", exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            # A caller may have been cancelled (client disconnected) while the batch ran
+            if not future.done():
+                future.set_result((result, compute / size))
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0,
+            "max_batch_seen": self.max_batch_seen,
+            "pending": len(self._pending),
+        }
+
+
+def _timed_call(fn, items):
+    """Runs on the stage's worker thread, so the duration excludes waiting for a slot."""
+    started = time.perf_counter()
+    results = fn(items)
+    return results, time.perf_counter() - started
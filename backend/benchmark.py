@@ -0,0 +1,357 @@
+"""
+Retrieval/answer benchmark and load test for DocQuery.
+
+Builds a synthetic PDF corpus whose pages contain uniquely numbered facts, uploads it through
+the real /upload endpoint, then asks one generated question per fact through /ask/stream at a
+fixed concurrency. Gemini is replaced by llm.FakeProvider with a configurable latency distribution;
+the embedder, reranker and Qdrant calls are the real ones. Qdrant is in-memory by default, or
+any local instance via --qdrant-url (e.g. `docker run -p 6333:6333 qdrant/qdrant`).
+
+Run it once with --backend torch and once with --backend onnx to compare the int8 models'
+throughput and retrieval quality against fp32 (`python inference.py parity` compares the raw
+embeddings and reranker scores).
+
+Reports ingestion pages/sec, p50/p95/p99 latency per stage (embed, search, rerank, generate),
+end-to-end latency, QPS, the LLM client's hedges and failovers, and recall@k / MRR of the reranked chunks
+against the chunks that actually contain each fact. Results are printed as JSON so runs can be
+compared across commits:
+
+    python benchmark.py --docs 5 --pages 20 --concurrency 8 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--qdrant-url", default=":memory:", help="':memory:' or the URL of a local Qdrant")
+    parser.add_argument("--docs", type=int, default=3, help="synthetic PDFs to upload")
+    parser.add_argument("--pages", type=int, default=10, help="pages per PDF")
+    parser.add_argument("--facts-per-page", type=int, default=3)
+    parser.add_argument("--questions", type=int, default=100, help="questions to ask (sampled from the facts)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="median fake Gemini latency")
+    parser.add_argument("--llm-latency-sigma", type=float, default=0.5, help="lognormal sigma of fake Gemini latency")
+    parser.add_argument("--llm-tail-rate", type=float, default=0.0, help="share of fake Gemini calls that straggle")
+    parser.add_argument("--llm-tail-ms", type=float, default=10000, help="latency of a straggling call")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of fake Gemini calls that fail")
+    parser.add_argument("--answer-cache", action="store_true", help="leave the answer cache enabled")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default="torch",
+                        help="embedder/reranker inference backend (see inference.py); compare runs of each")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    return parser.parse_args(argv)
+
+
+# --- Synthetic corpus ---
+
+FILLER = (
+    "The maintenance schedule should be reviewed by a qualified technician before each shift. "
+    "Operators must record every inspection in the logbook and report anomalies to the supervisor. "
+    "Storage areas are to be kept dry, ventilated and free of obstructions at all times. "
+)
+
+
+def build_corpus(directory: str, docs: int, pages: int, facts_per_page: int, rng: random.Random) -> tuple[list[str], list[dict]]:
+    """Writes the PDFs and returns (paths, facts); every fact has a unique part number."""
+    import fitz # PyMuPDF for PDF processing
+
+    paths, facts = [], []
+    for d in range(docs):
+        filename = f"manual-{d:03d}.pdf"
+        doc = fitz.open()
+        for p in range(pages):
+            paragraphs = [f"Section {d}.{p}", FILLER]
+            for f in range(facts_per_page):
+                part = f"PN-{d:03d}-{p:03d}-{f}"
+                torque = rng.randint(5, 250)
+                clause = f"{d + 1}.{p + 1}.{f + 1}"
+                facts.append({"filename": filename, "part": part, "torque": torque, "clause": clause})
+                paragraphs.append(
+                    f"Clause {clause}: part number {part} must be tightened to a rated torque of {torque} Nm."
+                )
+                paragraphs.append(FILLER)
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(40, 40, 555, 800), "\n".join(paragraphs), fontsize=9)
+        path = os.path.join(directory, filename)
+        doc.save(path)
+        doc.close()
+        paths.append(path)
+    return paths, facts
+
+
+def question_for(fact: dict) -> str:
+    return f"What torque is part number {fact['part']} rated for?"
+
+
+# --- Measurement helpers ---
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 2)}
+
+
+def timed_async(fn, samples: list):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            samples.append((time.perf_counter() - started) * 1000)
+    return wrapper
+
+
+def timed_stream(fn, samples: list):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            async for item in fn(*args, **kwargs):
+                yield item
+        finally:
+            samples.append((time.perf_counter() - started) * 1000)
+    return wrapper
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), text=True, stderr=subprocess.DEVNULL,
+        ).strip()
+    except Exception:
+        return None
+
+
+def configure_environment(args, workdir: str):
+    """Points every external dependency of main.py at local, throwaway resources before it is imported."""
+    defaults = {
+        "SECRET_KEY": "benchmark-secret",
+        "GEMINI_API_KEY": "benchmark",
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'benchmark.sqlite3')}",
+        "QDRANT_URL": args.qdrant_url,
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.sqlite3"),
+        "LEXICAL_INDEX_PATH": os.path.join(workdir, "lexical_index.sqlite3"),
+        "JOB_SPOOL_DIR": os.path.join(workdir, "jobs"),
+        "INFERENCE_BACKEND": args.backend,
+        # One benchmark user asks every question; rate limits would throttle the load test itself
+        "ADMISSION_CONTROL": "false",
+        "LLM_PROVIDER": "fake",
+        "LLM_FAKE_LATENCY_MS": str(args.llm_latency_ms),
+        "LLM_FAKE_LATENCY_SIGMA": str(args.llm_latency_sigma),
+        "LLM_FAKE_TAIL_RATE": str(args.llm_tail_rate),
+        "LLM_FAKE_TAIL_MS": str(args.llm_tail_ms),
+        "LLM_FAKE_ERROR_RATE": str(args.llm_error_rate),
+        "LLM_FAKE_SEED": str(args.seed),
+    }
+    if not args.answer_cache:
+        # Entries expire immediately, so every question goes through the full pipeline
+        defaults["ANSWER_CACHE_TTL_SECONDS"] = "0"
+    for key, value in defaults.items():
+        os.environ[key] = value
+
+    if args.qdrant_url == ":memory:":
+        import qdrant_client
+        local_sync, local_async = qdrant_client.QdrantClient, qdrant_client.AsyncQdrantClient
+        qdrant_client.QdrantClient = lambda *a, **k: local_sync(location=":memory:")
+        qdrant_client.AsyncQdrantClient = lambda *a, **k: local_async(location=":memory:")
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="docquery-bench-")
+    configure_environment(args, workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import httpx
+    from jose import jwt
+    from qdrant_client.models import Distance, VectorParams
+
+    import main
+    from database import Base, SessionLocal, engine
+    from models import User
+
+    timings = defaultdict(list)
+    main.llm_client.stream = timed_stream(main.llm_client.stream, timings["generate"])
+    main.query_embed_batcher.submit = timed_async(main.query_embed_batcher.submit, timings["embed"])
+    main.aqdrant.query_points = timed_async(main.aqdrant.query_points, timings["search"])
+    main.rerank_chunks = timed_async(main.rerank_chunks, timings["rerank"])
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    db.merge(User(id="benchmark-user", name="Benchmark", email="benchmark@example.com"))
+    db.commit()
+    db.close()
+    token = jwt.encode({"sub": "benchmark-user", "name": "Benchmark", "email": "benchmark@example.com"},
+                       os.environ["SECRET_KEY"], algorithm="HS256")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    paths, facts = build_corpus(workdir, args.docs, args.pages, args.facts_per_page, rng)
+    report = {
+        "commit": current_commit(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+    }
+
+    async with main.app.router.lifespan_context(main.app):
+        # The models load in the background after startup; wait for that to finish
+        await main.warm_up_task
+        if not main.hot_path_ready.is_set():
+            raise RuntimeError(f"DocQuery failed to start: {main.startup_state['error']}")
+        # Differs from --backend when the ONNX models could not be loaded
+        report["inference_backend"] = main.inference_backend
+        if args.qdrant_url == ":memory:":
+            await main.aqdrant.create_collection(
+                main.collection_name, vectors_config=VectorParams(size=main.vector_dim, distance=Distance.COSINE)
+            )
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=600) as client:
+            report["ingestion"] = await benchmark_ingestion(client, headers, paths, args.pages)
+            ground_truth = await locate_facts(main, facts)
+            report["load"], report["quality"] = await benchmark_questions(client, headers, facts, ground_truth, args, rng)
+
+    report["latency_ms"] = {stage: percentiles(samples) for stage, samples in timings.items()}
+    report["llm"] = main.llm_client.stats()
+    return report
+
+
+async def benchmark_ingestion(client, headers, paths: list[str], pages_per_doc: int) -> dict:
+    files = [("files", (os.path.basename(path), open(path, "rb"), "application/pdf")) for path in paths]
+    started = time.perf_counter()
+    try:
+        response = await client.post("/upload", files=files, headers=headers)
+    finally:
+        for _, (_, handle, _) in files:
+            handle.close()
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    accepted = time.perf_counter() - started
+
+    while True:
+        job = (await client.get(f"/jobs/{job_id}", headers=headers)).json()
+        if job["status"] in ("completed", "failed"):
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    pages = len(paths) * pages_per_doc
+    return {
+        "status": job["status"],
+        "files": len(paths),
+        "pages": pages,
+        "points": job["total_points"],
+        "upload_accepted_s": round(accepted, 3),
+        "total_s": round(elapsed, 3),
+        "pages_per_s": round(pages / elapsed, 2),
+    }
+
+
+async def locate_facts(main, facts: list[dict]) -> dict[str, set[str]]:
+    """Maps each part number to the ids of every indexed chunk whose text contains it."""
+    holders = defaultdict(set)
+    offset = None
+    while True:
+        points, offset = await main.aqdrant.scroll(
+            collection_name=main.collection_name, limit=1000, offset=offset, with_payload=["text"], with_vectors=False
+        )
+        for point in points:
+            text = (point.payload or {}).get("text", "")
+            for fact in facts:
+                if fact["part"] in text:
+                    holders[fact["part"]].add(str(point.id))
+        if offset is None:
+            return holders
+
+
+async def ask_stream(client, headers, question: str) -> dict:
+    # httpx's ASGI transport hands over the body only once the response is complete, so
+    # time to first token cannot be measured in-process; only end-to-end latency is reported.
+    started = time.perf_counter()
+    chunk_ids = []
+    error = None
+    async with client.stream("POST", "/ask/stream", json={"question": question}, headers=headers) as response:
+        if response.status_code != 200:
+            return {"error": f"HTTP {response.status_code}", "latency_ms": (time.perf_counter() - started) * 1000}
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[5:])
+                if event == "meta":
+                    chunk_ids = [chunk["id"] for chunk in data.get("chunks", [])]
+                elif event == "error":
+                    error = data.get("detail")
+    return {
+        "latency_ms": (time.perf_counter() - started) * 1000,
+        "chunk_ids": chunk_ids,
+        "error": error,
+    }
+
+
+async def benchmark_questions(client, headers, facts, ground_truth, args, rng) -> tuple[dict, dict]:
+    sample = [rng.choice(facts) for _ in range(args.questions)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = [None] * len(sample)
+
+    async def worker(i, fact):
+        async with semaphore:
+            results[i] = await ask_stream(client, headers, question_for(fact))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i, fact) for i, fact in enumerate(sample)))
+    wall = time.perf_counter() - started
+
+    ok = [r for r in results if not r["error"]]
+    load = {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "concurrency": args.concurrency,
+        "wall_s": round(wall, 3),
+        "qps": round(len(results) / wall, 2),
+        "end_to_end_ms": percentiles([r["latency_ms"] for r in ok]),
+    }
+
+    k = max((len(r["chunk_ids"]) for r in ok), default=0)
+    hits, reciprocal_ranks, judged = 0, [], 0
+    for fact, result in zip(sample, results):
+        relevant = ground_truth.get(fact["part"])
+        if result["error"] or not relevant:
+            continue
+        judged += 1
+        rank = next((i for i, chunk_id in enumerate(result["chunk_ids"], start=1) if chunk_id in relevant), None)
+        hits += rank is not None
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+    quality = {
+        "k": k,
+        "judged": judged,
+        f"recall@{k}": round(hits / judged, 4) if judged else None,
+        "mrr": round(sum(reciprocal_ranks) / judged, 4) if judged else None,
+    }
+    return load, quality
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,298 @@
+import copy
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+import fitz # PyMuPDF for PDF processing
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# "structured" splits on headings, paragraphs and sentences within a token budget;
+# "window" is the original fixed 800-character window every 700 characters.
+CHUNKER = os.getenv("CHUNKER", "structured").lower()
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "0"))  # 0 = the embedder's max sequence length
+CHUNK_OVERLAP_SENTENCES = int(os.getenv("CHUNK_OVERLAP_SENTENCES", "1"))
+
+MIN_CHUNK_CHARS = 50  # Only include substantial chunks
+BOLD_FLAG = 16  # PyMuPDF span flag
+
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?;:])\s+(?=[\"'(\[A-Z0-9])")
+_HYPHENATED_BREAK = re.compile(r"(\w)-\n(\w)")
+
+
+class Chunk:
+    __slots__ = ("text", "pages", "bboxes", "heading")
+
+    def __init__(self, text: str, pages: list[int] = None, bboxes: list[dict] = None, heading: str = None):
+        self.text = text
+        self.pages = pages      # page numbers the chunk spans, in order
+        self.bboxes = bboxes    # [{"page": n, "bbox": [x0, y0, x1, y1]}], one box per page
+        self.heading = heading  # heading of the section the chunk belongs to
+
+
+def approximate_tokens(text: str) -> int:
+    """Rough WordPiece-sized token count, used when the embedder exposes no tokenizer."""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+# --- Page extraction ---
+# Page functions turn one fitz page into whatever a chunker consumes. They are module-level
+# and return plain picklable data, so extraction.py can run them in worker processes.
+
+def page_text(page) -> str:
+    return page.get_text()
+
+
+def page_blocks(page) -> list[tuple]:
+    """(text, bbox, max_font_size, all_bold, line_count, chars_per_font_size) for each text block on the page."""
+    blocks = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT).get("blocks", []):
+        if block.get("type", 0) != 0:
+            continue
+        lines, sizes, bold = [], Counter(), True
+        for line in block.get("lines", []):
+            spans = [span for span in line.get("spans", []) if span.get("text", "").strip()]
+            if not spans:
+                continue
+            lines.append("".join(span["text"] for span in line.get("spans", [])).strip())
+            for span in spans:
+                sizes[round(span.get("size", 0) * 2) / 2] += len(span["text"].strip())
+                bold = bold and bool(span.get("flags", 0) & BOLD_FLAG)
+        text = _HYPHENATED_BREAK.sub(r"\1\2", "\n".join(lines))
+        if text.strip():
+            blocks.append((text, tuple(block["bbox"]), max(sizes), bold, len(lines), dict(sizes)))
+    return blocks
+
+
+def iter_pages(path: str, page_fn=page_text):
+    """Yields (page_number, page_fn(page)) one page at a time; only the current page is held in memory."""
+    doc = fitz.open(path)
+    try:
+        for page_number, page in enumerate(doc, start=1):
+            started = time.perf_counter()
+            data = page_fn(page)
+            metrics.observe("extract", time.perf_counter() - started)
+            yield page_number, data
+    finally:
+        doc.close()
+
+
+def iter_chunks(pages, chunk_size: int = 800, overlap: int = 100, stats: dict = None):
+    """
+    Sliding-window chunker over a stream of pages. Produces the same windows as
+    slicing the fully joined text every `chunk_size - overlap` characters, but only
+    buffers about one window of text at a time.
+    """
+    step = chunk_size - overlap
+    buffer = ""
+    for page_number, text in pages:
+        if stats is not None:
+            stats["pages"] = page_number
+            stats["has_text"] = stats.get("has_text", False) or bool(text.strip())
+        buffer = f"{buffer}\n{text}" if page_number > 1 else text
+        while len(buffer) >= chunk_size:
+            chunk = buffer[:chunk_size]
+            buffer = buffer[step:]
+            if len(chunk.strip()) > MIN_CHUNK_CHARS:
+                yield chunk.strip()
+
+    for i in range(0, len(buffer), step):
+        chunk = buffer[i:i + chunk_size]
+        if len(chunk.strip()) > MIN_CHUNK_CHARS:
+            yield chunk.strip()
+
+
+class WindowChunker:
+    """The original fixed-size character windows; chunks carry no page or layout information."""
+
+    page_fn = staticmethod(page_text)
+
+    def __init__(self, chunk_size: int = 800, overlap: int = 100):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    def chunk_pages(self, pages, stats: dict = None):
+        """Chunks a stream of (page_number, page_text(page)) pairs."""
+        for text in iter_chunks(pages, self.chunk_size, self.overlap, stats):
+            yield Chunk(text)
+
+
+class _ChunkBuilder:
+    def __init__(self):
+        self.parts = []
+        self.tokens = 0
+        self.boxes = {}  # page -> [x0, y0, x1, y1]
+
+    def add(self, text: str, tokens: int, page: int, bbox, joiner: str):
+        if self.parts:
+            self.parts.append(joiner)
+        self.parts.append(text)
+        self.tokens += tokens
+        box = self.boxes.get(page)
+        if box is None:
+            self.boxes[page] = list(bbox)
+        else:
+            self.boxes[page] = [min(box[0], bbox[0]), min(box[1], bbox[1]), max(box[2], bbox[2]), max(box[3], bbox[3])]
+
+    def build(self, heading: str | None) -> Chunk:
+        body = "".join(self.parts).strip()
+        text = f"{heading}\n{body}" if heading and not body.startswith(heading) else body
+        pages = sorted(self.boxes)
+        return Chunk(
+            text,
+            pages=pages,
+            bboxes=[{"page": page, "bbox": [round(v, 1) for v in self.boxes[page]]} for page in pages],
+            heading=heading,
+        )
+
+
+class StructuredChunker:
+    """
+    Layout-aware chunker built on PyMuPDF text blocks and spans.
+
+    Blocks set in a larger or bold font that read like a title start a new section; the
+    section heading is repeated at the top of each of its chunks so every vector carries
+    its context. Paragraphs are packed into chunks of at most `max_tokens` tokens as counted
+    by `count_tokens` (the embedder's tokenizer, so nothing is truncated at encode time).
+    A paragraph that does not fit is split on sentence boundaries, and a single oversized
+    sentence on words. When a section spills over into a new chunk, the last
+    `overlap_sentences` pieces (sentences, or short paragraphs) are carried over when they fit.
+
+    Chunks may span pages; each records the page numbers it covers and one bounding box per page.
+    """
+
+    page_fn = staticmethod(page_blocks)
+
+    def __init__(self, count_tokens, max_tokens: int, overlap_sentences: int = 1):
+        self.count_tokens = count_tokens
+        self.max_tokens = max(16, max_tokens)
+        self.min_tokens = self.max_tokens // 4
+        self.overlap_sentences = overlap_sentences
+
+    @staticmethod
+    def _blocks(pages, stats: dict = None):
+        for page_number, blocks in pages:
+            if stats is not None:
+                stats["pages"] = page_number
+                stats["has_text"] = stats.get("has_text", False) or bool(blocks)
+            for block in blocks:
+                yield (page_number, *block)
+
+    @staticmethod
+    def _is_heading(text: str, size: float, bold: bool, line_count: int, body_size: float) -> bool:
+        if line_count > 2 or len(text) > 120 or not body_size:
+            return False
+        if text.rstrip().endswith((".", ",", ";")):
+            return False
+        return size >= body_size + 1.5 or (bold and size >= body_size)
+
+    # --- Packing ---
+
+    def _units(self, paragraph: str) -> list[tuple[str, int]]:
+        """Splits a paragraph into (text, tokens) pieces that each fit the budget."""
+        flat = re.sub(r"\s*\n\s*", " ", paragraph).strip()
+        tokens = self.count_tokens(flat)
+        if tokens <= self.max_tokens:
+            return [(flat, tokens)]
+        units = []
+        for sentence in _SENTENCE_BOUNDARY.split(flat):
+            sentence_tokens = self.count_tokens(sentence)
+            if sentence_tokens <= self.max_tokens:
+                units.append((sentence, sentence_tokens))
+                continue
+            words, piece = sentence.split(), []
+            for word in words:
+                candidate = " ".join(piece + [word])
+                if piece and self.count_tokens(candidate) > self.max_tokens:
+                    text = " ".join(piece)
+                    units.append((text, self.count_tokens(text)))
+                    piece = [word]
+                else:
+                    piece.append(word)
+            if piece:
+                text = " ".join(piece)
+                units.append((text, self.count_tokens(text)))
+        return units
+
+    def chunk_pages(self, pages, stats: dict = None):
+        """Chunks a stream of (page_number, page_blocks(page)) pairs."""
+        size_histogram = Counter()
+        heading, heading_tokens = None, 0
+        builder = _ChunkBuilder()
+        recent = []  # (text, tokens, page, bbox) of the last units added, for overlap
+
+        def emit():
+            chunk = builder.build(heading)
+            return chunk if len(chunk.text) > MIN_CHUNK_CHARS else None
+
+        for page_number, text, bbox, size, bold, line_count, sizes in self._blocks(pages, stats):
+            size_histogram.update(sizes)
+            body_size = size_histogram.most_common(1)[0][0]
+
+            if self._is_heading(text, size, bold, line_count, body_size):
+                title = " ".join(text.split())
+                title_tokens = self.count_tokens(title)
+                if builder.parts and builder.tokens < self.min_tokens:
+                    # Tiny sections are folded into the next one instead of becoming stub chunks
+                    builder.add(title, title_tokens, page_number, bbox, "\n")
+                    continue
+                if builder.parts:
+                    chunk = emit()
+                    if chunk:
+                        yield chunk
+                builder, recent = _ChunkBuilder(), []
+                if title_tokens <= self.max_tokens // 4:
+                    heading, heading_tokens = title, title_tokens
+                else:
+                    heading, heading_tokens = None, 0
+                    builder.add(title, title_tokens, page_number, bbox, "\n")
+                continue
+
+            for i, (unit, tokens) in enumerate(self._units(text)):
+                if builder.parts and heading_tokens + builder.tokens + tokens > self.max_tokens:
+                    chunk = emit()
+                    if chunk:
+                        yield chunk
+                    builder = _ChunkBuilder()
+                    carried = recent[-self.overlap_sentences:] if self.overlap_sentences else []
+                    if heading_tokens + sum(c[1] for c in carried) + tokens <= self.max_tokens:
+                        for c_text, c_tokens, c_page, c_bbox in carried:
+                            builder.add(c_text, c_tokens, c_page, c_bbox, " ")
+                    recent = []
+                builder.add(unit, tokens, page_number, bbox, " " if i else "\n")
+                recent.append((unit, tokens, page_number, bbox))
+                del recent[:-max(1, self.overlap_sentences)]
+
+        if builder.parts:
+            chunk = emit()
+            if chunk:
+                yield chunk
+
+
+def token_counter(tokenizer):
+    """
+    Counts tokens with a private copy of a Hugging Face tokenizer: the embedder's own instance
+    is used concurrently by encode(), and fast tokenizers must not be shared across threads.
+    """
+    tokenizer = copy.deepcopy(tokenizer)
+    lock = threading.Lock()
+
+    def count_tokens(text: str) -> int:
+        with lock:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+
+    return count_tokens
+
+
+def make_chunker(kind: str = CHUNKER, count_tokens=None, max_tokens: int = CHUNK_MAX_TOKENS):
+    """Builds the configured chunker; `count_tokens` should use the embedder's tokenizer."""
+    if kind == "window":
+        return WindowChunker()
+    if kind != "structured":
+        logger.warning(f"Unknown CHUNKER '{kind}', using the structured chunker.")
+    return StructuredChunker(count_tokens or approximate_tokens, max_tokens or 256, CHUNK_OVERLAP_SENTENCES)
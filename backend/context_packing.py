@@ -0,0 +1,180 @@
+import logging
+import os
+
+import numpy as np
+
+from chunking import approximate_tokens
+
+logger = logging.getLogger(__name__)
+
+# --- Context packing ---
+# Reranked chunks are turned into the prompt context in three steps:
+# 1. Merge: chunks of the same file with consecutive chunk_index become one passage, and the
+#    text each chunk repeats from its predecessor (window overlap, carried-over sentences,
+#    the repeated section heading) is dropped.
+# 2. Select: passages are ordered by maximal marginal relevance over the chunk vectors the
+#    dense search already returned, so a near-duplicate passage ranks behind new information.
+#    The passage holding the cross-encoder's best chunk always goes first.
+# 3. Fill: passages are added in that order until CONTEXT_TOKEN_BUDGET is used up. Tokens are
+#    counted with the embedder's tokenizer, a close enough stand-in for the LLM's.
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "true").lower() != "false"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))  # 1 = relevance only
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "8"))  # reranked chunks offered to the packer
+
+MIN_OVERLAP_CHARS = 20  # shorter matches between chunk boundaries are coincidence, not overlap
+MIN_FILL_TOKENS = 32  # stop filling once less than this is left
+
+
+def strip_overlap(previous: str, text: str) -> str:
+    """Returns `text` without the part it repeats from the end of `previous`."""
+    # A structured chunk repeats its section heading as its first line
+    head, _, rest = text.partition("\n")
+    if rest and previous.startswith(f"{head}\n"):
+        text = rest.lstrip()
+    for size in range(min(len(previous), len(text)), MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:].lstrip()
+    return text
+
+
+class Passage:
+    __slots__ = ("filename", "chunks", "pieces", "vector", "rank")
+
+    def __init__(self, chunk: dict, rank: int):
+        self.filename = chunk.get("filename")
+        self.chunks = [chunk]       # candidate dicts, in document order
+        self.pieces = [chunk["text"]]  # their text without the overlap
+        self.vector = None
+        self.rank = rank            # best reranker position among its chunks
+
+    def append(self, chunk: dict):
+        self.pieces.append(strip_overlap(self.chunks[-1]["text"], chunk["text"]))
+        self.chunks.append(chunk)
+
+    def pages(self) -> list[int]:
+        return sorted({page for chunk in self.chunks for page in (chunk.get("pages") or [])})
+
+    def render(self, number: int, pieces: int = None) -> str:
+        pages = self.pages()
+        where = self.filename or "unknown file"
+        if pages:
+            where += f", page {pages[0]}" if len(pages) == 1 else f", pages {pages[0]}-{pages[-1]}"
+        body = "\n".join(piece for piece in self.pieces[:pieces] if piece)
+        return f"[Passage {number}] ({where}):\n{body}"
+
+
+def merge_adjacent(chunks: list[dict]) -> list[Passage]:
+    """
+    Groups chunks (in reranked order, each with "text", "filename", "chunk_index" and an
+    optional "vector") into passages of consecutive chunks; passages keep the order of their
+    best chunk. A passage's vector is the normalized mean of its chunks' vectors.
+    """
+    ranked = {}  # the same chunk can come back from both retrievers; keep its best rank
+    for rank, chunk in enumerate(chunks):
+        position = (chunk.get("filename") or "", chunk.get("chunk_index"))
+        ranked.setdefault(position if position[1] is not None else (position[0], -1, rank), (rank, chunk))
+
+    passages = []
+    for position in sorted(ranked):
+        rank, chunk = ranked[position]
+        last = passages[-1] if passages else None
+        if (last is not None and len(position) == 2 and last.filename == chunk.get("filename")
+                and last.chunks[-1].get("chunk_index") == position[1] - 1):
+            last.append(chunk)
+            last.rank = min(last.rank, rank)
+        else:
+            passages.append(Passage(chunk, rank))
+
+    for passage in passages:
+        vectors = [chunk["vector"] for chunk in passage.chunks if chunk.get("vector") is not None]
+        if vectors:
+            mean = np.mean(np.asarray(vectors, dtype=np.float32), axis=0)
+            passage.vector = mean / (np.linalg.norm(mean) or 1.0)
+    passages.sort(key=lambda passage: passage.rank)
+    return passages
+
+
+def mmr_order(query_vector, vectors: np.ndarray, mmr_lambda: float, first: int = None) -> list[int]:
+    """
+    Orders the rows of `vectors` (unit length) by maximal marginal relevance to the query.
+    Similarities are computed once as matrix products; `first` pins the opening pick.
+    """
+    count = len(vectors)
+    query = np.asarray(query_vector, dtype=np.float32)
+    relevance = vectors @ (query / (np.linalg.norm(query) or 1.0))
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(count, dtype=np.float32)  # max similarity to anything picked so far
+    available = np.ones(count, dtype=bool)
+    order = []
+    for _ in range(count):
+        if first is not None and not order:
+            pick = first
+        else:
+            scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+            pick = int(np.argmax(np.where(available, scores, -np.inf)))
+        order.append(pick)
+        available[pick] = False
+        redundancy = np.maximum(redundancy, similarity[pick])
+    return order
+
+
+class ContextPacker:
+    """
+    Packs reranked chunks into a prompt context of at most `budget` tokens.
+    `count_tokens` is replaced with the embedder's tokenizer once the models are loaded.
+    """
+
+    def __init__(self, count_tokens=approximate_tokens, budget: int = CONTEXT_TOKEN_BUDGET,
+                 mmr_lambda: float = CONTEXT_MMR_LAMBDA):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.mmr_lambda = mmr_lambda
+        self.packed = 0
+        self.chunks_in = 0
+        self.chunks_out = 0
+        self.tokens_out = 0
+
+    def stats(self) -> dict:
+        return {
+            "contexts": self.packed,
+            "chunks_in": self.chunks_in,
+            "chunks_out": self.chunks_out,
+            "mean_tokens": round(self.tokens_out / self.packed, 1) if self.packed else None,
+            "budget": self.budget,
+        }
+
+    def select(self, query_vector, passages: list[Passage]) -> list[Passage]:
+        if not all(passage.vector is not None for passage in passages) or len(passages) < 2:
+            return passages
+        order = mmr_order(query_vector, np.stack([passage.vector for passage in passages]), self.mmr_lambda, first=0)
+        return [passages[i] for i in order]
+
+    def pack(self, query_vector, chunks: list[dict]) -> tuple[str, list[dict]]:
+        """
+        Returns the context text and the chunks it contains, in prompt order. A passage that
+        does not fit is cut back to its leading chunks, or left out if not even one fits.
+        """
+        passages = self.select(query_vector, merge_adjacent(chunks))
+        parts, used, remaining = [], [], self.budget
+        for passage in passages:
+            if remaining < MIN_FILL_TOKENS:
+                break
+            number = len(parts) + 1
+            for pieces in range(len(passage.pieces), 0, -1):
+                text = passage.render(number, pieces)
+                tokens = self.count_tokens(text)
+                # The best passage always goes in, even if the budget is set below one chunk
+                if tokens <= remaining or not parts and pieces == 1:
+                    parts.append(text)
+                    used.extend(passage.chunks[:pieces])
+                    remaining -= tokens
+                    break
+
+        self.packed += 1
+        self.chunks_in += len(chunks)
+        self.chunks_out += len(used)
+        self.tokens_out += self.budget - remaining
+        logger.info(f"Packed {len(used)} of {len(chunks)} chunks into {len(parts)} passages, "
+                    f"{self.budget - remaining}/{self.budget} tokens.")
+        return "\n\n".join(parts), used
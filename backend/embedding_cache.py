@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "20000"))
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "512"))
+
+
+def content_key(model_name: str, text: str) -> str:
+    """Stable content address of a chunk for a given model: sha256 of model name and text."""
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier, content-addressed embedding cache.
+
+    An in-memory LRU sits in front of a SQLite table keyed by `content_key`. Vectors are
+    stored as raw float32 bytes. When the table grows past `max_bytes` of vector data the
+    least recently used rows are evicted. All methods are blocking and thread-safe; call
+    them from the executor, not the event loop.
+    """
+
+    def __init__(self, model_name: str, path: str = EMBEDDING_CACHE_PATH,
+                 memory_entries: int = EMBEDDING_CACHE_MEMORY_ENTRIES, max_bytes: int = EMBEDDING_CACHE_MAX_MB * 1024 * 1024):
+        self.model_name = model_name
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self, key: str, vector: list[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, texts: list[str]) -> dict[int, list[float]]:
+        """Returns {position: vector} for every text already in the cache."""
+        keys = [content_key(self.model_name, text) for text in texts]
+        found = {}
+        with self._lock:
+            missing = {}
+            memory_misses = 0
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[i] = vector
+                    self.memory_hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+                    memory_misses += 1
+
+            if missing:
+                placeholders = ",".join("?" * len(missing))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", list(missing)
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                    self._remember(key, vector)
+                    for i in missing.pop(key):
+                        found[i] = vector
+                        self.disk_hits += 1
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(time.time(), key) for key, _ in rows],
+                    )
+                    self._conn.commit()
+                self.misses += sum(len(positions) for positions in missing.values())
+
+        # Every lookup is an LRU hit or miss; each LRU miss is then a SQLite hit or miss
+        memory_hits = len(texts) - memory_misses
+        metrics.embedding_cache_lookups.inc("memory", "hit", amount=memory_hits)
+        metrics.embedding_cache_lookups.inc("memory", "miss", amount=memory_misses)
+        metrics.embedding_cache_lookups.inc("sqlite", "hit", amount=len(found) - memory_hits)
+        metrics.embedding_cache_lookups.inc("sqlite", "miss", amount=len(texts) - len(found))
+        return found
+
+    def put_many(self, texts: list[str], vectors: list[list[float]]):
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = content_key(self.model_name, text)
+                self._remember(key, vector)
+                rows.append((key, np.asarray(vector, dtype=np.float32).tobytes(), now))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            self._conn.commit()
+            if rows:
+                self._evict(len(rows[0][1]))
+
+    def _evict(self, row_bytes: int):
+        max_rows = max(1, self.max_bytes // row_bytes)
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        excess = count - max_rows
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        self._conn.commit()
+        self.evictions += excess
+        logger.info(f"Embedding cache evicted {excess} least recently used vectors")
+
+    def embed(self, texts: list[str], encode) -> list[list[float]]:
+        """
+        Returns vectors for `texts`, calling `encode(list[str])` only for the texts not seen before
+        and caching the new vectors.
+        """
+        found = self.get_many(texts)
+        miss_positions = [i for i in range(len(texts)) if i not in found]
+        if miss_positions:
+            miss_texts = [texts[i] for i in miss_positions]
+            new_vectors = encode(miss_texts)
+            self.put_many(miss_texts, new_vectors)
+            for i, vector in zip(miss_positions, new_vectors):
+                found[i] = vector
+
+        hits = len(texts) - len(miss_positions)
+        logger.info(f"Embedding cache: {hits}/{len(texts)} chunks reused, {len(miss_positions)} embedded "
+                    f"(lifetime hit rate {self.hit_rate():.1%})")
+        return [found[i] for i in range(len(texts))]
+
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_name,
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate(), 4),
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
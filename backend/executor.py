@@ -0,0 +1,163 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import FairQueue, current_flow
+
+logger = logging.getLogger(__name__)
+
+# --- Pool configuration ---
+# I/O-bound clients (Gemini) spend most of their time waiting on the network, so the
+# I/O pool can be wide. Model inference is CPU-bound; torch releases the GIL inside its
+# kernels, so a small thread pool sized to the core count is enough to keep it busy.
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "16"))
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE", str(os.cpu_count() or 1)))
+
+io_pool = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix="io")
+cpu_pool = ThreadPoolExecutor(max_workers=CPU_POOL_SIZE, thread_name_prefix="cpu")
+
+
+class Stage:
+    """
+    A named unit of blocking work (embed, rerank, extract, llm) bound to a pool.
+    Limits how many calls may run at once and tracks how many are waiting, so
+    workers can be sized from observed queue depth instead of guesswork.
+    Waiting calls are admitted in weighted fair order across users (see admission.py).
+    """
+
+    def __init__(self, name: str, pool: ThreadPoolExecutor, concurrency: int):
+        self.name = name
+        self.pool = pool
+        self.concurrency = concurrency
+        self.fair_queue = FairQueue(concurrency)
+        self.queued = 0
+        self.active = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on the stage's pool without blocking the event loop."""
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        flow = current_flow.get()
+        try:
+            await self.fair_queue.acquire(flow)
+        finally:
+            self.queued -= 1
+        self.active += 1
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.pool.submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self.active -= 1
+            self.fair_queue.release(flow)
+            raise
+        # The slot is held until the call is done, not until the caller stops waiting: a request
+        # cancelled mid-call (client gone, LLM deadline) cannot stop the thread running it. A call
+        # cancelled while still queued on the pool never starts and frees its slot at once.
+        future.add_done_callback(functools.partial(self._done_threadsafe, loop, flow, started))
+        return await asyncio.wrap_future(future)
+
+    def _done_threadsafe(self, loop, flow, started: float, future):
+        try:
+            loop.call_soon_threadsafe(self._done, flow, started, future)
+        except RuntimeError:
+            pass  # the event loop has shut down
+
+    def _done(self, flow, started: float, future):
+        self.active -= 1
+        self.fair_queue.release(flow, time.perf_counter() - started)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
+
+    def stats(self) -> dict:
+        return {
+            "pool": "io" if self.pool is io_pool else "cpu",
+            "concurrency": self.concurrency,
+            "queued": self.queued,
+            "active": self.active,
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "fair_queue": self.fair_queue.stats(),
+        }
+
+
+def _limit(stage_name: str, default: int) -> int:
+    return int(os.getenv(f"{stage_name.upper()}_CONCURRENCY", str(default)))
+
+
+# Each stage's concurrency limit can be overridden with <STAGE>_CONCURRENCY, e.g. LLM_CONCURRENCY=8.
+stages = {
+    "extract": Stage("extract", cpu_pool, _limit("extract", max(1, CPU_POOL_SIZE // 2))),
+    "embed": Stage("embed", cpu_pool, _limit("embed", CPU_POOL_SIZE)),
+    "rerank": Stage("rerank", cpu_pool, _limit("rerank", CPU_POOL_SIZE)),
+    "llm": Stage("llm", io_pool, _limit("llm", IO_POOL_SIZE)),
+    "db": Stage("db", io_pool, _limit("db", 8)),
+}
+
+
+async def run_in_stage(stage_name: str, fn, *args, **kwargs):
+    """Runs a blocking call on the pool that owns `stage_name`."""
+    return await stages[stage_name].run(fn, *args, **kwargs)
+
+
+async def iterate_in_stage(stage_name: str, make_iterator):
+    """
+    Consumes a blocking iterator (e.g. a streamed Gemini response) on the stage's pool and
+    yields its items to async code as they arrive. `make_iterator` is called on the worker
+    thread, so any blocking setup it does stays off the event loop too.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def drain():
+        try:
+            for item in make_iterator():
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (done, e))
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+    task = asyncio.ensure_future(run_in_stage(stage_name, drain))
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                break
+            yield item
+        await task
+    finally:
+        # Consumer went away (e.g. client disconnected): let the worker thread stop at the next item
+        stop.set()
+
+
+def executor_stats() -> dict:
+    return {
+        "io_pool_size": IO_POOL_SIZE,
+        "cpu_pool_size": CPU_POOL_SIZE,
+        "stages": {name: stage.stats() for name, stage in stages.items()},
+    }
+
+
+def shutdown_pools():
+    io_pool.shutdown(wait=False, cancel_futures=True)
+    cpu_pool.shutdown(wait=False, cancel_futures=True)
+    logger.info("Executor pools shut down.")
@@ -0,0 +1,166 @@
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz # PyMuPDF for PDF processing
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Process pool configuration ---
+# page.get_text() is CPU-bound and holds the GIL, so threads cannot extract several PDFs at
+# once. Worker processes can; EXTRACT_PROCESSES=0 keeps extraction on the thread pool, which
+# is also the default on single-core machines where worker processes only add overhead.
+_CPUS = os.cpu_count() or 1
+EXTRACT_PROCESSES = int(os.getenv("EXTRACT_PROCESSES", str(_CPUS if _CPUS > 1 else 0)))
+# Large PDFs are split into page ranges of this size so one file can use several cores
+EXTRACT_PAGES_PER_TASK = int(os.getenv("EXTRACT_PAGES_PER_TASK", "20"))
+# Address-space limit per worker process; a task that exceeds it fails instead of exhausting the machine. 0 = no limit.
+EXTRACT_MAX_TASK_MB = int(os.getenv("EXTRACT_MAX_TASK_MB", "1024"))
+# Workers are replaced after this many tasks, returning any memory MuPDF has not given back
+EXTRACT_TASKS_PER_PROCESS = int(os.getenv("EXTRACT_TASKS_PER_PROCESS", "100"))
+# ProcessPoolExecutor(max_tasks_per_child=...) needs Python 3.11; before that the whole pool is
+# replaced once it has run EXTRACT_TASKS_PER_PROCESS tasks per worker
+_NATIVE_RECYCLING = sys.version_info >= (3, 11)
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def _limit_memory(max_mb: int):
+    """Worker initializer: caps the worker's address space (Linux/macOS only)."""
+    if not max_mb:
+        return
+    try:
+        import resource
+        limit = max_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning(f"Could not limit extraction worker memory to {max_mb}MB: {e}")
+
+
+def page_count(path: str) -> int:
+    doc = fitz.open(path)
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
+
+
+def extract_page_range(path: str, start: int, stop: int, page_fn) -> tuple[list, float]:
+    """
+    Runs in a worker process: applies `page_fn` to pages [start, stop) (0-based).
+    Returns ([(page_number, data)], seconds spent), page numbers being 1-based.
+    """
+    started = time.perf_counter()
+    doc = fitz.open(path)
+    try:
+        pages = [(number + 1, page_fn(doc[number])) for number in range(start, stop)]
+    finally:
+        doc.close()
+    return pages, time.perf_counter() - started
+
+
+class ProcessExtractor:
+    """
+    Fans PDF page extraction out to a pool of worker processes.
+
+    Each file is cut into page ranges of `pages_per_task` pages. A file keeps up to
+    `prefetch` ranges in flight and its pages are yielded back in order as ranges complete,
+    so the chunk/embed stages start on the first pages while later ones are still being
+    extracted. Ranges from concurrently ingested files share the pool, so a multi-file
+    upload takes roughly as long as its largest file rather than the sum of all of them.
+
+    `iter_pages` is a blocking generator meant to be consumed on an executor thread, like
+    chunking.iter_pages which it replaces.
+    """
+
+    def __init__(self, processes: int = EXTRACT_PROCESSES, pages_per_task: int = EXTRACT_PAGES_PER_TASK,
+                 max_task_mb: int = EXTRACT_MAX_TASK_MB, tasks_per_process: int = EXTRACT_TASKS_PER_PROCESS,
+                 prefetch: int = None):
+        self.processes = max(1, processes)
+        self.pages_per_task = max(1, pages_per_task)
+        self.max_task_mb = max_task_mb
+        self.tasks_per_process = tasks_per_process or None
+        self.prefetch = prefetch or self.processes
+        self._pool = None
+        self._pool_tasks = 0  # tasks submitted to the current pool, for recycling before 3.11
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if (self._pool is not None and not _NATIVE_RECYCLING and self.tasks_per_process
+                    and self._pool_tasks >= self.tasks_per_process * self.processes):
+                # Ranges already submitted still complete; new files go to a fresh pool
+                self._pool.shutdown(wait=False)
+                self._pool = None
+            if self._pool is None:
+                recycling = {"max_tasks_per_child": self.tasks_per_process} if _NATIVE_RECYCLING else {}
+                # "spawn": forking a process that has loaded torch and started threads is unsafe
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_limit_memory,
+                    initargs=(self.max_task_mb,),
+                    **recycling,
+                )
+                self._pool_tasks = 0
+                logger.info(f"Started PDF extraction pool with {self.processes} processes.")
+            return self._pool
+
+    def _submit(self, pool: ProcessPoolExecutor, *args):
+        with self._lock:
+            if pool is self._pool:
+                self._pool_tasks += 1
+        return pool.submit(*args)
+
+    def _reset_pool(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is broken:
+                self._pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def iter_pages(self, path: str, page_fn):
+        """Yields (page_number, page_fn(page)) for every page of the PDF, in order."""
+        total = page_count(path)
+        ranges = deque((start, min(start + self.pages_per_task, total)) for start in range(0, total, self.pages_per_task))
+        pool = self._get_pool()
+        in_flight = deque()
+        try:
+            while ranges or in_flight:
+                while ranges and len(in_flight) < self.prefetch:
+                    start, stop = ranges.popleft()
+                    in_flight.append((start, stop, self._submit(pool, extract_page_range, path, start, stop, page_fn)))
+                start, stop, future = in_flight.popleft()
+                try:
+                    pages, seconds = future.result()
+                except BrokenProcessPool:
+                    self._reset_pool(pool)
+                    raise ExtractionError(
+                        f"Extraction worker died on pages {start + 1}-{stop}; "
+                        f"the file may need more than EXTRACT_MAX_TASK_MB={self.max_task_mb}MB"
+                    )
+                except MemoryError:
+                    raise ExtractionError(f"Pages {start + 1}-{stop} exceed EXTRACT_MAX_TASK_MB={self.max_task_mb}MB")
+                for page in pages:
+                    metrics.observe("extract", seconds / max(1, len(pages)))
+                    yield page
+        finally:
+            # Consumer stopped early (failure or cancellation): drop the ranges not yet started
+            for _, _, future in in_flight:
+                future.cancel()
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            logger.info("PDF extraction pool shut down.")
@@ -0,0 +1,199 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# "torch" runs the fp32 PyTorch models; "onnx" runs dynamically int8-quantized ONNX exports
+# through ONNX Runtime (needs `pip install -r requirements-onnx.txt`, which the Docker image
+# does). If the ONNX models cannot be exported or loaded, the PyTorch models are used instead.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch").lower()
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_models")
+# Instruction set the int8 kernels are tuned for: arm64, avx2, avx512 or avx512_vnni
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx2")
+# sentence-transformers (and with it torch) is imported only where models are loaded, so web
+# workers that use the inference sidecar (sidecar.py) never load it.
+
+# Hugging Face download cache for the models. The Docker image pre-fills it at build time
+# (`python inference.py download`) so a cold start reads local files instead of the Hub.
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR") or None
+
+
+def _export_dir(model_name: str) -> str:
+    return os.path.join(ONNX_MODEL_DIR, model_name.replace("/", "__"))
+
+
+def _quantized_file(quantization: str) -> str:
+    return f"onnx/model_qint8_{quantization}.onnx"
+
+
+def export_quantized(model_cls, model_name: str, quantization: str = ONNX_QUANTIZATION) -> str:
+    """
+    Exports `model_name` to ONNX and writes a dynamically int8-quantized copy next to it.
+    The export is cached: an existing quantized file is reused. Returns the model directory.
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    directory = _export_dir(model_name)
+    if os.path.exists(os.path.join(directory, _quantized_file(quantization))):
+        return directory
+
+    logger.info(f"Exporting {model_name} to int8 ONNX ({quantization}) in {directory}; this runs once.")
+    model = model_cls(model_name, backend="onnx", cache_folder=MODEL_CACHE_DIR)
+    model.save_pretrained(directory)
+    export_dynamic_quantized_onnx_model(model, quantization, directory, file_suffix=f"qint8_{quantization}")
+    return directory
+
+
+def load_onnx(model_cls, model_name: str, quantization: str = ONNX_QUANTIZATION):
+    directory = export_quantized(model_cls, model_name, quantization)
+    return model_cls(directory, backend="onnx", model_kwargs={"file_name": _quantized_file(quantization)})
+
+
+def load_torch(model_cls, model_name: str):
+    # Using 'cpu' for broad compatibility. Consider 'cuda' if a GPU is available and configured.
+    return model_cls(model_name, device='cpu', cache_folder=MODEL_CACHE_DIR)
+
+
+def load_pair(load, embedder_name: str, reranker_name: str):
+    """Loads the embedder and reranker side by side; reading weights and building the models mostly release the GIL."""
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-load") as pool:
+        embedder = pool.submit(load, SentenceTransformer, embedder_name)
+        reranker = pool.submit(load, CrossEncoder, reranker_name)
+        return embedder.result(), reranker.result()
+
+
+def load_models(embedder_name: str, reranker_name: str, backend: str = INFERENCE_BACKEND):
+    """Returns (embedder, reranker, backend actually in use)."""
+    if backend == "onnx":
+        try:
+            embedder, reranker = load_pair(load_onnx, embedder_name, reranker_name)
+            logger.info(f"Loaded int8 ONNX models ({ONNX_QUANTIZATION}) for {embedder_name} and {reranker_name}.")
+            return embedder, reranker, "onnx"
+        except ImportError as e:
+            logger.error(f"INFERENCE_BACKEND=onnx but ONNX Runtime is not installed ({e}); "
+                         f"install requirements-onnx.txt. Falling back to PyTorch.")
+        except Exception as e:
+            logger.warning(f"Could not load ONNX models, falling back to PyTorch: {e}", exc_info=True)
+    elif backend != "torch":
+        logger.warning(f"Unknown INFERENCE_BACKEND '{backend}', using PyTorch.")
+
+    embedder, reranker = load_pair(load_torch, embedder_name, reranker_name)
+    return embedder, reranker, "torch"
+
+
+def backend_tag(backend: str) -> str:
+    """Distinguishes vectors produced by different backends, e.g. in the embedding cache key."""
+    return "" if backend == "torch" else f"@{backend}-qint8-{ONNX_QUANTIZATION}"
+
+
+# --- Parity check ---
+# `python inference.py parity` exits non-zero when the int8 models drift past these, so it can
+# gate a deployment (or a change of ONNX_QUANTIZATION) in CI.
+PARITY_MIN_COSINE = float(os.getenv("PARITY_MIN_COSINE", "0.98"))
+PARITY_MIN_TOP1_AGREEMENT = float(os.getenv("PARITY_MIN_TOP1_AGREEMENT", "1.0"))
+
+PARITY_SENTENCES = [
+    "The pump must be serviced every 500 operating hours.",
+    "Clause 4.2.1 requires part AB-1234 to be tightened to 12 Nm.",
+    "Employees are entitled to 25 days of paid leave per calendar year.",
+    "The warranty does not cover damage caused by improper installation.",
+    "Store the device in a dry place between 5 and 35 degrees Celsius.",
+    "Invoices are payable within 30 days of the invoice date.",
+    "The tenant shall notify the landlord of any defects without delay.",
+    "Backups are encrypted with AES-256 and retained for 90 days.",
+]
+PARITY_QUESTIONS = [
+    "How often does the pump need servicing?",
+    "What torque for AB-1234?",
+    "How many vacation days do employees get?",
+    "When do invoices have to be paid?",
+]
+
+
+def parity_report(embedder_name: str, reranker_name: str, repeats: int = 20) -> dict:
+    """
+    Compares the int8 ONNX models against the fp32 PyTorch ones: cosine similarity of the
+    embeddings, reranker score differences and top-1 agreement, and throughput of each.
+    """
+    import numpy as np
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+
+    torch_embedder, torch_reranker = load_torch(SentenceTransformer, embedder_name), load_torch(CrossEncoder, reranker_name)
+    onnx_embedder, onnx_reranker = load_onnx(SentenceTransformer, embedder_name), load_onnx(CrossEncoder, reranker_name)
+    pairs = [(q, s) for q in PARITY_QUESTIONS for s in PARITY_SENTENCES]
+
+    def throughput(fn, items):
+        fn(items)  # warm-up
+        started = time.perf_counter()
+        for _ in range(repeats):
+            fn(items)
+        return round(repeats * len(items) / (time.perf_counter() - started), 1)
+
+    a = torch_embedder.encode(PARITY_SENTENCES, normalize_embeddings=True)
+    b = onnx_embedder.encode(PARITY_SENTENCES, normalize_embeddings=True)
+    cosines = (a * b).sum(axis=1)
+
+    torch_scores = np.asarray(torch_reranker.predict(pairs)).reshape(len(PARITY_QUESTIONS), -1)
+    onnx_scores = np.asarray(onnx_reranker.predict(pairs)).reshape(len(PARITY_QUESTIONS), -1)
+
+    return {
+        "quantization": ONNX_QUANTIZATION,
+        "embedder": {
+            "mean_cosine": round(float(cosines.mean()), 5),
+            "min_cosine": round(float(cosines.min()), 5),
+            "torch_sentences_per_s": throughput(torch_embedder.encode, PARITY_SENTENCES),
+            "onnx_sentences_per_s": throughput(onnx_embedder.encode, PARITY_SENTENCES),
+        },
+        "reranker": {
+            "max_abs_score_diff": round(float(np.abs(torch_scores - onnx_scores).max()), 5),
+            "top1_agreement": float((torch_scores.argmax(axis=1) == onnx_scores.argmax(axis=1)).mean()),
+            "torch_pairs_per_s": throughput(torch_reranker.predict, pairs),
+            "onnx_pairs_per_s": throughput(onnx_reranker.predict, pairs),
+        },
+    }
+
+
+def parity_failures(report: dict, min_cosine: float = PARITY_MIN_COSINE,
+                    min_top1_agreement: float = PARITY_MIN_TOP1_AGREEMENT) -> list[str]:
+    """The parity thresholds the report misses, as readable messages; empty if it passes."""
+    failures = []
+    if report["embedder"]["min_cosine"] < min_cosine:
+        failures.append(f"embedding cosine {report['embedder']['min_cosine']} is below {min_cosine}")
+    if report["reranker"]["top1_agreement"] < min_top1_agreement:
+        failures.append(f"reranker top-1 agreement {report['reranker']['top1_agreement']} is below {min_top1_agreement}")
+    return failures
+
+
+if __name__ == "__main__":
+    # Downloads the models into MODEL_CACHE_DIR (run while building the image), exports (and
+    # caches) the quantized models ahead of deployment, and reports parity:
+    #   python inference.py download
+    #   python inference.py export
+    #   python inference.py parity
+    import json
+    import sys
+
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    embedder_name, reranker_name = "all-MiniLM-L12-v2", "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    command = sys.argv[1] if len(sys.argv) > 1 else "export"
+    if command == "download":
+        load_pair(load_torch, embedder_name, reranker_name)
+        print(MODEL_CACHE_DIR or "default Hugging Face cache")
+    elif command == "export":
+        for model_cls, name in ((SentenceTransformer, embedder_name), (CrossEncoder, reranker_name)):
+            print(export_quantized(model_cls, name))
+    elif command == "parity":
+        report = parity_report(embedder_name, reranker_name)
+        print(json.dumps(report, indent=2))
+        failures = parity_failures(report)
+        if failures:
+            sys.exit("Parity check failed: " + "; ".join(failures))
+        print("Parity check passed.")
+    else:
+        sys.exit(f"Unknown command '{command}'; use 'download', 'export' or 'parity'.")
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+
+from fastapi import UploadFile
+from qdrant_client.models import PointStruct
+
+from chunking import Chunk, WindowChunker, iter_pages
+from executor import run_in_stage
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or tempfile.gettempdir()
+SPOOL_READ_SIZE = 1024 * 1024  # Copy uploads to disk 1MB at a time
+
+
+class FileTooLargeError(Exception):
+    pass
+
+
+async def spool_upload(file: UploadFile, max_bytes: int, spool_dir: str = None) -> str:
+    """
+    Streams an upload to a temporary file on disk without holding it in memory.
+    Returns the path; the caller is responsible for removing it.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=spool_dir or SPOOL_DIR)
+    written = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                block = await file.read(SPOOL_READ_SIZE)
+                if not block:
+                    break
+                written += len(block)
+                if written > max_bytes:
+                    raise FileTooLargeError(f"{file.filename} exceeds {max_bytes} bytes")
+                out.write(block)
+    except BaseException:
+        remove_spooled(path)
+        raise
+    return path
+
+
+def remove_spooled(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def take(iterator, n: int) -> list:
+    """Pulls up to `n` items from an iterator (runs the extract/chunk work for them)."""
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) >= n:
+            break
+    return batch
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(SPOOL_READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_point_id(user_id: str, filename: str, digest: str, occurrence: int) -> str:
+    """
+    Stable point id derived from the chunk content. Unlike Python's salted `hash()`, the same
+    chunk maps to the same id on every worker and after restarts, so re-uploads overwrite
+    instead of duplicating. `occurrence` separates identical chunks repeated within a file.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{user_id}/{filename}/{digest}/{occurrence}"))
+
+
+class IngestionPipeline:
+    """
+    Page-at-a-time ingestion: extract → chunk → embed in fixed batches → upsert.
+    Chunk boundaries come from the pluggable `chunker` (see chunking.py); pages come from
+    `page_source`, in-thread by default or from extraction.ProcessExtractor's worker processes.
+
+    Each batch is upserted as soon as it is embedded, while the next batch is being
+    extracted and embedded, so peak memory is bounded by the batch size and the first
+    chunks of a document become searchable before the rest has been processed.
+
+    In incremental mode the chunks already indexed for the filename are looked up first:
+    unchanged chunks are neither re-embedded nor re-upserted, and chunks that no longer
+    appear in the new version are deleted at the end, so the write cost follows the diff.
+    This also makes re-running an interrupted file cheap.
+    """
+
+    def __init__(self, embed_batch, store, chunker=None, page_source=None, batch_size: int = 50, incremental: bool = True):
+        self.embed_batch = embed_batch  # async (list[str]) -> list[list[float]]
+        self.store = store              # vector_store.ChunkStore
+        self.chunker = chunker or WindowChunker()
+        self.page_source = page_source or iter_pages  # (path, page_fn) -> iterator of (page_number, data)
+        self.batch_size = batch_size
+        self.incremental = incremental
+
+    def build_points(self, user_id: str, filename: str, chunks: list[tuple[str, int, str, Chunk]], vectors: list[list[float]]) -> list[PointStruct]:
+        """`chunks` holds (point_id, chunk_index, digest, chunk) for each vector."""
+        points = []
+        for (point_id, chunk_index, digest, chunk), vector in zip(chunks, vectors):
+            payload = {
+                "text": chunk.text,
+                "source": "document",
+                "filename": filename,
+                "user_id": user_id,
+                "chunk_index": chunk_index,
+                "content_hash": digest,
+            }
+            if chunk.pages:
+                payload["page"] = chunk.pages[0]
+                payload["pages"] = chunk.pages
+                payload["bboxes"] = chunk.bboxes
+            if chunk.heading:
+                payload["heading"] = chunk.heading
+            points.append(PointStruct(id=point_id, vector=vector, payload=payload))
+        return points
+
+    async def ingest_file(self, path: str, filename: str, user_id: str, on_progress=None) -> dict:
+        """
+        Indexes one spooled PDF. Returns {"pages", "chunks", "points", "has_text", "new", "unchanged", "deleted", "file_hash"}.
+
+        `points` counts chunks confirmed in Qdrant, whether newly upserted or already there.
+        `on_progress`, if given, is awaited with a copy of the stats after every batch.
+        """
+        stats = {"pages": 0, "chunks": 0, "points": 0, "has_text": False, "new": 0, "unchanged": 0, "deleted": 0}
+        existing = await self.store.existing_chunks(user_id, filename) if self.incremental else {}
+        file_hash = await run_in_stage("extract", file_digest, path)
+        seen = set()
+        occurrences = {}
+        moved = {}
+
+        chunk_iter = self.chunker.chunk_pages(self.page_source(path, self.chunker.page_fn), stats)
+        pending_upsert = None
+
+        async def report():
+            if on_progress is not None:
+                await on_progress(dict(stats))
+
+        async def confirm(upsert):
+            stats["points"] += await upsert
+            await report()
+
+        try:
+            while True:
+                batch_chunks = await run_in_stage("extract", take, chunk_iter, self.batch_size)
+                if not batch_chunks:
+                    break
+
+                new_chunks = []
+                for chunk in batch_chunks:
+                    chunk_index = stats["chunks"]
+                    stats["chunks"] += 1
+                    digest = chunk_digest(chunk.text)
+                    occurrence = occurrences.get(digest, 0)
+                    occurrences[digest] = occurrence + 1
+                    point_id = chunk_point_id(user_id, filename, digest, occurrence)
+                    if point_id in existing:
+                        seen.add(point_id)
+                        if existing[point_id] != chunk_index:
+                            moved[point_id] = chunk_index
+                    else:
+                        new_chunks.append((point_id, chunk_index, digest, chunk))
+
+                unchanged = len(batch_chunks) - len(new_chunks)
+                stats["unchanged"] += unchanged
+                stats["points"] += unchanged
+                if not new_chunks:
+                    await report()
+                    continue
+
+                vectors = await self.embed_batch([chunk.text for _, _, _, chunk in new_chunks])
+                points = self.build_points(user_id, filename, new_chunks, vectors)
+                stats["new"] += len(points)
+
+                # Keep at most one upsert in flight: wait for the previous batch before sending this one
+                if pending_upsert is not None:
+                    await confirm(pending_upsert)
+                pending_upsert = asyncio.ensure_future(self.store.upsert_points(points))
+
+            if pending_upsert is not None:
+                await confirm(pending_upsert)
+                pending_upsert = None
+        finally:
+            if pending_upsert is not None:
+                pending_upsert.cancel()
+            try:
+                chunk_iter.close()
+            except ValueError:
+                # Still running on a worker thread after cancellation; it is released once that finishes
+                pass
+
+        await self.store.set_chunk_indexes(user_id, moved)
+        stale = [point_id for point_id in existing if point_id not in seen]
+        if stale:
+            stats["deleted"] = await self.store.delete_points(user_id, stale)
+
+        logger.info(f"Ingested {filename}: {stats['pages']} pages, {stats['chunks']} chunks "
+                    f"({stats['new']} new, {stats['unchanged']} unchanged, {len(moved)} moved, {stats['deleted']} stale deleted)")
+        stats["file_hash"] = file_hash
+        return stats
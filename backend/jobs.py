@@ -0,0 +1,450 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+
+from fastapi import UploadFile
+from sqlalchemy import or_
+
+from admission import BULK, set_flow
+from database import SessionLocal
+from executor import run_in_stage
+from ingestion import FileTooLargeError, spool_upload, remove_spooled
+from manifest import has_document, record_document, touch_documents
+from tombstones import covering, is_deleted
+from models import IngestionJob, IngestionJobFile
+
+logger = logging.getLogger(__name__)
+
+# Spooled uploads must outlive a worker crash for jobs to resume, so on Fly.io point
+# this at a mounted volume rather than the machine's ephemeral /tmp.
+JOB_SPOOL_DIR = os.getenv("JOB_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "docquery-jobs")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_JOBS_PER_USER = int(os.getenv("INGEST_JOBS_PER_USER", "1"))
+# A running job whose heartbeat is older than this is considered orphaned and is picked up again
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "300"))
+# How often each worker process looks for orphaned jobs; a worker that crashed and came back
+# before its jobs went stale finds them here once they do
+JOB_SWEEP_SECONDS = int(os.getenv("JOB_SWEEP_SECONDS", "60"))
+# Uploads are refused with a 429 once this many jobs are unfinished (queued or running), per
+# user and across all workers, so a burst of uploads cannot fill the spool volume; 0 = no limit
+INGEST_MAX_QUEUED_PER_USER = int(os.getenv("INGEST_MAX_QUEUED_PER_USER", "5"))
+INGEST_MAX_QUEUED = int(os.getenv("INGEST_MAX_QUEUED", "200"))
+
+
+# --- Database helpers (blocking; run on the "db" executor stage) ---
+
+def _backlog(user_id: str) -> tuple[int, int]:
+    """Returns the number of unfinished jobs of the user, and of everyone."""
+    db = SessionLocal()
+    try:
+        unfinished = db.query(IngestionJob).filter(IngestionJob.status.in_(("queued", "running")))
+        return unfinished.filter(IngestionJob.user_id == user_id).count(), unfinished.count()
+    finally:
+        db.close()
+
+def _create_job(job_id: str, user_id: str, files: list[dict]):
+    db = SessionLocal()
+    try:
+        job = IngestionJob(id=job_id, user_id=user_id, status="queued")
+        for f in files:
+            job.files.append(IngestionJobFile(
+                filename=f["filename"],
+                spool_path=f.get("spool_path"),
+                status="failed" if f.get("error") else "queued",
+                error=f.get("error"),
+            ))
+        db.add(job)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _claim_job(job_id: str) -> bool:
+    """Atomically marks a job as running unless another worker holds a live claim on it."""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        claimed = db.query(IngestionJob).filter(
+            IngestionJob.id == job_id,
+            or_(
+                IngestionJob.status == "queued",
+                (IngestionJob.status == "running") & (IngestionJob.heartbeat_at < now - timedelta(seconds=JOB_STALE_SECONDS)),
+            ),
+        ).update({"status": "running", "heartbeat_at": now}, synchronize_session=False)
+        db.commit()
+        return claimed == 1
+    finally:
+        db.close()
+
+
+def _job_files(job_id: str) -> list[dict]:
+    db = SessionLocal()
+    try:
+        files = db.query(IngestionJobFile).filter(IngestionJobFile.job_id == job_id).order_by(IngestionJobFile.id).all()
+        return [
+            {"id": f.id, "filename": f.filename, "spool_path": f.spool_path, "status": f.status}
+            for f in files
+        ]
+    finally:
+        db.close()
+
+
+def _update_file(job_id: str, file_id: int, **fields):
+    db = SessionLocal()
+    try:
+        db.query(IngestionJobFile).filter(IngestionJobFile.id == file_id).update(fields, synchronize_session=False)
+        db.query(IngestionJob).filter(IngestionJob.id == job_id).update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+class FileDeleted(Exception):
+    """The file was deleted while it was being ingested."""
+
+
+DELETED_ERROR = "Deleted while it was being indexed"
+
+
+def _complete_file(job_id: str, file_id: int, user_id: str, filename: str, result: dict, error: str = None) -> bool:
+    """
+    Records a file's final status and, if it was indexed, its manifest row, in one transaction.
+    Returns False, without recording the row, if the file was deleted while it was indexed.
+    """
+    db = SessionLocal()
+    try:
+        deleted = covering(db, user_id, filename).first() is not None
+        if deleted:
+            error = DELETED_ERROR
+        db.query(IngestionJobFile).filter(IngestionJobFile.id == file_id).update({
+            "status": "failed" if error else "done",
+            "error": error,
+            "pages": result["pages"],
+            "chunks": result["chunks"],
+            "points": result["points"],
+        }, synchronize_session=False)
+        db.query(IngestionJob).filter(IngestionJob.id == job_id).update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+        if not error:
+            record_document(db, user_id, filename, result["file_hash"], result["pages"], result["points"])
+        db.commit()
+        return not deleted
+    finally:
+        db.close()
+
+
+def _finish_job(job_id: str) -> str:
+    db = SessionLocal()
+    try:
+        job = db.query(IngestionJob).filter(IngestionJob.id == job_id).first()
+        job.status = "completed" if any(f.status == "done" for f in job.files) else "failed"
+        job.heartbeat_at = datetime.utcnow()
+        db.commit()
+        return job.status
+    finally:
+        db.close()
+
+
+def _resumable_jobs(stale_only: bool = False) -> list[tuple[str, str]]:
+    """
+    Queued jobs and running jobs with a stale heartbeat. With `stale_only`, queued jobs too
+    must have waited longer than JOB_STALE_SECONDS, so a sweep leaves the jobs another live
+    worker has just queued alone.
+    """
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+        queued = IngestionJob.status == "queued"
+        if stale_only:
+            queued = queued & (IngestionJob.heartbeat_at < cutoff)
+        jobs = db.query(IngestionJob).filter(
+            or_(
+                queued,
+                (IngestionJob.status == "running") & (IngestionJob.heartbeat_at < cutoff),
+            )
+        ).order_by(IngestionJob.created_at).all()
+        return [(job.id, job.user_id) for job in jobs]
+    finally:
+        db.close()
+
+
+def _job_report(job_id: str, user_id: str) -> dict | None:
+    db = SessionLocal()
+    try:
+        job = db.query(IngestionJob).filter(IngestionJob.id == job_id, IngestionJob.user_id == user_id).first()
+        if job is None:
+            return None
+        files = [
+            {
+                "filename": f.filename,
+                "status": f.status,
+                "pages": f.pages or 0,
+                "chunks": f.chunks or 0,
+                "points": f.points or 0,
+                "error": f.error,
+            }
+            for f in job.files
+        ]
+        return {
+            "job_id": job.id,
+            "status": job.status,
+            "created_at": job.created_at.isoformat() if job.created_at else None,
+            "files": files,
+            "total_points": sum(f["points"] for f in files),
+        }
+    finally:
+        db.close()
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the backlog is at its limit; nothing has been spooled."""
+
+    def __init__(self, reason: str, retry_after: float, message: str):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.message = message
+
+
+class JobQueue:
+    """
+    In-process ingestion job queue.
+
+    /upload spools the files to JOB_SPOOL_DIR, records a job in the database and returns
+    immediately; a fixed pool of worker tasks runs extract → chunk → embed → upsert. Job and
+    per-file progress live in the database, so after a crash any queued job or running job
+    with a stale heartbeat is picked up again, on startup and by a sweep every
+    JOB_SWEEP_SECONDS. Unfinished files are re-run; since
+    point ids are content-derived, incremental ingestion skips the chunks already indexed
+    and only the remainder is embedded. At most `per_user_limit` jobs per user run at once;
+    the rest wait their turn without holding a worker. New jobs are refused with QueueFull
+    beyond `max_queued_per_user` unfinished jobs of the user, or `max_queued` in total.
+    """
+
+    def __init__(self, pipeline, max_upload_bytes: int, workers: int = INGEST_WORKERS, per_user_limit: int = INGEST_JOBS_PER_USER,
+                 on_documents_changed=None, settle_deletes=None, max_queued_per_user: int = INGEST_MAX_QUEUED_PER_USER,
+                 max_queued: int = INGEST_MAX_QUEUED):
+        self.pipeline = pipeline
+        self.on_documents_changed = on_documents_changed  # (user_id) -> None, called after each file is indexed
+        # async (user_id, filename) -> None: purges the file's pending deletes; awaited before a
+        # file is indexed and after a delete stopped it
+        self.settle_deletes = settle_deletes
+        self.max_upload_bytes = max_upload_bytes
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queued = max_queued
+        self.job_seconds = None  # moving average of how long a job runs, for Retry-After
+        self._queue = asyncio.Queue()
+        self._active = defaultdict(int)
+        self._deferred = defaultdict(deque)
+        self._known = set()  # job ids queued, deferred or running in this process
+        self._tasks = []
+
+    async def start(self):
+        os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        resumed = await self._resume()
+        self._tasks.append(asyncio.create_task(self._sweep()))
+        logger.info(f"Ingestion job queue started with {self.workers} workers; {resumed} jobs resumed.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _enqueue(self, job_id: str, user_id: str):
+        self._known.add(job_id)
+        self._queue.put_nowait((job_id, user_id))
+
+    async def _resume(self, stale_only: bool = False) -> int:
+        """Enqueues the resumable jobs this process doesn't already hold; returns how many."""
+        try:
+            resumable = await run_in_stage("db", _resumable_jobs, stale_only)
+        except Exception as e:
+            logger.error(f"Could not load resumable ingestion jobs: {e}", exc_info=True)
+            return 0
+        resumed = 0
+        for job_id, user_id in resumable:
+            if job_id not in self._known:
+                self._enqueue(job_id, user_id)
+                resumed += 1
+        return resumed
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(JOB_SWEEP_SECONDS)
+            resumed = await self._resume(stale_only=True)
+            if resumed:
+                logger.info(f"Picked up {resumed} orphaned ingestion jobs.")
+
+    async def _check_backlog(self, user_id: str):
+        if not self.max_queued_per_user and not self.max_queued:
+            return
+        mine, total = await run_in_stage("db", _backlog, user_id)
+        job_seconds = self.job_seconds or 30.0
+        if self.max_queued_per_user and mine >= self.max_queued_per_user:
+            raise QueueFull("user_backlog", (mine - self.max_queued_per_user + 1) * job_seconds / self.per_user_limit,
+                            f"You already have {mine} uploads waiting to be indexed.")
+        if self.max_queued and total >= self.max_queued:
+            raise QueueFull("backlog", (total - self.max_queued + 1) * job_seconds / self.workers,
+                            "DocQuery is indexing too many uploads right now.")
+
+    async def submit(self, user_id: str, files: list[UploadFile]) -> str:
+        """
+        Spools the uploads to disk, records the job and enqueues it. Returns the job id, or
+        raises QueueFull, before spooling anything, if the backlog is at its limit.
+        """
+        await self._check_backlog(user_id)
+        job_id = str(uuid.uuid4())
+        job_files = []
+        try:
+            for file in files:
+                try:
+                    path = await spool_upload(file, self.max_upload_bytes, spool_dir=JOB_SPOOL_DIR)
+                    job_files.append({"filename": file.filename, "spool_path": path})
+                except FileTooLargeError:
+                    job_files.append({"filename": file.filename, "error": "File too large (>50MB)"})
+            await run_in_stage("db", _create_job, job_id, user_id, job_files)
+        except BaseException:
+            for f in job_files:
+                if f.get("spool_path"):
+                    remove_spooled(f["spool_path"])
+            raise
+
+        self._enqueue(job_id, user_id)
+        logger.info(f"Queued ingestion job {job_id} with {len(files)} files for user {user_id}")
+        return job_id
+
+    async def report(self, job_id: str, user_id: str) -> dict | None:
+        return await run_in_stage("db", _job_report, job_id, user_id)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job_id, user_id = await self._queue.get()
+            if self._active[user_id] >= self.per_user_limit:
+                # The user already has their share running; park the job until one finishes
+                self._deferred[user_id].append(job_id)
+                continue
+
+            self._active[user_id] += 1
+            started = time.perf_counter()
+            try:
+                await self._run_job(job_id, user_id)
+                seconds = time.perf_counter() - started
+                self.job_seconds = seconds if self.job_seconds is None else 0.8 * self.job_seconds + 0.2 * seconds
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ingestion job {job_id} crashed on worker {worker_id}: {e}", exc_info=True)
+            finally:
+                self._known.discard(job_id)
+                self._active[user_id] -= 1
+                if self._deferred[user_id]:
+                    self._queue.put_nowait((self._deferred[user_id].popleft(), user_id))
+                if not self._active[user_id]:
+                    del self._active[user_id]
+                if not self._deferred[user_id]:
+                    del self._deferred[user_id]
+
+    async def _run_job(self, job_id: str, user_id: str):
+        # Everything the job runs on the executor is bulk work, queued behind interactive queries
+        set_flow(user_id, BULK)
+        if not await run_in_stage("db", _claim_job, job_id):
+            logger.info(f"Ingestion job {job_id} is finished or held by another worker; skipping.")
+            return
+
+        # Files of a job are ingested concurrently; their extraction shares the process pool
+        pending = [f for f in await run_in_stage("db", _job_files, job_id) if f["status"] not in ("done", "failed")]
+        if pending and self.settle_deletes is not None:
+            # A "delete all" covers every file; purge it once, before any of them writes. If this
+            # fails, each file's own settle tries again
+            try:
+                await self.settle_deletes(user_id, None)
+            except Exception as e:
+                logger.error(f"Could not purge the deleted documents of user {user_id} before job {job_id}: {e}", exc_info=True)
+        await asyncio.gather(*(self._run_file(job_id, user_id, f) for f in pending))
+
+        status = await run_in_stage("db", _finish_job, job_id)
+        logger.info(f"Ingestion job {job_id} finished with status '{status}'")
+
+    async def _settle(self, user_id: str, filename: str):
+        """Purges a file deleted while it was indexed; the purger's sweep retries if this fails."""
+        if self.settle_deletes is not None:
+            try:
+                await self.settle_deletes(user_id, filename)
+            except Exception as e:
+                logger.error(f"Could not purge {filename} of user {user_id}: {e}", exc_info=True)
+        if self.on_documents_changed is not None:
+            self.on_documents_changed(user_id)
+
+    async def _discard_partial(self, user_id: str, filename: str):
+        """
+        Removes the batches a failed file got indexed before the failure. Without a manifest
+        row they would be searchable but missing from /documents, so the user could not
+        delete them. A file that was indexed before keeps its row and its chunks.
+        """
+        try:
+            if not await run_in_stage("db", has_document, user_id, filename):
+                removed = await self.pipeline.store.purge_documents(user_id, filename)
+                logger.info(f"Removed {removed} partially indexed chunks of {filename} for user {user_id}")
+            # Answers built while those batches were searchable must not be served again
+            await run_in_stage("db", touch_documents, user_id)
+        except Exception as e:
+            logger.error(f"Could not remove the partially indexed chunks of {filename}: {e}", exc_info=True)
+        # Batches indexed before the failure may have reached cached answers
+        if self.on_documents_changed is not None:
+            self.on_documents_changed(user_id)
+
+    async def _run_file(self, job_id: str, user_id: str, f: dict):
+        file_id = f["id"]
+        if not f["spool_path"] or not os.path.exists(f["spool_path"]):
+            await run_in_stage("db", _update_file, job_id, file_id, status="failed",
+                               error="Upload data is no longer available; please upload the file again")
+            return
+
+        async def on_progress(stats: dict):
+            await run_in_stage("db", _update_file, job_id, file_id,
+                               pages=stats["pages"], chunks=stats["chunks"], points=stats["points"])
+            if self.settle_deletes is not None and await run_in_stage("db", is_deleted, user_id, f["filename"]):
+                raise FileDeleted()
+
+        await run_in_stage("db", _update_file, job_id, file_id, status="running")
+        try:
+            if self.settle_deletes is not None:
+                await self.settle_deletes(user_id, f["filename"])
+            result = await self.pipeline.ingest_file(f["spool_path"], f["filename"], user_id, on_progress=on_progress)
+        except asyncio.CancelledError:
+            # Shutdown: leave the file 'running' so it is picked up again on restart
+            raise
+        except FileDeleted:
+            logger.info(f"{f['filename']} was deleted while job {job_id} indexed it; stopped and purging it.")
+            await run_in_stage("db", _update_file, job_id, file_id, status="failed", error=DELETED_ERROR)
+            remove_spooled(f["spool_path"])
+            await self._settle(user_id, f["filename"])
+            return
+        except Exception as e:
+            logger.error(f"Error processing {f['filename']} in job {job_id}: {e}", exc_info=True)
+            await run_in_stage("db", _update_file, job_id, file_id, status="failed",
+                               error=f"Processing error - {str(e)[:100]}")
+            remove_spooled(f["spool_path"])
+            await self._discard_partial(user_id, f["filename"])
+            return
+
+        error = None
+        if not result["has_text"] and not result["points"]:
+            error = "No readable text found"
+        elif not result["chunks"]:
+            error = "No valid chunks extracted"
+        recorded = await run_in_stage("db", _complete_file, job_id, file_id, user_id, f["filename"], result, error)
+        remove_spooled(f["spool_path"])
+        if not recorded:
+            await self._settle(user_id, f["filename"])
+            return
+        if self.on_documents_changed is not None:
+            self.on_documents_changed(user_id)
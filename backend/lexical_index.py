@@ -0,0 +1,180 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Keep this on a volume (fly.toml mounts one at /data): on the machine's own filesystem the
+# index is emptied by every redeploy, and hybrid retrieval quietly falls back to dense only.
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "lexical_index.sqlite3")
+
+# Identifiers such as "AB-1234", "4.2.1" or "ISO/IEC" are kept whole here and matched as
+# phrases, so they hit the same adjacent tokens the FTS tokenizer produced at index time.
+_TERM_PATTERN = re.compile(r"\w[\w\-./]*\w|\w")
+
+
+def to_match_query(question: str) -> str | None:
+    """Builds an FTS5 query that ORs every term of the question as a quoted phrase."""
+    terms = dict.fromkeys(term.lower() for term in _TERM_PATTERN.findall(question))
+    if not terms:
+        return None
+    return " OR ".join(f'"{term}"' for term in terms)
+
+
+class LexicalIndex:
+    """
+    Local BM25 index over chunk text, kept next to the Qdrant collection.
+
+    Chunks live in an ordinary SQLite table keyed by point id (so deletes and updates are
+    index lookups), mirrored into an external-content FTS5 table by triggers. The FTS table
+    also indexes a per-user key, so a search only intersects postings of that user's chunks.
+    Rows carry the text, filename and chunk index, so lexical hits can be fused with dense
+    hits without another Qdrant round-trip. Blocking and thread-safe; call it from the executor.
+    """
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunk_rows (
+                rowid INTEGER PRIMARY KEY,
+                point_id TEXT NOT NULL UNIQUE,
+                user_id TEXT NOT NULL,
+                user_key TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                chunk_index INTEGER,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chunk_rows_document ON chunk_rows (user_id, filename);
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+                text, user_key, content='chunk_rows', content_rowid='rowid'
+            );
+            CREATE TRIGGER IF NOT EXISTS chunk_rows_ai AFTER INSERT ON chunk_rows BEGIN
+                INSERT INTO chunks (rowid, text, user_key) VALUES (new.rowid, new.text, new.user_key);
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunk_rows_ad AFTER DELETE ON chunk_rows BEGIN
+                INSERT INTO chunks (chunks, rowid, text, user_key) VALUES ('delete', old.rowid, old.text, old.user_key);
+            END;
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _user_key(user_id: str) -> str:
+        # A single alphanumeric token, so a phrase query on it matches exactly one user
+        return "u" + re.sub(r"\W", "", user_id)
+
+    def add(self, rows: list[tuple[str, str, str, str, int]]):
+        """Indexes (point_id, user_id, filename, text, chunk_index) rows, replacing any existing point ids."""
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM chunk_rows WHERE point_id = ?", [(row[0],) for row in rows])
+            self._conn.executemany(
+                "INSERT INTO chunk_rows (point_id, user_id, user_key, filename, text, chunk_index) VALUES (?, ?, ?, ?, ?, ?)",
+                [(point_id, user_id, self._user_key(user_id), filename, text, chunk_index)
+                 for point_id, user_id, filename, text, chunk_index in rows],
+            )
+            self._conn.commit()
+
+    def set_chunk_indexes(self, chunk_indexes: dict[str, int]):
+        if not chunk_indexes:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE chunk_rows SET chunk_index = ? WHERE point_id = ?",
+                [(index, point_id) for point_id, index in chunk_indexes.items()],
+            )
+            self._conn.commit()
+
+    def delete_ids(self, point_ids: list[str]):
+        with self._lock:
+            self._conn.executemany("DELETE FROM chunk_rows WHERE point_id = ?", [(point_id,) for point_id in point_ids])
+            self._conn.commit()
+
+    def delete_document(self, user_id: str, filename: str = None):
+        """Removes one of the user's documents, or all of them when `filename` is None."""
+        with self._lock:
+            if filename is None:
+                self._conn.execute("DELETE FROM chunk_rows WHERE user_id = ?", (user_id,))
+            else:
+                self._conn.execute("DELETE FROM chunk_rows WHERE user_id = ? AND filename = ?", (user_id, filename))
+            self._conn.commit()
+
+    def search(self, user_id: str, question: str, limit: int = 20) -> list[dict]:
+        """Returns the user's best BM25 matches, best first, as {"id", "text", "filename", "chunk_index", "score"}."""
+        terms_query = to_match_query(question)
+        if terms_query is None:
+            return []
+        match_query = f'user_key : "{self._user_key(user_id)}" AND text : ({terms_query})'
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.point_id, r.text, r.filename, r.chunk_index, bm25(chunks, 1.0, 0.0) AS rank"
+                " FROM chunks JOIN chunk_rows r ON r.rowid = chunks.rowid"
+                " WHERE chunks MATCH ? ORDER BY rank LIMIT ?",
+                (match_query, limit),
+            ).fetchall()
+        # FTS5's bm25() is lower-is-better; flip it so higher means more relevant
+        return [
+            {"id": point_id, "text": text, "filename": filename, "chunk_index": chunk_index, "score": -rank}
+            for point_id, text, filename, chunk_index, rank in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def reciprocal_rank_fusion(*ranked_lists: list[str], k: int = 60) -> list[str]:
+    """Fuses ranked id lists: each id scores sum(1 / (k + rank)) over the lists it appears in."""
+    scores = {}
+    for ranked in ranked_lists:
+        for rank, item_id in enumerate(ranked, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+if __name__ == "__main__":
+    # Backfills the index from every document chunk already stored in Qdrant:
+    #   python lexical_index.py [collection]
+    # covering the shared collection and every dedicated tenant collection.
+    import sys
+
+    from dotenv import load_dotenv
+    from qdrant_client import QdrantClient
+    from qdrant_client.models import Filter, FieldCondition, MatchValue
+
+    from vector_store import QDRANT_COLLECTION, SCROLL_PAGE_SIZE, TENANT_COLLECTION_PREFIX
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"), timeout=60)
+    name = sys.argv[1] if len(sys.argv) > 1 else QDRANT_COLLECTION
+    names = [name] + [c.name for c in client.get_collections().collections if c.name.startswith(f"{TENANT_COLLECTION_PREFIX}_tenant_")]
+    index = LexicalIndex()
+    total = 0
+    for collection_name in names:
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                scroll_filter=Filter(must=[FieldCondition(key="source", match=MatchValue(value="document"))]),
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+                with_payload=["text", "user_id", "filename", "chunk_index"],
+                with_vectors=False,
+            )
+            index.add([
+                (str(p.id), p.payload.get("user_id"), p.payload.get("filename"), p.payload.get("text", ""), p.payload.get("chunk_index"))
+                for p in points if p.payload
+            ])
+            total += len(points)
+            logger.info(f"Backfilled {total} chunks into the lexical index ({collection_name})")
+            if offset is None:
+                break
+    index.close()
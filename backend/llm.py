@@ -0,0 +1,381 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import metrics
+from executor import run_in_stage, iterate_in_stage
+
+logger = logging.getLogger(__name__)
+
+# --- LLM client ---
+# Answers are generated through LLMClient, which puts three guards around the provider:
+# 1. Deadlines: a whole answer must arrive within LLM_TIMEOUT_SECONDS, the first streamed
+#    piece within LLM_FIRST_TOKEN_TIMEOUT_SECONDS.
+# 2. Hedging: a request still running at the provider's observed LLM_HEDGE_PERCENTILE latency
+#    gets a second, identical request; whichever answers first wins. A request that fails
+#    outright (other than by timing out) is retried once the same way. There are never more
+#    than two per call; an abandoned request runs on until the provider's own timeout.
+# 3. Circuit breaker: LLM_BREAKER_FAILURES failed calls in a row take a provider out of
+#    rotation for LLM_BREAKER_RESET_SECONDS, after which a single trial call decides whether
+#    it comes back. Calls go to LLM_FALLBACK_MODEL while the primary is out; with no provider
+#    left the client raises LLMUnavailable and the endpoints answer from retrieval alone.
+# LLM_PROVIDER=fake swaps Gemini for FakeProvider, whose latency distribution is set with the
+# LLM_FAKE_* variables, so all of this can be load-tested offline (see benchmark.py).
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini").lower()
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")  # e.g. gemini-2.5-flash-lite; empty = none
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_FIRST_TOKEN_TIMEOUT_SECONDS = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT_SECONDS", "20"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "true").lower() != "false"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_MS = float(os.getenv("LLM_HEDGE_MIN_MS", "500"))  # never hedge earlier than this
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+LLM_FAKE_LATENCY_MS = float(os.getenv("LLM_FAKE_LATENCY_MS", "800"))  # median
+LLM_FAKE_LATENCY_SIGMA = float(os.getenv("LLM_FAKE_LATENCY_SIGMA", "0.5"))  # lognormal sigma, 0 = fixed
+LLM_FAKE_TAIL_RATE = float(os.getenv("LLM_FAKE_TAIL_RATE", "0"))  # share of calls that straggle
+LLM_FAKE_TAIL_MS = float(os.getenv("LLM_FAKE_TAIL_MS", "10000"))
+LLM_FAKE_ERROR_RATE = float(os.getenv("LLM_FAKE_ERROR_RATE", "0"))
+LLM_FAKE_SEED = os.getenv("LLM_FAKE_SEED")
+
+LATENCY_WINDOW = 200  # recent latencies kept per provider for the hedge threshold
+MIN_HEDGE_SAMPLES = 20  # no hedging until this many have been seen
+
+_END = object()
+
+
+class LLMUnavailable(RuntimeError):
+    pass
+
+
+# --- Providers ---
+# A provider makes blocking calls (run on the "llm" stage): generate() returns a response with
+# `.text`, stream() an iterator of such pieces. Both take the call's timeout in seconds.
+
+class GeminiProvider:
+    def __init__(self, model_name: str, api_key: str):
+        from google.generativeai import configure, GenerativeModel
+
+        configure(api_key=api_key)
+        self.name = model_name
+        self._model = GenerativeModel(model_name)
+
+    def generate(self, prompt: str, timeout: float):
+        return self._model.generate_content(prompt, request_options={"timeout": timeout})
+
+    def stream(self, prompt: str, timeout: float):
+        return self._model.generate_content(prompt, stream=True, request_options={"timeout": timeout})
+
+
+class FakeResponse:
+    usage_metadata = None
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeProvider:
+    """
+    Stands in for Gemini. Latency is lognormal around `median_ms`; a `tail_rate` share of calls
+    takes `tail_ms` instead, and an `error_rate` share fails. Streams arrive in 5 pieces.
+    """
+
+    ANSWER = "Based on your documents, the requested value is stated in the cited clause."
+
+    def __init__(self, name: str = "fake", median_ms: float = LLM_FAKE_LATENCY_MS, sigma: float = LLM_FAKE_LATENCY_SIGMA,
+                 tail_rate: float = LLM_FAKE_TAIL_RATE, tail_ms: float = LLM_FAKE_TAIL_MS,
+                 error_rate: float = LLM_FAKE_ERROR_RATE, seed=LLM_FAKE_SEED):
+        self.name = name
+        self.median_s = median_ms / 1000
+        self.sigma = sigma
+        self.tail_rate = tail_rate
+        self.tail_s = tail_ms / 1000
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self) -> tuple[float, bool]:
+        with self._lock:
+            if self._rng.random() < self.tail_rate:
+                latency = self.tail_s
+            else:
+                latency = self.median_s * self._rng.lognormvariate(0, self.sigma)
+            return latency, self._rng.random() < self.error_rate
+
+    def _wait(self, seconds: float, timeout: float):
+        if seconds > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Fake LLM timed out after {timeout:.1f}s")
+        time.sleep(seconds)
+
+    def generate(self, prompt: str, timeout: float):
+        latency, fail = self._draw()
+        self._wait(latency, timeout)
+        if fail:
+            raise RuntimeError("Fake LLM error")
+        return FakeResponse(self.ANSWER)
+
+    def stream(self, prompt: str, timeout: float):
+        latency, fail = self._draw()
+        words = self.ANSWER.split(" ")
+        size = -(-len(words) // 5)
+        pieces = [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
+        for i, piece in enumerate(pieces):
+            self._wait(latency / len(pieces), timeout - latency * i / len(pieces))
+            if fail:
+                raise RuntimeError("Fake LLM error")
+            yield FakeResponse(piece + " ")
+
+
+# --- Resilience ---
+
+class LatencyWindow:
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if len(self._samples) < MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Closed -> open after `failures` consecutive failures -> half-open (one trial call) after `reset_seconds`."""
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state != "closed" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            # A trial call that never reports back (client gone) is replaced after another period
+            self.state = "half_open"
+            self.opened_at = time.monotonic()
+            return True
+        return self.state == "closed"
+
+    def success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+
+    def failure(self) -> bool:
+        """Records a failed call; returns True if it opened the breaker."""
+        self.consecutive_failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failures):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
+class Route:
+    """A provider with its own breaker and latency history."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.name = provider.name
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyWindow()
+        self.first_token = LatencyWindow()
+
+
+class LLMClient:
+    def __init__(self, primary, fallback=None, timeout: float = LLM_TIMEOUT_SECONDS,
+                 first_token_timeout: float = LLM_FIRST_TOKEN_TIMEOUT_SECONDS, hedge: bool = LLM_HEDGE,
+                 hedge_percentile: float = LLM_HEDGE_PERCENTILE, hedge_min_ms: float = LLM_HEDGE_MIN_MS):
+        self.routes = [Route(primary)] + ([Route(fallback)] if fallback is not None else [])
+        self.timeout = timeout
+        self.first_token_timeout = first_token_timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_s = hedge_min_ms / 1000
+        self.events = {}
+
+    def _event(self, route: Route, event: str):
+        self.events[event] = self.events.get(event, 0) + 1
+        metrics.llm_events.inc(route.name, event)
+
+    def stats(self) -> dict:
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            "routes": [
+                {
+                    "provider": route.name,
+                    "breaker": route.breaker.state,
+                    "consecutive_failures": route.breaker.consecutive_failures,
+                    "p95_ms": ms(route.latency.percentile(95)),
+                    "first_token_p95_ms": ms(route.first_token.percentile(95)),
+                }
+                for route in self.routes
+            ],
+            "events": dict(self.events),
+        }
+
+    def _available(self):
+        """Yields the routes whose breaker lets a call through, primary first."""
+        for route in self.routes:
+            if route.breaker.allow():
+                if route is not self.routes[0]:
+                    self._event(route, "failover")
+                yield route
+
+    def _failed(self, route: Route, error: Exception):
+        self._event(route, "timeout" if isinstance(error, TimeoutError) else "error")
+        if route.breaker.failure():
+            self._event(route, "breaker_open")
+            logger.warning(f"LLM circuit breaker for {route.name} opened after {route.breaker.consecutive_failures} "
+                           f"failed calls; retrying it in {route.breaker.reset_seconds:.0f}s.")
+
+    def _hedge_after(self, window: LatencyWindow) -> float | None:
+        threshold = window.percentile(self.hedge_percentile) if self.hedge else None
+        return max(threshold, self.hedge_min_s) if threshold is not None else None
+
+    async def _race(self, route: Route, start, timeout: float, window: LatencyWindow) -> tuple[int, object]:
+        """
+        Awaits start() and, if it is still running at the hedge threshold or has failed, a second
+        start(). Returns (attempt index, result) of the first attempt to succeed.
+        """
+        started = time.perf_counter()
+        tasks, starts = [], []
+
+        def launch():
+            tasks.append(asyncio.ensure_future(start()))
+            starts.append(time.perf_counter())
+
+        launch()
+        hedge_after = self._hedge_after(window)
+        error = None
+        try:
+            while True:
+                elapsed = time.perf_counter() - started
+                if elapsed >= timeout:
+                    raise TimeoutError(f"{route.name} did not respond within {timeout:.0f}s")
+                can_hedge = len(tasks) == 1 and hedge_after is not None
+                wait = min(timeout - elapsed, max(0.0, hedge_after - elapsed)) if can_hedge else timeout - elapsed
+                done, _ = await asyncio.wait([t for t in tasks if not t.done()], timeout=wait,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = tasks.index(task)
+                    if task.exception() is None:
+                        window.add(time.perf_counter() - starts[attempt])
+                        if attempt == 1 and error is None:
+                            self._event(route, "hedge_won")
+                        return attempt, task.result()
+                    error = task.exception()
+                    logger.warning(f"LLM request to {route.name} failed: {error}")
+
+                if len(tasks) == 1 and error is not None and not isinstance(error, TimeoutError):
+                    self._event(route, "retried")
+                    launch()
+                elif can_hedge and time.perf_counter() - started >= hedge_after:
+                    self._event(route, "hedged")
+                    launch()
+                elif all(task.done() for task in tasks):
+                    raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # the losing attempt's error is not worth a warning at exit
+
+    async def generate(self, prompt: str):
+        """Returns the provider's response; raises LLMUnavailable when no provider answered."""
+        for route in self._available():
+            try:
+                _, response = await self._race(
+                    route, lambda: run_in_stage("llm", route.provider.generate, prompt, self.timeout),
+                    self.timeout, route.latency,
+                )
+            except Exception as e:
+                self._failed(route, e)
+                continue
+            route.breaker.success()
+            return response
+        raise LLMUnavailable("No LLM provider is available")
+
+    async def stream(self, prompt: str):
+        """
+        Yields the pieces of a streamed answer. A provider that fails before its first piece is
+        replaced by the next one; once text has been sent, errors are raised to the caller.
+        Raises LLMUnavailable when no provider answered.
+        """
+        for route in self._available():
+            started = time.perf_counter()
+            streams = []
+
+            def start():
+                stream = iterate_in_stage("llm", lambda: route.provider.stream(prompt, self.timeout))
+                streams.append(stream)
+                return _next_piece(stream)
+
+            winner = None
+            try:
+                winner, piece = await self._race(route, start, self.first_token_timeout, route.first_token)
+            except Exception as e:
+                self._failed(route, e)
+                continue
+            finally:
+                # Losing streams stop at their next piece; cancelled ones have stopped already
+                for i, loser in enumerate(streams):
+                    if i != winner:
+                        asyncio.ensure_future(_close(loser))
+            stream = streams[winner]
+            try:
+                while piece is not _END:
+                    yield piece
+                    remaining = self.timeout - (time.perf_counter() - started)
+                    if remaining <= 0:
+                        raise TimeoutError(f"{route.name} did not finish within {self.timeout:.0f}s")
+                    piece = await asyncio.wait_for(_next_piece(stream), remaining)
+            except Exception as e:
+                self._failed(route, e)
+                raise
+            finally:
+                await stream.aclose()
+            route.breaker.success()
+            return
+        raise LLMUnavailable("No LLM provider is available")
+
+
+async def _close(stream):
+    try:
+        await stream.aclose()
+    except RuntimeError:
+        pass  # still unwinding from the cancellation
+
+
+async def _next_piece(stream):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
+def build_client(api_key: str = None) -> LLMClient:
+    if LLM_PROVIDER == "fake":
+        primary = FakeProvider()
+        fallback = FakeProvider(name="fake-fallback") if LLM_FALLBACK_MODEL else None
+    else:
+        if LLM_PROVIDER != "gemini":
+            logger.warning(f"Unknown LLM_PROVIDER '{LLM_PROVIDER}', using Gemini.")
+        if not api_key:
+            raise RuntimeError("GEMINI_API_KEY not set in environment.")
+        primary = GeminiProvider(LLM_MODEL, api_key)
+        fallback = GeminiProvider(LLM_FALLBACK_MODEL, api_key) if LLM_FALLBACK_MODEL else None
+    logger.info(f"LLM provider: {primary.name}" + (f", falling back to {fallback.name}." if fallback else "."))
+    return LLMClient(primary, fallback)
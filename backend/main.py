@@ -1,37 +1,64 @@
-from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, status
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel
-import fitz # PyMuPDF for PDF processing
-import uuid
 import os
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer, CrossEncoder
-from qdrant_client import QdrantClient
-from qdrant_client.models import (
-    Distance,
-    VectorParams,
-    Filter,
-    MatchValue,
-    FilterSelector,
-    PointStruct,
-    FieldCondition,
-    CollectionStatus
-)
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import CollectionStatus
 from qdrant_client.http.exceptions import UnexpectedResponse
-from google.generativeai import configure, GenerativeModel
 import logging # For more structured logging
 
 # --- Authentication Imports ---
 from auth.routes import router as auth_router
 from auth.oauth import get_current_active_user
 from models import User 
+from executor import run_in_stage, executor_stats, shutdown_pools, stages
+import metrics
+from metrics import timed, TimedClient
+from batching import MicroBatcher
+from ingestion import IngestionPipeline
+from inference import load_models, backend_tag
+from sidecar import connect_models, INFERENCE_SIDECAR
+from chunking import make_chunker, token_counter, CHUNKER, CHUNK_MAX_TOKENS
+from extraction import ProcessExtractor, EXTRACT_PROCESSES
+from embedding_cache import EmbeddingCache
+from vector_store import (
+    ChunkStore, TenantRouter, create_collection, create_payload_indexes, QDRANT_COLLECTION, VECTOR_QUANTIZATION, TENANT_LAYOUT
+)
+from answer_cache import AnswerCache
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from rerank import RerankCascade
+from context_packing import ContextPacker, CONTEXT_PACKING, CONTEXT_CANDIDATES
+from jobs import JobQueue, QueueFull
+from llm import build_client, LLMUnavailable, LLM_PROVIDER
+from admission import AdmissionControl, INTERACTIVE, set_flow
+import manifest
+import tombstones
+from tombstones import Purger
+from tenants import TenantRefresher
+from database import Base, engine
 # === Setup ===
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # startup() and shutdown() are defined further down, next to the objects they manage
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+
 app = FastAPI(
     title="DocQuery",
     description="An AI assistant to answer questions based on uploaded pdf, with user authentication.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -57,26 +84,58 @@ app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET_KEY)
 
 # Gemini API Key configuration
 gemini_api_key = os.getenv("GEMINI_API_KEY")
-if not gemini_api_key:
+if not gemini_api_key and LLM_PROVIDER != "fake":
     logger.error("GEMINI_API_KEY not set in environment.")
     raise RuntimeError("GEMINI_API_KEY not set in environment.")
 
-configure(api_key=gemini_api_key)
-model = GenerativeModel("gemini-2.5-flash")
-logger.info("Google Generative AI model 'gemini-2.5-flash' configured.")
-
-# Load models globally to avoid reloading on each request
-# Using 'cpu' for broad compatibility. Consider 'cuda' if a GPU is available and configured.
-try:
-    embedder = SentenceTransformer("all-MiniLM-L12-v2", device='cpu') 
-    reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
-    vector_dim = embedder.get_sentence_embedding_dimension() or 384
-    logger.info(f"SentenceTransformer embedder and CrossEncoder reranker loaded. Vector dimension: {vector_dim}")
-except Exception as e:
-    logger.critical(f"Failed to load sentence-transformer models: {e}", exc_info=True)
-    raise RuntimeError(f"Failed to load sentence-transformer models: {e}")
+# Answers are generated through the LLM client (see llm.py): Gemini with per-call deadlines,
+# hedged requests, a circuit breaker and an optional fallback model.
+llm_client = build_client(gemini_api_key)
+
+# Models are loaded once per process, in the background at startup (see warm_up() below).
+# INFERENCE_BACKEND=onnx swaps in int8-quantized ONNX Runtime models (see inference.py);
+# INFERENCE_SIDECAR=true uses the models of a shared sidecar process instead (see sidecar.py).
+EMBEDDING_MODEL_NAME = "all-MiniLM-L12-v2"
+RERANKER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+embedder = reranker = None
+inference_backend = None
+vector_dim = None
+
+
+def embed_queries(texts: list[str]) -> list[list[float]]:
+    """Encodes a batch of questions from concurrent /ask requests in one forward pass."""
+    return embedder.encode(texts, batch_size=len(texts)).tolist()
+
+
+def score_pair_groups(groups: list[list[tuple[str, str]]]) -> list[list[float]]:
+    """Scores the (question, chunk) pairs of several requests in one CrossEncoder call."""
+    flat_pairs = [pair for group in groups for pair in group]
+    flat_scores = reranker.predict(flat_pairs, batch_size=max(1, len(flat_pairs))).tolist()
+    results, offset = [], 0
+    for group in groups:
+        results.append(flat_scores[offset:offset + len(group)])
+        offset += len(group)
+    return results
+
+
+# Cross-request micro-batching: concurrent /ask calls share one encode and one predict call.
+query_embed_batcher = MicroBatcher(
+    "query_embed",
+    embed_queries,
+    stage="embed",
+    max_batch_size=int(os.getenv("EMBED_BATCH_MAX_SIZE", "32")),
+    max_wait_ms=float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5")),
+)
+rerank_batcher = MicroBatcher(
+    "rerank",
+    score_pair_groups,
+    stage="rerank",
+    max_batch_size=int(os.getenv("RERANK_BATCH_MAX_PAIRS", "256")),
+    max_wait_ms=float(os.getenv("RERANK_BATCH_MAX_WAIT_MS", "10")),
+    size_fn=len,
+)
 
-collection_name = "general_docs"
+collection_name = QDRANT_COLLECTION
 
 # --- Qdrant Client configuration ---
 qdrant_url = os.getenv("QDRANT_URL")
@@ -90,6 +149,14 @@ qdrant = QdrantClient(
     api_key=qdrant_api_key,
     timeout=60 
 )
+# Request handlers use the async client so Qdrant round-trips never block the event loop;
+# the sync client above is only used for one-off initialization at startup, on a thread.
+# Every call is timed as a `qdrant.<method>` stage for /metrics and Server-Timing.
+aqdrant = TimedClient(AsyncQdrantClient(
+    url=qdrant_url,
+    api_key=qdrant_api_key,
+    timeout=60
+), "qdrant")
 
 # Print Qdrant client version for debugging
 try:
@@ -100,81 +167,266 @@ except AttributeError:
 logger.info(f"Connecting to Qdrant at: {qdrant_url}")
 
 # --- Qdrant Collection Initialization ---
-try:
-    # Attempt to get collection info to check existence and status
-    collection_info = qdrant.get_collection(collection_name=collection_name)
-    if collection_info.status == CollectionStatus.GREEN:
-        logger.info(f"Qdrant collection '{collection_name}' already exists and is healthy.")
-    else:
-        logger.warning(f"Qdrant collection '{collection_name}' exists but its status is {collection_info.status}.")
-except UnexpectedResponse as e:
-    if e.status_code == 404:
-        logger.info(f"Qdrant collection '{collection_name}' not found, attempting to recreate.")
-        try:
-            qdrant.recreate_collection(
-                collection_name=collection_name,
-                vectors_config=VectorParams(size=vector_dim, distance=Distance.COSINE),
-                timeout=60 
-            )
-            logger.info(f"Qdrant collection '{collection_name}' recreated successfully.")
-        except Exception as recreate_e:
-            logger.critical(f"Error recreating Qdrant collection: {recreate_e}", exc_info=True)
-            raise RuntimeError(f"Error recreating Qdrant collection: {recreate_e}")
-    elif e.status_code == 503:
-        # Service Unavailable - Qdrant might be temporarily down, allow app to start
-        logger.warning(f"Qdrant service is temporarily unavailable (503). The app will start, but Qdrant operations may fail until the service is restored.")
-    else:
-        logger.warning(f"Error checking Qdrant collection (UnexpectedResponse {e.status_code}): {e}. The app will start, but Qdrant operations may fail.")
-except Exception as e:
-    # For other exceptions, log but allow app to start
-    logger.warning(f"Error checking/creating Qdrant collection: {e}. The app will start, but Qdrant operations may fail.", exc_info=True)
-
-for field_name in ["source", "user_id", "filename"]:
+def check_collection() -> bool:
+    """
+    Checks the collection on the sync client (runs on a thread at startup). Returns False if it
+    does not exist and has to be created, which waits for the embedder's vector dimension.
+    """
     try:
-        qdrant.create_payload_index(
-            collection_name=collection_name,
-            field_name=field_name,
-            field_schema="keyword" 
-        )
-        logger.info(f"Payload index for '{field_name}' field created or already exists in collection '{collection_name}'.")
+        # Attempt to get collection info to check existence and status
+        collection_info = qdrant.get_collection(collection_name=collection_name)
+        if collection_info.status == CollectionStatus.GREEN:
+            logger.info(f"Qdrant collection '{collection_name}' already exists and is healthy.")
+        else:
+            logger.warning(f"Qdrant collection '{collection_name}' exists but its status is {collection_info.status}.")
+        if collection_info.config.quantization_config is None and VECTOR_QUANTIZATION != "none":
+            logger.info(f"Qdrant collection '{collection_name}' stores unquantized vectors; run `python migrate_collection.py` "
+                        f"to rebuild it with {VECTOR_QUANTIZATION} quantization.")
+        if TENANT_LAYOUT == "partitioned" and not collection_info.config.hnsw_config.payload_m:
+            logger.info(f"Qdrant collection '{collection_name}' has one global HNSW graph; run `python migrate_collection.py` "
+                        f"to rebuild it with per-tenant graphs.")
     except UnexpectedResponse as e:
-        # Check if the error is due to the index already existing (status code 409 Conflict)
-        if e.status_code == 409 or "already exists" in str(e):
-            logger.info(f"Payload index for '{field_name}' field already exists in collection '{collection_name}'.")
+        if e.status_code == 404:
+            logger.info(f"Qdrant collection '{collection_name}' not found, it will be recreated once the embedder is loaded.")
+            return False
+        elif e.status_code == 503:
+            # Service Unavailable - Qdrant might be temporarily down, allow app to start
+            logger.warning(f"Qdrant service is temporarily unavailable (503). The app will start, but Qdrant operations may fail until the service is restored.")
         else:
-            logger.warning(f"Could not create payload index for '{field_name}' field (UnexpectedResponse): {e}", exc_info=True)
+            logger.warning(f"Error checking Qdrant collection (UnexpectedResponse {e.status_code}): {e}. The app will start, but Qdrant operations may fail.")
     except Exception as e:
-        logger.warning(f"Could not create payload index for '{field_name}' field: {e}", exc_info=True)
+        # For other exceptions, log but allow app to start
+        logger.warning(f"Error checking/creating Qdrant collection: {e}. The app will start, but Qdrant operations may fail.", exc_info=True)
+    return True
 
 
-def rerank_chunks(question: str, chunks: list[str], top_k=3) -> list[str]:
-    """Reranks retrieved chunks based on relevance to the question."""
+# Scores only as many candidates with the cross-encoder as it takes to settle the top-k (see rerank.py)
+rerank_cascade = RerankCascade(rerank_batcher.submit)
+
+
+async def rerank_chunks(question: str, chunks: list[str], top_k=3, dense_scores: list = None) -> list[str]:
+    """
+    Reranks retrieved chunks based on relevance to the question. `chunks` are in retrieval
+    order; `dense_scores` holds each chunk's dense similarity (None for lexical-only hits).
+    """
     if not chunks:
         return []
 
-    # Using set to ensure uniqueness if the retrieval method can return duplicates
-    unique_chunks = list(set(chunks))
-    
-    if not unique_chunks:
-        return []
+    # Drop duplicate texts the retrieval method may return, keeping the first (best) occurrence
+    first = {}
+    for i, chunk in enumerate(chunks):
+        first.setdefault(chunk, i)
+    unique_chunks = list(first)
+    scores = [dense_scores[i] for i in first.values()] if dense_scores else [None] * len(unique_chunks)
 
-    pairs = [(question, chunk) for chunk in unique_chunks]
-    
     try:
-        scores = reranker.predict(pairs)
+        ranked = await rerank_cascade.rank(question, unique_chunks, scores, top_k)
     except Exception as e:
         logger.error(f"Error during reranker prediction: {e}", exc_info=True)
-        # Fallback: return original chunks if reranking fails
-        return unique_chunks[:top_k] if len(unique_chunks) > top_k else unique_chunks
-
-    # Sort chunks based on scores descending
-    ranked = sorted(zip(unique_chunks, scores), key=lambda x: x[1], reverse=True)
-    top_chunks = [chunk for chunk, _ in ranked[:top_k]]
+        # Fallback: keep the retrieval order if reranking fails
+        return unique_chunks[:top_k]
 
-    logger.info(f"Reranked {len(chunks)} chunks to top {len(top_chunks)}. Top scores: {[round(s, 3) for _, s in ranked[:top_k]]}")
+    top_chunks = [unique_chunks[i] for i in ranked]
+    logger.info(f"Reranked {len(chunks)} chunks to top {len(top_chunks)}.")
     return top_chunks
 
 
+# Re-uploaded or revised documents share most of their chunks; only unseen chunk text is embedded.
+# Created by warm_up() once the backend is known: int8 vectors are close to, but not the same as, the fp32 ones
+embedding_cache = None
+
+
+def encode_passages(texts: list[str]) -> list[list[float]]:
+    metrics.observe_batch("passage_embed", len(texts))
+    with timed("passage_embed"):
+        return embedder.encode(texts).tolist()
+
+
+async def embed_chunks(chunks: list[str]) -> list[list[float]]:
+    return await run_in_stage("embed", embedding_cache.embed, chunks, encode_passages)
+
+
+# --- Hybrid retrieval ---
+# A local BM25 index catches exact identifiers (clause and part numbers) that dense MiniLM
+# vectors miss. Dense and lexical hits are fused with reciprocal rank fusion, which lets the
+# cross-encoder score a smaller candidate pool without losing recall.
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "true").lower() != "false"
+DENSE_CANDIDATES = int(os.getenv("DENSE_CANDIDATES", "20"))
+LEXICAL_CANDIDATES = int(os.getenv("LEXICAL_CANDIDATES", "20"))
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "12"))
+lexical_index = LexicalIndex()
+
+
+
+def build_chunker():
+    """
+    Chunks are sized in embedder tokens so nothing is silently truncated at encode time
+    (2 positions are taken by the [CLS]/[SEP] special tokens).
+    """
+    tokenizer = getattr(embedder, "tokenizer", None)
+    chunker = make_chunker(
+        CHUNKER,
+        count_tokens=token_counter(tokenizer) if tokenizer is not None else None,
+        max_tokens=CHUNK_MAX_TOKENS or (getattr(embedder, "max_seq_length", None) or 256) - 2,
+    )
+    logger.info(f"Using the {type(chunker).__name__} for document ingestion.")
+    return chunker
+
+
+# Worker processes extract PDF pages in parallel across files and page ranges
+extractor = ProcessExtractor() if EXTRACT_PROCESSES > 0 else None
+
+# Every chunk read and write goes through the store, which routes each user to their collection.
+# The vector dimension (for dedicated tenant collections) is filled in by warm_up().
+chunk_store = ChunkStore(aqdrant, TenantRouter(collection_name), vector_dim, lexical=lexical_index)
+# Picks up users promoted to a dedicated collection while the app runs
+tenant_refresher = TenantRefresher(chunk_store.router)
+
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # 50MB limit per file
+ingestion_pipeline = IngestionPipeline(
+    embed_batch=embed_chunks,
+    store=chunk_store,
+    chunker=None,  # set by warm_up(), before the job queue starts
+    page_source=extractor.iter_pages if extractor is not None else None,
+    batch_size=int(os.getenv("INGEST_BATCH_SIZE", "50")),
+    # Re-uploading a filename only writes new/changed chunks and deletes stale ones
+    incremental=os.getenv("INCREMENTAL_REINDEX", "true").lower() != "false",
+)
+
+
+# Per-user cache of generated answers; dropped whenever that user's documents change.
+answer_cache = AnswerCache()
+
+# Deletes only tombstone a document; the purger removes its chunks in the background
+purger = Purger(chunk_store)
+
+job_queue = JobQueue(ingestion_pipeline, max_upload_bytes=MAX_UPLOAD_BYTES, on_documents_changed=answer_cache.invalidate_user,
+                     settle_deletes=purger.settle)
+
+
+# --- Startup ---
+# Uvicorn only accepts connections once startup() returns, so it returns straight away and the
+# slow part (loading both models in parallel, checking the Qdrant collection alongside) runs in
+# the background. /healthz answers from the first second; /readyz and the endpoints that need
+# the models answer 503 until warm_up() has loaded them and run a first inference.
+hot_path_ready = asyncio.Event()
+READYZ_QDRANT_TIMEOUT = float(os.getenv("READYZ_QDRANT_TIMEOUT", "2"))
+startup_state = {"error": None}
+warm_up_task = None
+
+
+async def warm_up():
+    global embedder, reranker, inference_backend, vector_dim, embedding_cache
+    started = time.perf_counter()
+    try:
+        if INFERENCE_SIDECAR:
+            models = asyncio.create_task(asyncio.to_thread(connect_models))
+        else:
+            models = asyncio.create_task(asyncio.to_thread(load_models, EMBEDDING_MODEL_NAME, RERANKER_MODEL_NAME))
+        collection_exists = await asyncio.to_thread(check_collection)
+        try:
+            embedder, reranker, inference_backend = await models
+        except Exception as e:
+            raise RuntimeError(f"Failed to load sentence-transformer models: {e}") from e
+        vector_dim = embedder.get_sentence_embedding_dimension() or 384
+        logger.info(f"SentenceTransformer embedder and CrossEncoder reranker loaded ({inference_backend}) in "
+                    f"{time.perf_counter() - started:.1f}s. Vector dimension: {vector_dim}")
+
+        if collection_exists:
+            await asyncio.to_thread(create_payload_indexes, qdrant, collection_name)
+        else:
+            try:
+                await asyncio.to_thread(create_collection, qdrant, collection_name, vector_dim)
+            except Exception as e:
+                raise RuntimeError(f"Error recreating Qdrant collection: {e}") from e
+
+        embedding_cache = EmbeddingCache(EMBEDDING_MODEL_NAME + backend_tag(inference_backend))
+        ingestion_pipeline.chunker = build_chunker()
+        if getattr(embedder, "tokenizer", None) is not None:
+            context_packer.count_tokens = token_counter(embedder.tokenizer)
+        chunk_store.vector_dim = vector_dim
+
+        # The first forward passes allocate buffers and pick kernels; pay for that before traffic arrives
+        await run_in_stage("embed", embed_queries, ["warm-up"])
+        await run_in_stage("rerank", score_pair_groups, [[("warm-up", "warm-up")]])
+        # Resumed ingestion jobs must already write to the right collection
+        await tenant_refresher.start()
+        await job_queue.start()
+        await purger.start()
+        hot_path_ready.set()
+        logger.info(f"DocQuery is ready after {time.perf_counter() - started:.1f}s.")
+    except Exception as e:
+        # /healthz now fails, so the platform restarts the machine
+        startup_state["error"] = str(e)
+        logger.critical(f"Startup failed: {e}", exc_info=True)
+
+
+async def startup():
+    global warm_up_task
+    # Creates the ingestion job tables if they don't exist yet; existing tables are left untouched
+    await run_in_stage("db", Base.metadata.create_all, bind=engine)
+    warm_up_task = asyncio.create_task(warm_up())
+
+
+async def shutdown():
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+        await asyncio.gather(warm_up_task, return_exceptions=True)
+    await job_queue.stop()
+    await purger.stop()
+    await tenant_refresher.stop()
+    await aqdrant.close()
+    shutdown_pools()
+    if extractor is not None:
+        extractor.shutdown()
+    if embedding_cache is not None:
+        embedding_cache.close()
+    lexical_index.close()
+
+
+async def require_ready():
+    """Dependency for endpoints that need the models; answers 503 while they are still loading."""
+    if not hot_path_ready.is_set():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="🚧 DocQuery is still starting up. Please try again in a few seconds.",
+            headers={"Retry-After": "5"},
+        )
+
+
+# Per-user rate limits, and 429s when the query stages are backed up (see admission.py)
+admission_control = AdmissionControl()
+
+
+def admitted(group: str):
+    """Dependency that rate-limits an endpoint group per user; question endpoints also check stage backlogs."""
+    async def dependency(current_user: User = Depends(get_current_active_user)):
+        user_id = str(current_user.id)
+        if group == "ask":
+            admission_control.admit(group, user_id, stages={name: stages[name] for name in ("embed", "rerank", "llm")})
+            set_flow(user_id, INTERACTIVE)
+        else:
+            admission_control.admit(group, user_id)
+    return dependency
+
+
+metrics.register_gauge("docquery_stage_queued", "Calls waiting for a slot in each executor stage.", "stage",
+                       lambda: {name: stage.queued for name, stage in stages.items()})
+metrics.register_gauge("docquery_stage_active", "Calls running in each executor stage.", "stage",
+                       lambda: {name: stage.active for name, stage in stages.items()})
+
+
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next):
+    """Reports the time spent in each stage of this request in a Server-Timing header (visible in browser devtools)."""
+    timings = metrics.start_request()
+    started = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - started
+    response.headers["Server-Timing"] = metrics.server_timing_header({**timings, "total": total})
+    return response
+
+
 app.include_router(auth_router, prefix="/auth", tags=["Authentication"])
 
 # Root path for testing authentication
@@ -188,13 +440,73 @@ async def root(current_user: User = Depends(get_current_active_user)):
     return {"message": f"Welcome, {current_user.email}! Authentication successful."}
 
 
+@app.get("/healthz", summary="Liveness probe", response_model=dict)
+async def healthz():
+    """
+    Answers as soon as the process serves requests, including while the models load.
+    Fails only if startup failed, so the platform restarts the machine.
+    """
+    if startup_state["error"]:
+        return JSONResponse(status_code=503, content={"status": "failed", "error": startup_state["error"]})
+    return {"status": "ok"}
+
+
+@app.get("/readyz", summary="Readiness probe", response_model=dict)
+async def readyz():
+    """
+    Answers 200 once the models are loaded and warmed up and the Qdrant collection is
+    reachable, 503 until then; route traffic to the machine only once this passes.
+    """
+    checks = {"models": hot_path_ready.is_set(), "qdrant": False}
+    try:
+        checks["qdrant"] = await asyncio.wait_for(aqdrant.collection_exists(collection_name), READYZ_QDRANT_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Readiness check could not reach Qdrant: {e}")
+    ready = all(checks.values())
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "checks": checks})
+
+
+@app.get("/executor/stats", summary="Queue depth and concurrency per execution stage", response_model=dict,
+         dependencies=[Depends(get_current_active_user)])
+async def get_executor_stats():
+    """
+    Reports pool sizes and, for each stage, how many calls are queued, running, completed and failed,
+    plus batch sizes achieved by the query micro-batchers and embedding/answer cache hit rates.
+    Requires authentication: the stats name users and what is being purged.
+    """
+    stats = executor_stats()
+    stats["inference_backend"] = inference_backend
+    stats["batchers"] = {
+        batcher.name: batcher.stats() for batcher in (query_embed_batcher, rerank_batcher)
+    }
+    stats["embedding_cache"] = embedding_cache.stats() if embedding_cache is not None else None
+    stats["answer_cache"] = answer_cache.stats()
+    stats["rerank_cascade"] = rerank_cascade.stats()
+    stats["context_packing"] = context_packer.stats()
+    stats["llm"] = llm_client.stats()
+    stats["admission"] = admission_control.stats()
+    stats["purger"] = purger.stats()
+    return stats
+
+
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Per-stage latency histograms (embedding, Qdrant calls, lexical search, reranking, PDF extraction,
+    Gemini), batch sizes, Gemini token counts, error counters and executor queue depth,
+    in the Prometheus text exposition format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 # === Upload Multiple PDFs Endpoint ===
-@app.post("/upload", summary="Upload and index multiple PDF documents", response_model=dict)
+@app.post("/upload", summary="Upload and index multiple PDF documents", response_model=dict, dependencies=[Depends(require_ready)])
 async def upload_documents(files: list[UploadFile] = File(..., description="PDF documents to upload."),
                           current_user: User = Depends(get_current_active_user)):
     """
-    Uploads multiple PDF documents, extracts their text, embeds chunks, and indexes them into Qdrant.
-    Documents are added incrementally to the user's existing collection.
+    Queues multiple PDF documents for indexing and returns a job id immediately.
+    A background worker extracts, embeds and upserts them page by page; poll /jobs/{job_id}
+    for progress. Documents are added incrementally to the user's existing collection.
     Requires authentication.
     """
     if not files:
@@ -211,172 +523,152 @@ async def upload_documents(files: list[UploadFile] = File(..., description="PDF
             logger.warning(f"Upload failed for {current_user.email}: Invalid file type '{file.filename}'")
             raise HTTPException(status_code=400, detail=f"🚫 Only PDF files are allowed. Found: {file.filename}")
 
-    all_points = []
-    successful_uploads = []
-    failed_uploads = []
+    # Uploads are charged per file against the user's rate limit
+    admission_control.admit("upload", str(current_user.id), cost=len(files))
 
-    for file in files:
-        try:
-            # Read file content
-            file_content = await file.read()
-            if len(file_content) > 50 * 1024 * 1024:  # 50MB limit per file
-                failed_uploads.append(f"{file.filename}: File too large (>50MB)")
-                continue
-                
-            doc = fitz.open(stream=file_content, filetype="pdf")
-            text = "\n".join(page.get_text() for page in doc)
-            doc.close()
-            
-            if not text.strip():
-                failed_uploads.append(f"{file.filename}: No readable text found")
-                continue
-
-            # Improved chunking with overlap for better context preservation
-            chunk_size = 800  # Increased chunk size for better context
-            overlap = 100     # Overlap between chunks
-            chunks = []
-            
-            for i in range(0, len(text), chunk_size - overlap):
-                chunk = text[i:i + chunk_size]
-                if len(chunk.strip()) > 50:  # Only include substantial chunks
-                    chunks.append(chunk.strip())
-            
-            if not chunks:
-                failed_uploads.append(f"{file.filename}: No valid chunks extracted")
-                continue
-
-            # Process chunks in batches to handle large documents
-            batch_size = 50  # Process 50 chunks at a time
-            for batch_start in range(0, len(chunks), batch_size):
-                batch_chunks = chunks[batch_start:batch_start + batch_size]
-                
-                try:
-                    vectors = embedder.encode(batch_chunks).tolist()
-                except Exception as e:
-                    logger.error(f"Error encoding chunks for {file.filename}: {e}", exc_info=True)
-                    failed_uploads.append(f"{file.filename}: Error processing chunks")
-                    break
-
-                # Create points for this batch
-                for i, (vector, chunk) in enumerate(zip(vectors, batch_chunks)):
-                    chunk_index = batch_start + i
-                    # Create unique ID using file content hash for deduplication
-                    content_hash = str(hash(chunk[:200]))  # Use first 200 chars for hash
-                    point_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{current_user.id}-{file.filename}-{chunk_index}-{content_hash}"))
-                    
-                    all_points.append(
-                        PointStruct(
-                            id=point_id, 
-                            vector=vector, 
-                            payload={
-                                "text": chunk, 
-                                "source": "document", 
-                                "filename": file.filename, 
-                                "user_id": str(current_user.id),
-                                "chunk_index": chunk_index,
-                                "total_chunks": len(chunks),
-                                "upload_timestamp": str(uuid.uuid4().time_low)  # Simple timestamp
-                            }
-                        )
-                    )
-            
-            successful_uploads.append(f"{file.filename}: {len(chunks)} chunks")
-            logger.info(f"Successfully processed {file.filename} with {len(chunks)} chunks for user {current_user.email}")
+    try:
+        job_id = await job_queue.submit(str(current_user.id), files)
+    except QueueFull as e:
+        logger.warning(f"Upload refused for {current_user.email}: {e.message}")
+        admission_control.reject("upload", e.reason, e.retry_after, e.message)
+    except Exception as e:
+        logger.error(f"Failed to queue upload for user {current_user.email}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"❌ Failed to queue documents for indexing: {e}")
 
-        except Exception as e:
-            logger.error(f"Error processing {file.filename} for user {current_user.email}: {e}", exc_info=True)
-            failed_uploads.append(f"{file.filename}: Processing error - {str(e)[:100]}")
+    return JSONResponse(status_code=202, content={
+        "detail": f"⏳ {len(files)} document{'s' if len(files) > 1 else ''} queued for indexing.",
+        "job_id": job_id
+    })
 
-    # Batch insert all points to Qdrant
-    if all_points:
-        try:
-            # Process in batches of 100 points to avoid memory issues
-            batch_size = 100
-            total_inserted = 0
-            
-            for i in range(0, len(all_points), batch_size):
-                batch_points = all_points[i:i + batch_size]
-                upsert_result = qdrant.upsert(collection_name=collection_name, points=batch_points, wait=True)
-                
-                if upsert_result.status == 'completed':
-                    total_inserted += len(batch_points)
-                    logger.info(f"Successfully indexed batch {i//batch_size + 1} with {len(batch_points)} points for user {current_user.email}")
-                else:
-                    logger.error(f"Qdrant upsert status not completed for batch {i//batch_size + 1}: {upsert_result.status}")
-            
-            response_message = f"✅ Successfully uploaded {len(successful_uploads)} documents with {total_inserted} total chunks!"
-            if failed_uploads:
-                response_message += f"\n⚠️ Failed uploads: {', '.join(failed_uploads)}"
-            
-            return JSONResponse(status_code=200, content={"detail": response_message})
 
-        except Exception as e:
-            logger.error(f"Failed to index documents for user {current_user.email}: {e}", exc_info=True)
-            raise HTTPException(status_code=500, content={"detail": f"❌ Failed to index documents: {e}"})
-    else:
-        error_message = "❌ No documents could be processed successfully."
-        if failed_uploads:
-            error_message += f" Errors: {', '.join(failed_uploads)}"
-        raise HTTPException(status_code=400, detail=error_message)
+@app.get("/jobs/{job_id}", summary="Get the progress of an ingestion job", response_model=dict)
+async def get_job(job_id: str, current_user: User = Depends(get_current_active_user)):
+    """
+    Reports the status of an upload job and, per file, the pages read, chunks produced
+    and points indexed so far.
+    """
+    report = await job_queue.report(job_id, str(current_user.id))
+    if report is None:
+        raise HTTPException(status_code=404, detail=f"🚫 Job '{job_id}' not found.")
+    return report
 
 
 # === Ask Question Endpoint ===
 class QuestionRequest(BaseModel):
     question: str
 
-@app.post("/ask", summary="Ask a question about uploaded documents", response_model=dict)
-async def ask_question(data: QuestionRequest, current_user: User = Depends(get_current_active_user)):
+
+async def lexical_search(user_id: str, question: str, exclude_filenames: list[str] = None) -> list[dict]:
     """
-    Asks a question and retrieves answers based on the authenticated user's indexed documents.
-    Searches across all uploaded PDFs for the user. Requires authentication.
+    BM25 hits, kept only if Qdrant still holds the chunk. Each machine keeps its own lexical
+    index, so a purge run elsewhere leaves rows behind here; those are dropped on sight.
     """
-    logger.info(f"User {current_user.email} asked: '{data.question[:50]}...'")
-
-    if not data.question.strip():
-        logger.warning(f"Ask question failed for {current_user.email}: Empty question provided.")
-        raise HTTPException(status_code=400, detail="🚫 Please provide a question.")
+    with timed("lexical"):
+        hits = await run_in_stage("db", lexical_index.search, user_id, question, LEXICAL_CANDIDATES)
+    if not hits:
+        return hits
+    live = await chunk_store.existing_ids(user_id, [hit["id"] for hit in hits], exclude_filenames)
+    stale = [hit["id"] for hit in hits if hit["id"] not in live and hit["filename"] not in (exclude_filenames or ())]
+    if stale:
+        logger.info(f"Dropped {len(stale)} lexical index rows whose chunks are no longer in Qdrant.")
+        await run_in_stage("db", lexical_index.delete_ids, stale)
+    return [hit for hit in hits if hit["id"] in live]
+
+
+# Merges adjacent chunks, drops their overlap and fills the prompt by MMR within a token budget.
+# Counts tokens approximately until warm_up() hands it the embedder's tokenizer.
+context_packer = ContextPacker()
+
+
+async def pack_context(q_vec: list[float], chunks: list[dict]) -> tuple[str, list[dict]]:
+    # Lexical-only hits come without a vector; their chunks are usually in the embedding cache
+    missing = [chunk for chunk in chunks if chunk.get("vector") is None]
+    if missing:
+        try:
+            for chunk, vector in zip(missing, await embed_chunks([chunk["text"] for chunk in missing])):
+                chunk["vector"] = vector
+        except Exception as e:
+            logger.warning(f"Could not embed lexical hits for context packing, keeping the rerank order: {e}")
+    with timed("pack"):
+        return context_packer.pack(q_vec, chunks)
 
-    try:
-        q_vec = embedder.encode(data.question).tolist()
-    except Exception as e:
-        logger.error(f"Error encoding question for user {current_user.email}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"❌ Error encoding question: {e}")
 
+async def retrieve_context(question: str, q_vec: list[float], current_user: User, all_deleted: bool,
+                           deleted_files: list[str]) -> dict:
+    """
+    Retrieves and reranks the user's most relevant chunks for a question, leaving out the
+    deleted files (from tombstones.document_state) that the purger has not removed yet.
+    Returns the prompt context plus source files and chunk references for the response.
+    """
     document_context = ""
     source_files = set()
-    
+    top_chunk_refs = []
+    retrieval_failed = False
+
     try:
-        # Query for relevant chunks from all user documents
-        document_results = qdrant.query_points(
-            collection_name=collection_name,
-            query=q_vec,
-            limit=20, # Retrieve more chunks for better reranking across multiple documents
-            with_payload=True,
-            query_filter=Filter(
-                must=[
-                    FieldCondition(key="source", match=MatchValue(value="document")),
-                    FieldCondition(key="user_id", match=MatchValue(value=str(current_user.id)))
-                ]
-            )
-        )
-        
-        retrieved_chunks = []
-        for point in document_results.points:
+        # Query for relevant chunks from all user documents, densely and (if enabled) lexically
+        # Retrieve more chunks for better reranking across multiple documents
+        if all_deleted:
+            document_results, lexical_hits = [], []
+        else:
+            dense_query = chunk_store.search(str(current_user.id), q_vec, limit=DENSE_CANDIDATES,
+                                             with_vectors=CONTEXT_PACKING, exclude_filenames=deleted_files)
+            if HYBRID_RETRIEVAL:
+                document_results, lexical_hits = await asyncio.gather(
+                    dense_query,
+                    lexical_search(str(current_user.id), question, exclude_filenames=deleted_files),
+                )
+            else:
+                document_results, lexical_hits = await dense_query, []
+
+        candidates = {}
+        for point in document_results:
             if point.payload and "text" in point.payload:
-                retrieved_chunks.append(point.payload["text"])
-                if "filename" in point.payload:
-                    source_files.add(point.payload["filename"])
+                candidates[str(point.id)] = {
+                    "text": point.payload["text"],
+                    "filename": point.payload.get("filename"),
+                    "chunk_index": point.payload.get("chunk_index"),
+                    "pages": point.payload.get("pages"),
+                    "dense_score": point.score,
+                    "vector": point.vector,
+                }
+        for hit in lexical_hits:
+            candidates.setdefault(hit["id"], hit)
+
+        ranked_ids = [str(point.id) for point in document_results if str(point.id) in candidates]
+        if lexical_hits:
+            ranked_ids = reciprocal_rank_fusion(ranked_ids, [hit["id"] for hit in lexical_hits])[:RERANK_CANDIDATES]
+            logger.info(f"Fused {len(document_results)} dense and {len(lexical_hits)} lexical hits into {len(ranked_ids)} rerank candidates.")
+
+        retrieved_chunks = []
+        dense_scores = []
+        by_text = {}
+        for point_id in ranked_ids:
+            candidate = candidates[point_id]
+            candidate["id"] = point_id
+            retrieved_chunks.append(candidate["text"])
+            dense_scores.append(candidate.get("dense_score"))
+            by_text.setdefault(candidate["text"], candidate)
+            if candidate["filename"]:
+                source_files.add(candidate["filename"])
         
         if retrieved_chunks:
             # Rerank to get the most relevant chunks across all documents
-            top_relevant_chunks = rerank_chunks(data.question, retrieved_chunks, top_k=5)
-            document_context = "\n\n".join([f"[Chunk {i+1}]: {chunk}" for i, chunk in enumerate(top_relevant_chunks)])
-            
-            source_info = f"Sources: {', '.join(list(source_files)[:3])}"  # Show up to 3 source files
-            if len(source_files) > 3:
-                source_info += f" and {len(source_files) - 3} more"
+            top_k = CONTEXT_CANDIDATES if CONTEXT_PACKING else 5
+            top_relevant_chunks = await rerank_chunks(question, retrieved_chunks, top_k=top_k, dense_scores=dense_scores)
+            top_chunks = [by_text[chunk] for chunk in top_relevant_chunks]
+            if CONTEXT_PACKING:
+                document_context, packed = await pack_context(q_vec, top_chunks)
+                # The response lists the packed chunks best first, whatever their order in the prompt
+                top_chunks = [chunk for chunk in top_chunks if any(chunk is p for p in packed)]
+            else:
+                document_context = "\n\n".join([f"[Chunk {i+1}]: {chunk}" for i, chunk in enumerate(top_relevant_chunks)])
+            top_chunk_refs = [
+                {"id": c["id"], "filename": c["filename"], "chunk_index": c["chunk_index"], "pages": c.get("pages")}
+                for c in top_chunks
+            ]
             
-            logger.info(f"Generated document context with {len(top_relevant_chunks)} chunks from {len(source_files)} files for user {current_user.email}.")
+            logger.info(f"Generated document context with {len(top_chunk_refs)} chunks from {len(source_files)} files for user {current_user.email}.")
         else:
             document_context = "No relevant information found in your uploaded documents."
             logger.info(f"No relevant chunks found in Qdrant for user {current_user.email}.")
@@ -384,13 +676,31 @@ async def ask_question(data: QuestionRequest, current_user: User = Depends(get_c
     except Exception as e:
         logger.error(f"Error querying document context from Qdrant for user {current_user.email}: {e}", exc_info=True)
         document_context = "An error occurred while retrieving relevant information from your documents."
+        retrieval_failed = True
 
+    return {
+        "context": document_context,
+        "sources": sorted(source_files),
+        "chunks": top_chunk_refs,
+        "failed": retrieval_failed,
+    }
+
+
+def retrieval_only_answer(retrieval: dict) -> str:
+    """What the user gets when no LLM provider is available: the passages retrieval found."""
+    if retrieval["failed"] or not retrieval["chunks"]:
+        return "⚠️ Answers are temporarily unavailable and no matching passages were found. Please try again shortly."
+    return ("⚠️ Answers are temporarily unavailable, so here are the most relevant passages from your documents:"
+            f"\n\n{retrieval['context']}")
+
+
+def build_prompt(question: str, document_context: str) -> str:
     # --- Enhanced Prompt for Gemini ---
-    prompt = f"""
+    return f"""
 You are a helpful, knowledgeable, and empathetic AI assistant designed to assist users in understanding their uploaded documents and answering questions about their content.
 
 --- User's Question ---
-{data.question}
+{question}
 --- End of Question ---
 
 --- Extracted Document Context ---
@@ -410,53 +720,160 @@ Instructions:
 Return only the final response as if you are directly speaking to the user.
 """
 
+
+@app.post("/ask", summary="Ask a question about uploaded documents", response_model=dict, dependencies=[Depends(require_ready), Depends(admitted("ask"))])
+async def ask_question(data: QuestionRequest, current_user: User = Depends(get_current_active_user)):
+    """
+    Asks a question and retrieves answers based on the authenticated user's indexed documents.
+    Searches across all uploaded PDFs for the user. Requires authentication.
+    Repeated or near-duplicate questions are answered from the user's answer cache;
+    `cached` in the response says whether that happened.
+    """
+    logger.info(f"User {current_user.email} asked: '{data.question[:50]}...'")
+
+    if not data.question.strip():
+        logger.warning(f"Ask question failed for {current_user.email}: Empty question provided.")
+        raise HTTPException(status_code=400, detail="🚫 Please provide a question.")
+
+    user_id = str(current_user.id)
+    # One round trip for the cache generation and the deleted files retrieval must leave out
+    cache_generation, all_deleted, deleted_files = await run_in_stage("db", tombstones.document_state, user_id)
+    cached_answer = answer_cache.get_exact(user_id, data.question, cache_generation)
+    if cached_answer is not None:
+        logger.info(f"Served exact cached answer for user {current_user.email}.")
+        return JSONResponse(status_code=200, content={"answer": cached_answer, "cached": True, "cache_match": "exact"})
+
     try:
-        response = model.generate_content(prompt)
+        q_vec = await query_embed_batcher.submit(data.question)
+    except Exception as e:
+        logger.error(f"Error encoding question for user {current_user.email}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"❌ Error encoding question: {e}")
+
+    cached_answer = answer_cache.get_similar(user_id, q_vec, data.question, cache_generation)
+    if cached_answer is not None:
+        return JSONResponse(status_code=200, content={"answer": cached_answer, "cached": True, "cache_match": "semantic"})
+
+    retrieval = await retrieve_context(data.question, q_vec, current_user, all_deleted, deleted_files)
+    prompt = build_prompt(data.question, retrieval["context"])
+
+    try:
+        with timed("generate"):
+            response = await llm_client.generate(prompt)
+        metrics.count_llm_usage(response)
         if response and response.text:
             logger.info(f"Successfully generated response for user {current_user.email}.")
-            return JSONResponse(status_code=200, content={"answer": response.text})
+            if not retrieval["failed"]:
+                answer_cache.put(user_id, data.question, q_vec, response.text, cache_generation)
+            return JSONResponse(status_code=200, content={"answer": response.text, "cached": False})
         else:
             logger.error(f"Gemini did not return a valid answer for user {current_user.email}.")
             raise HTTPException(status_code=500, detail="❌ Gemini did not return a valid answer. Please try again.")
+    except LLMUnavailable as e:
+        logger.error(f"No answer for user {current_user.email}, returning retrieved passages only: {e}")
+        return JSONResponse(status_code=200, content={"answer": retrieval_only_answer(retrieval), "cached": False, "degraded": True})
     except Exception as e:
         logger.error(f"Gemini error for user {current_user.email}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"❌ Gemini error: {e}")
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/ask/stream", summary="Ask a question and stream the answer as server-sent events", dependencies=[Depends(require_ready), Depends(admitted("ask"))])
+async def ask_question_stream(data: QuestionRequest, current_user: User = Depends(get_current_active_user)):
+    """
+    Streaming variant of /ask. Emits a `meta` event with the source files and chunk ids as soon as
+    retrieval finishes, then one `token` event per piece of text Gemini streams back, and finally a
+    `done` event carrying per-stage timings. Failures after the stream has started are reported as an `error` event.
+    """
+    logger.info(f"User {current_user.email} asked (stream): '{data.question[:50]}...'")
+
+    if not data.question.strip():
+        logger.warning(f"Ask question failed for {current_user.email}: Empty question provided.")
+        raise HTTPException(status_code=400, detail="🚫 Please provide a question.")
+
+    user_id = str(current_user.id)
+
+    async def events():
+        cache_generation, all_deleted, deleted_files = await run_in_stage("db", tombstones.document_state, user_id)
+        cached_answer = answer_cache.get_exact(user_id, data.question, cache_generation)
+        cache_match = "exact"
+        q_vec = None
+
+        if cached_answer is None:
+            try:
+                q_vec = await query_embed_batcher.submit(data.question)
+            except Exception as e:
+                logger.error(f"Error encoding question for user {current_user.email}: {e}", exc_info=True)
+                yield sse_event("error", {"detail": f"❌ Error encoding question: {e}"})
+                return
+            cached_answer = answer_cache.get_similar(user_id, q_vec, data.question, cache_generation)
+            cache_match = "semantic"
+
+        if cached_answer is not None:
+            yield sse_event("meta", {"sources": [], "chunks": [], "cached": True, "cache_match": cache_match})
+            yield sse_event("token", {"text": cached_answer})
+            yield sse_event("done", {"cached": True})
+            return
+
+        retrieval = await retrieve_context(data.question, q_vec, current_user, all_deleted, deleted_files)
+        yield sse_event("meta", {"sources": retrieval["sources"], "chunks": retrieval["chunks"], "cached": False})
+
+        prompt = build_prompt(data.question, retrieval["context"])
+        answer_parts = []
+        started = time.perf_counter()
+        last_chunk = None
+        try:
+            with timed("generate"):
+                async for chunk in llm_client.stream(prompt):
+                    if last_chunk is None:
+                        metrics.observe("generate.first_token", time.perf_counter() - started)
+                    last_chunk = chunk
+                    if chunk.text:
+                        answer_parts.append(chunk.text)
+                        yield sse_event("token", {"text": chunk.text})
+            metrics.count_llm_usage(last_chunk)
+        except LLMUnavailable as e:
+            logger.error(f"No answer for user {current_user.email}, returning retrieved passages only: {e}")
+            yield sse_event("token", {"text": retrieval_only_answer(retrieval)})
+            yield sse_event("done", {"cached": False, "degraded": True, "timings_ms": metrics.request_timings_ms()})
+            return
+        except Exception as e:
+            logger.error(f"Gemini streaming error for user {current_user.email}: {e}", exc_info=True)
+            yield sse_event("error", {"detail": f"❌ Gemini error: {e}"})
+            return
+
+        answer = "".join(answer_parts)
+        if not answer:
+            logger.error(f"Gemini did not return a valid answer for user {current_user.email}.")
+            yield sse_event("error", {"detail": "❌ Gemini did not return a valid answer. Please try again."})
+            return
+
+        logger.info(f"Successfully streamed response for user {current_user.email}.")
+        if not retrieval["failed"]:
+            answer_cache.put(user_id, data.question, q_vec, answer, cache_generation)
+        # Headers went out before any stage ran, so the stream's timings travel with the final event
+        yield sse_event("done", {"cached": False, "timings_ms": metrics.request_timings_ms()})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Stop proxies (Fly, nginx) from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # === Document Management Endpoints ===
 
-@app.get("/documents", summary="List user's uploaded documents", response_model=dict)
+@app.get("/documents", summary="List user's uploaded documents", response_model=dict, dependencies=[Depends(admitted("documents"))])
 async def list_documents(current_user: User = Depends(get_current_active_user)):
     """
     Lists all documents uploaded by the authenticated user with metadata.
     """
     try:
-        # Query all points for the user to get document metadata
-        all_results = qdrant.scroll(
-            collection_name=collection_name,
-            scroll_filter=Filter(
-                must=[
-                    FieldCondition(key="source", match=MatchValue(value="document")),
-                    FieldCondition(key="user_id", match=MatchValue(value=str(current_user.id)))
-                ]
-            ),
-            limit=1000,  # Adjust based on expected document count
-            with_payload=True
-        )
-        
-        documents = {}
-        for point in all_results[0]:  # all_results is a tuple (points, next_page_offset)
-            if point.payload and "filename" in point.payload:
-                filename = point.payload["filename"]
-                if filename not in documents:
-                    documents[filename] = {
-                        "filename": filename,
-                        "total_chunks": 0,
-                        "upload_timestamp": point.payload.get("upload_timestamp", "unknown")
-                    }
-                documents[filename]["total_chunks"] += 1
-        
-        document_list = list(documents.values())
+        # Read from the manifest written at ingestion time, not from the chunks in Qdrant
+        document_list = await run_in_stage("db", manifest.list_documents, str(current_user.id))
         logger.info(f"Retrieved {len(document_list)} documents for user {current_user.email}")
         
         return JSONResponse(status_code=200, content={
@@ -470,169 +887,47 @@ async def list_documents(current_user: User = Depends(get_current_active_user)):
         raise HTTPException(status_code=500, detail=f"❌ Error retrieving documents: {e}")
 
 
-@app.delete("/documents/{filename}", summary="Delete a specific document", response_model=dict)
+@app.delete("/documents/{filename}", summary="Delete a specific document", response_model=dict, dependencies=[Depends(require_ready), Depends(admitted("documents"))])
 async def delete_document(filename: str, current_user: User = Depends(get_current_active_user)):
     """
-    Deletes a specific document and all its chunks from the user's collection.
+    Deletes a specific document. It is gone from /documents and from answers immediately;
+    its chunks are removed from the user's collection in the background.
     """
     try:
-        # First, try to create the filename index if it doesn't exist
-        try:
-            qdrant.create_payload_index(
-                collection_name=collection_name,
-                field_name="filename",
-                field_schema="keyword"
-            )
-            logger.info(f"Created filename index for collection '{collection_name}'")
-        except Exception as index_e:
-            # Index might already exist, which is fine
-            logger.debug(f"Filename index creation result: {index_e}")
-
-        # Delete all points for the specific document
-        delete_result = qdrant.delete(
-            collection_name=collection_name,
-            points_selector=FilterSelector(
-                filter=Filter(
-                    must=[
-                        FieldCondition(key="source", match=MatchValue(value="document")),
-                        FieldCondition(key="user_id", match=MatchValue(value=str(current_user.id))),
-                        FieldCondition(key="filename", match=MatchValue(value=filename))
-                    ]
-                )
-            ),
-            wait=True
-        )
-        
-        if delete_result.status == 'completed':
-            # Handle different response structures from Qdrant
-            deleted_count = 0
-            if hasattr(delete_result, 'result') and hasattr(delete_result.result, 'points'):
-                deleted_count = delete_result.result.points
-            elif hasattr(delete_result, 'operation_id'):
-                # For newer Qdrant versions, we might not get exact count
-                deleted_count = "unknown"
-            else:
-                # Try to get count from other possible attributes
-                deleted_count = getattr(delete_result, 'points', "unknown")
-            
-            logger.info(f"Successfully deleted document '{filename}' with {deleted_count} chunks for user {current_user.email}")
-            return JSONResponse(status_code=200, content={
-                "detail": f"✅ Document '{filename}' deleted successfully!",
-                "deleted_chunks": deleted_count
-            })
-        else:
-            logger.warning(f"Delete status not completed for document '{filename}': {delete_result.status}")
-            raise HTTPException(status_code=500, detail=f"❌ Failed to delete document: {delete_result.status}")
-            
-    except UnexpectedResponse as e:
-        if e.status_code == 404:
+        deleted_count = await run_in_stage("db", tombstones.mark_deleted, str(current_user.id), filename)
+        if deleted_count is None:
             logger.info(f"Document '{filename}' not found for user {current_user.email}")
             raise HTTPException(status_code=404, detail=f"🚫 Document '{filename}' not found.")
-        elif "Index required but not found" in str(e):
-            logger.error(f"Index error during document deletion: {e}", exc_info=True)
-            # Try alternative approach - get all user documents and filter by filename
-            try:
-                return await delete_document_fallback(filename, current_user)
-            except Exception as fallback_e:
-                logger.error(f"Fallback deletion also failed: {fallback_e}", exc_info=True)
-                raise HTTPException(status_code=500, detail=f"❌ Error deleting document: Index not available. Please try again.")
-        else:
-            logger.error(f"Unexpected response during document deletion: {e}", exc_info=True)
-            raise HTTPException(status_code=500, detail=f"❌ Error deleting document: {e}")
-    except Exception as e:
-        logger.error(f"Error deleting document '{filename}' for user {current_user.email}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"❌ Error deleting document: {e}")
-
+        answer_cache.invalidate_user(str(current_user.id))
+        purger.wake()
+        logger.info(f"Deleted document '{filename}' with {deleted_count} chunks for user {current_user.email}; purge queued")
+        return JSONResponse(status_code=200, content={
+            "detail": f"✅ Document '{filename}' deleted successfully!",
+            "deleted_chunks": deleted_count
+        })
 
-async def delete_document_fallback(filename: str, current_user: User):
-    """
-    Fallback method to delete document when index is not available.
-    Gets all user documents and filters by filename.
-    """
-    try:
-        # Get all points for the user
-        all_results = qdrant.scroll(
-            collection_name=collection_name,
-            scroll_filter=Filter(
-                must=[
-                    FieldCondition(key="source", match=MatchValue(value="document")),
-                    FieldCondition(key="user_id", match=MatchValue(value=str(current_user.id)))
-                ]
-            ),
-            limit=1000,
-            with_payload=True
-        )
-        
-        # Filter points by filename
-        points_to_delete = []
-        for point in all_results[0]:
-            if point.payload and point.payload.get("filename") == filename:
-                points_to_delete.append(point.id)
-        
-        if not points_to_delete:
-            raise HTTPException(status_code=404, detail=f"🚫 Document '{filename}' not found.")
-        
-        # Delete the filtered points
-        delete_result = qdrant.delete(
-            collection_name=collection_name,
-            points_selector=points_to_delete,
-            wait=True
-        )
-        
-        if delete_result.status == 'completed':
-            deleted_count = len(points_to_delete)
-            logger.info(f"Successfully deleted document '{filename}' with {deleted_count} chunks using fallback method for user {current_user.email}")
-            return JSONResponse(status_code=200, content={
-                "detail": f"✅ Document '{filename}' deleted successfully!",
-                "deleted_chunks": deleted_count
-            })
-        else:
-            raise HTTPException(status_code=500, detail=f"❌ Failed to delete document: {delete_result.status}")
-            
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Fallback deletion failed for document '{filename}': {e}", exc_info=True)
+        logger.error(f"Error deleting document '{filename}' for user {current_user.email}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"❌ Error deleting document: {e}")
 
 
-@app.delete("/documents", summary="Delete all user documents", response_model=dict)
+@app.delete("/documents", summary="Delete all user documents", response_model=dict, dependencies=[Depends(require_ready), Depends(admitted("documents"))])
 async def delete_all_documents(current_user: User = Depends(get_current_active_user)):
     """
-    Deletes all documents and chunks for the authenticated user.
+    Deletes all documents for the authenticated user. Like a single delete, it takes effect
+    immediately and the chunks are purged in the background.
     """
     try:
-        delete_result = qdrant.delete(
-            collection_name=collection_name,
-            points_selector=FilterSelector(
-                filter=Filter(
-                    must=[
-                        FieldCondition(key="source", match=MatchValue(value="document")),
-                        FieldCondition(key="user_id", match=MatchValue(value=str(current_user.id)))
-                    ]
-                )
-            ),
-            wait=True
-        )
-        
-        if delete_result.status == 'completed':
-            # Handle different response structures from Qdrant
-            deleted_count = 0
-            if hasattr(delete_result, 'result') and hasattr(delete_result.result, 'points'):
-                deleted_count = delete_result.result.points
-            elif hasattr(delete_result, 'operation_id'):
-                # For newer Qdrant versions, we might not get exact count
-                deleted_count = "unknown"
-            else:
-                # Try to get count from other possible attributes
-                deleted_count = getattr(delete_result, 'points', "unknown")
-            
-            logger.info(f"Successfully deleted all documents with {deleted_count} chunks for user {current_user.email}")
-            return JSONResponse(status_code=200, content={
-                "detail": "✅ All documents deleted successfully!",
-                "deleted_chunks": deleted_count
-            })
-        else:
-            logger.warning(f"Delete all status not completed for user {current_user.email}: {delete_result.status}")
-            raise HTTPException(status_code=500, detail=f"❌ Failed to delete documents: {delete_result.status}")
+        deleted_count = await run_in_stage("db", tombstones.mark_deleted, str(current_user.id))
+        answer_cache.invalidate_user(str(current_user.id))
+        purger.wake()
+        logger.info(f"Deleted all documents with {deleted_count} chunks for user {current_user.email}; purge queued")
+        return JSONResponse(status_code=200, content={
+            "detail": "✅ All documents deleted successfully!",
+            "deleted_chunks": deleted_count
+        })
             
     except Exception as e:
         logger.error(f"Error deleting all documents for user {current_user.email}: {e}", exc_info=True)
@@ -0,0 +1,141 @@
+import logging
+from datetime import datetime
+
+from database import SessionLocal
+from models import Document, DocumentGeneration
+from vector_store import QDRANT_COLLECTION, SCROLL_PAGE_SIZE, TENANT_COLLECTION_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+# --- Database helpers (blocking; run on the "db" executor stage) ---
+
+def record_document(db, user_id: str, filename: str, file_hash: str, pages: int, chunks: int):
+    """
+    Inserts or refreshes a file's manifest row in the caller's session; the caller commits,
+    so the row lands in the same transaction as the ingestion bookkeeping.
+    """
+    now = datetime.utcnow()
+    document = db.query(Document).filter(Document.user_id == user_id, Document.filename == filename).first()
+    if document is None:
+        document = Document(user_id=user_id, filename=filename, uploaded_at=now)
+        db.add(document)
+    document.file_hash = file_hash
+    document.pages = pages
+    document.chunks = chunks
+    document.updated_at = now
+    bump_generation(db, user_id)
+
+
+def bump_generation(db, user_id: str):
+    """
+    Moves the user's document generation on, in the caller's session. Only inserts race-free
+    rows, so concurrent bumps from several workers never conflict.
+    """
+    change = DocumentGeneration(user_id=user_id)
+    db.add(change)
+    db.flush()
+    db.query(DocumentGeneration).filter(
+        DocumentGeneration.user_id == user_id, DocumentGeneration.id < change.id
+    ).delete(synchronize_session=False)
+
+
+def touch_documents(user_id: str):
+    """Bumps the generation on its own, for changes that leave the manifest rows alone."""
+    db = SessionLocal()
+    try:
+        bump_generation(db, user_id)
+        db.commit()
+    finally:
+        db.close()
+
+
+def has_document(user_id: str, filename: str) -> bool:
+    db = SessionLocal()
+    try:
+        return db.query(Document.id).filter(Document.user_id == user_id, Document.filename == filename).first() is not None
+    finally:
+        db.close()
+
+
+def list_documents(user_id: str) -> list[dict]:
+    db = SessionLocal()
+    try:
+        documents = db.query(Document).filter(Document.user_id == user_id).order_by(Document.uploaded_at).all()
+        return [
+            {
+                "filename": d.filename,
+                "total_chunks": d.chunks or 0,
+                "pages": d.pages or 0,
+                "file_hash": d.file_hash,
+                # Stored as naive UTC; the "Z" lets clients parse them as such
+                "upload_timestamp": f"{d.uploaded_at.isoformat()}Z" if d.uploaded_at else None,
+                "updated_at": f"{d.updated_at.isoformat()}Z" if d.updated_at else None,
+            }
+            for d in documents
+        ]
+    finally:
+        db.close()
+
+
+# --- Backfill ---
+
+def backfill(client, collection_names: list[str]) -> int:
+    """
+    Creates manifest rows for files indexed before the manifest existed, counting their chunks
+    and pages from the Qdrant payloads. Files that already have a row are left alone.
+    Returns the number of rows created.
+    """
+    files = {}  # (user_id, filename) -> [chunks, highest page]
+    for collection_name in collection_names:
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+                with_payload=["user_id", "filename", "source", "pages"],
+                with_vectors=False,
+            )
+            for point in points:
+                payload = point.payload or {}
+                if payload.get("source") != "document" or not payload.get("user_id") or not payload.get("filename"):
+                    continue
+                entry = files.setdefault((payload["user_id"], payload["filename"]), [0, 0])
+                entry[0] += 1
+                entry[1] = max([entry[1], *(payload.get("pages") or [])])
+            if offset is None:
+                break
+
+    db = SessionLocal()
+    try:
+        known = {(d.user_id, d.filename) for d in db.query(Document.user_id, Document.filename)}
+        created = 0
+        for (user_id, filename), (chunks, pages) in files.items():
+            if (user_id, filename) not in known:
+                record_document(db, user_id, filename, None, pages, chunks)
+                created += 1
+        db.commit()
+        return created
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    # Fills the manifest from an existing collection (and its dedicated tenant collections):
+    #   python manifest.py [collection]
+    import os
+    import sys
+
+    from dotenv import load_dotenv
+    from qdrant_client import QdrantClient
+
+    from database import Base, engine
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    name = sys.argv[1] if len(sys.argv) > 1 else QDRANT_COLLECTION
+    client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"), timeout=120)
+    Base.metadata.create_all(bind=engine)
+    names = [name] + [c.name for c in client.get_collections().collections if c.name.startswith(f"{TENANT_COLLECTION_PREFIX}_tenant_")]
+    logger.info(f"Backfilled {backfill(client, names)} manifest rows from {', '.join(names)}.")
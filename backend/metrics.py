@@ -0,0 +1,205 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Seconds; wide enough to cover a 1ms Qdrant lookup and a slow Gemini answer
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus text format. Thread-safe."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, {'le': _format_value(bound)})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, {'le': '+Inf'})} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+stage_seconds = Histogram("docquery_stage_duration_seconds", "Time spent per call in each pipeline stage.", ("stage",))
+stage_errors = Counter("docquery_stage_errors_total", "Calls that raised, per pipeline stage.", ("stage",))
+batch_sizes = Histogram("docquery_batch_size", "Items per batched model call.", ("stage",), BATCH_BUCKETS)
+llm_tokens = Counter("docquery_llm_tokens_total", "Gemini tokens reported in usage metadata.", ("kind",))
+rerank_decisions = Counter("docquery_rerank_decisions_total", "Rerank cascade outcome per query.", ("decision",))
+admission_rejections = Counter("docquery_admission_rejections_total", "Requests refused with 429, per endpoint group and reason.", ("group", "reason"))
+llm_events = Counter("docquery_llm_events_total", "LLM client hedges, retries, failures, failovers and breaker trips.", ("provider", "event"))
+embedding_cache_lookups = Counter("docquery_embedding_cache_lookups_total",
+                                  "Chunk embedding cache lookups per tier (in-memory LRU, then SQLite) and result.",
+                                  ("tier", "result"))
+
+_metrics = [stage_seconds, stage_errors, batch_sizes, llm_tokens, rerank_decisions, llm_events, admission_rejections,
+            embedding_cache_lookups]
+_gauges = []  # (name, documentation, labelname, fn() -> {label_value: value})
+
+
+def register_gauge(name: str, documentation: str, labelname: str, fn):
+    """Adds a gauge whose values are read from `fn` at scrape time, e.g. executor queue depth."""
+    _gauges.append((name, documentation, labelname, fn))
+
+
+# --- Per-request timings for the Server-Timing header ---
+# The middleware puts a fresh dict here for every request; stage timers running in that
+# request's context add to it. Work on executor threads or background jobs sees None.
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def start_request() -> dict:
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def add_request_timing(stage: str, seconds: float):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def request_timings_ms() -> dict:
+    """Stage timings of the current request so far, in milliseconds."""
+    return {stage: round(seconds * 1000, 1) for stage, seconds in (_request_timings.get() or {}).items()}
+
+
+def server_timing_header(timings: dict) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def observe(stage: str, seconds: float, error: bool = False):
+    stage_seconds.observe(seconds, stage)
+    if error:
+        stage_errors.inc(stage)
+
+
+def observe_batch(stage: str, size: int):
+    batch_sizes.observe(size, stage)
+
+
+def count_llm_usage(response):
+    """Counts prompt/completion tokens from a Gemini response (or the last chunk of a stream)."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, field in (("prompt", "prompt_token_count"), ("completion", "candidates_token_count")):
+        count = getattr(usage, field, None)
+        if count:
+            llm_tokens.inc(kind, amount=count)
+
+
+@contextmanager
+def timed(stage: str):
+    """Times the block into the stage histogram (and the current request's Server-Timing), counting errors."""
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe(stage, elapsed, error)
+        add_request_timing(stage, elapsed)
+
+
+class TimedClient:
+    """
+    Wraps a client so every coroutine method call is timed as stage `<prefix>.<method>`,
+    e.g. `qdrant.query_points`. Other attributes pass through untouched.
+    """
+
+    def __init__(self, client, prefix: str):
+        self._client = client
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        stage = f"{self._prefix}.{name}"
+
+        async def call(*args, **kwargs):
+            with timed(stage):
+                result = attr(*args, **kwargs)
+                if hasattr(result, "__await__"):
+                    result = await result
+                return result
+
+        return call
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, documentation, labelname, fn in _gauges:
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} gauge")
+        try:
+            values = fn()
+        except Exception as e:
+            logger.warning(f"Could not collect gauge {name}: {e}")
+            continue
+        for label, value in sorted(values.items()):
+            lines.append(f"{name}{_format_labels((labelname,), (label,))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,282 @@
+"""
+Rebuilds the document collection into the layout configured in vector_store.py (quantization,
+on-disk vectors, payload indexes) without taking search offline.
+
+    python migrate_collection.py [--collection general_docs_live] [--keep-old]
+
+The app addresses the collection by QDRANT_COLLECTION, and Qdrant resolves aliases wherever
+a collection name is accepted. The migration copies every point into a new versioned
+collection (e.g. general_docs_v1712345678) and then points the alias at it:
+1. Create the new collection with the configured layout and copy all points in batches,
+   with their vectors and payloads. Reads and writes keep going to the old collection.
+2. Reconcile: copy points written to the old collection during the copy and drop those
+   deleted from it. Point ids are content-derived, so comparing id sets is enough.
+3. Switch: the alias is swapped atomically.
+4. Catch up with writes that landed in the old collection between step 2 and the swap,
+   then delete it unless --keep-old is given. The new collection is live by then, so only
+   points new in the old collection are copied; its own points are never deleted as extra.
+   Points deleted from the old collection in that window are deleted from the new one too,
+   unless their document is listed in the manifest again.
+
+The name the app uses has to be an alias already. A deployment still addressing a plain
+collection first gets an alias on it, and switches to it without any copy:
+
+    python migrate_collection.py --collection general_docs --create-alias general_docs_live
+
+then sets QDRANT_COLLECTION=general_docs_live, rolls out, and migrates the alias from then on.
+The live collection is never deleted in place.
+
+A large tenant can be moved out of the shared collection into one of its own:
+
+    python migrate_collection.py --promote USER_ID
+
+copies the user's points into `<TENANT_COLLECTION_PREFIX>_tenant_<user>` and reconciles them
+as above, then records the user in the dedicated_tenants table. Running workers pick that up
+within TENANT_REFRESH_SECONDS, no restart needed; the script waits that long (plus a grace
+period for requests in flight), catches up with writes that still reached the shared
+collection, and finally deletes from it exactly the points it moved. The user's documents
+stay searchable throughout, and uploads may continue.
+"""
+import argparse
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    CreateAlias, CreateAliasOperation, DeleteAlias, DeleteAliasOperation, PointIdsList, PointStruct
+)
+
+from database import SessionLocal
+from models import Document
+from tenants import TENANT_REFRESH_SECONDS, add_dedicated_tenant, dedicated_tenants
+from vector_store import (
+    PAYLOAD_INDEX_FIELDS, QDRANT_COLLECTION, TENANT_LAYOUT, VECTOR_QUANTIZATION, VECTORS_ON_DISK, TenantRouter,
+    collection_settings, create_collection, document_filter, payload_schema,
+)
+
+logger = logging.getLogger(__name__)
+
+COPY_BATCH_SIZE = 256
+SWITCH_GRACE_SECONDS = 10  # lets writes routed just before a tenant switch land
+
+
+def resolve_alias(client: QdrantClient, name: str) -> str | None:
+    """Returns the collection the alias points at, or None if `name` is not an alias."""
+    for alias in client.get_aliases().aliases:
+        if alias.alias_name == name:
+            return alias.collection_name
+    return None
+
+
+def iter_points(client: QdrantClient, collection_name: str, with_vectors: bool = True, scroll_filter=None):
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=scroll_filter,
+            limit=COPY_BATCH_SIZE,
+            offset=offset,
+            with_payload=with_vectors,
+            with_vectors=with_vectors,
+        )
+        yield points
+        if offset is None:
+            return
+
+
+def point_ids(client: QdrantClient, collection_name: str, scroll_filter=None) -> set:
+    return {
+        point.id
+        for batch in iter_points(client, collection_name, with_vectors=False, scroll_filter=scroll_filter)
+        for point in batch
+    }
+
+
+def copy_points(client: QdrantClient, source: str, target: str, ids: set = None) -> int:
+    """Copies all points (or only `ids`) from source to target; returns how many were copied."""
+    copied = 0
+    if ids is not None:
+        ids = list(ids)
+        for i in range(0, len(ids), COPY_BATCH_SIZE):
+            points = client.retrieve(source, ids=ids[i:i + COPY_BATCH_SIZE], with_payload=True, with_vectors=True)
+            copied += _upsert(client, target, points)
+        return copied
+    for points in iter_points(client, source):
+        copied += _upsert(client, target, points)
+        logger.info(f"Copied {copied} points from '{source}' to '{target}'")
+    return copied
+
+
+def _upsert(client: QdrantClient, target: str, points) -> int:
+    if not points:
+        return 0
+    client.upsert(
+        collection_name=target,
+        points=[PointStruct(id=p.id, vector=p.vector, payload=p.payload) for p in points],
+        wait=True,
+    )
+    return len(points)
+
+
+def delete_ids(client: QdrantClient, collection_name: str, ids: list):
+    for i in range(0, len(ids), COPY_BATCH_SIZE):
+        client.delete(collection_name, points_selector=PointIdsList(points=ids[i:i + COPY_BATCH_SIZE]), wait=True)
+
+
+def reconcile(client: QdrantClient, source: str, target: str, scroll_filter=None) -> set:
+    """
+    Makes target hold exactly the point ids of source (those matching `scroll_filter`), copying
+    missing points and deleting extra ones; returns the source ids. Only safe while nothing
+    reads or writes target.
+    """
+    source_ids, target_ids = point_ids(client, source, scroll_filter), point_ids(client, target)
+    missing, extra = source_ids - target_ids, target_ids - source_ids
+    if missing:
+        copy_points(client, source, target, missing)
+    if extra:
+        delete_ids(client, target, list(extra))
+    logger.info(f"Reconciled '{target}' with '{source}': {len(missing)} copied, {len(extra)} deleted")
+    return source_ids
+
+
+def listed_documents(documents: set) -> set:
+    """The (user_id, filename) pairs among `documents` that have a manifest row."""
+    db = SessionLocal()
+    try:
+        rows = db.query(Document.user_id, Document.filename).filter(
+            Document.user_id.in_({user_id for user_id, _ in documents})
+        ).all()
+        return {(row.user_id, row.filename) for row in rows} & documents
+    finally:
+        db.close()
+
+
+def catch_up(client: QdrantClient, source: str, target: str, seen: set, scroll_filter=None) -> set:
+    """
+    Applies to target, which the app already uses, the writes source received since the
+    reconcile that returned `seen`. New points are copied unless target has them. Target
+    points are never deleted for being extra: they may have been written through the new
+    route. Points deleted from source meanwhile are deleted from target unless their
+    document is listed in the manifest, i.e. it was uploaded again after the switch.
+    Returns the source ids.
+    """
+    source_ids = point_ids(client, source, scroll_filter)
+    new = source_ids - seen - point_ids(client, target, scroll_filter)
+    if new:
+        copy_points(client, source, target, new)
+
+    gone, stale = list(seen - source_ids), []
+    if gone:
+        points = [
+            point
+            for i in range(0, len(gone), COPY_BATCH_SIZE)
+            for point in client.retrieve(target, ids=gone[i:i + COPY_BATCH_SIZE], with_payload=["user_id", "filename"])
+        ]
+        documents = {(p.payload.get("user_id"), p.payload.get("filename")) for p in points if p.payload}
+        listed = listed_documents(documents) if documents else set()
+        stale = [p.id for p in points if (p.payload or {}).get("user_id") is None
+                 or (p.payload["user_id"], p.payload.get("filename")) not in listed]
+        delete_ids(client, target, stale)
+    logger.info(f"Caught '{target}' up with '{source}': {len(new)} copied, {len(stale)} deleted, "
+                f"{len(gone) - len(stale)} re-uploaded points kept")
+    return source_ids
+
+
+def create_alias(client: QdrantClient, collection_name: str, alias: str):
+    """Points a new alias at an existing collection, so the app can switch to addressing it by the alias."""
+    if resolve_alias(client, alias) is not None or client.collection_exists(alias):
+        raise SystemExit(f"'{alias}' already exists; pick another alias name.")
+    client.update_collection_aliases(change_aliases_operations=[
+        CreateAliasOperation(create_alias=CreateAlias(collection_name=collection_name, alias_name=alias)),
+    ])
+    logger.info(f"Alias '{alias}' now points at '{collection_name}'; set QDRANT_COLLECTION={alias} and roll out "
+                f"before migrating it.")
+
+
+def migrate(client: QdrantClient, name: str, keep_old: bool = False) -> str:
+    source = resolve_alias(client, name)
+    if source is None:
+        # An alias cannot share its name with a collection, so switching a plain collection in
+        # place would mean deleting it while the app still writes to it
+        raise SystemExit(f"'{name}' is a collection, not an alias. Run `python migrate_collection.py --collection {name} "
+                         f"--create-alias {name}_live`, set QDRANT_COLLECTION={name}_live, roll out, then migrate "
+                         f"'{name}_live'.")
+    source_info = client.get_collection(source)
+    vector_dim = source_info.config.params.vectors.size
+    target = f"{name}_v{int(time.time())}"
+
+    logger.info(f"Migrating '{source}' ({source_info.points_count} points) into '{target}' "
+                f"(quantization: {VECTOR_QUANTIZATION}, vectors on disk: {VECTORS_ON_DISK}, tenant layout: {TENANT_LAYOUT})")
+    create_collection(client, target, vector_dim)
+    copy_points(client, source, target)
+    seen = reconcile(client, source, target)
+
+    client.update_collection_aliases(change_aliases_operations=[
+        DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=name)),
+        CreateAliasOperation(create_alias=CreateAlias(collection_name=target, alias_name=name)),
+    ])
+    logger.info(f"Alias '{name}' now points at '{target}'")
+    # Writes that reached the old collection between the last reconcile and the swap
+    catch_up(client, source, target, seen)
+    if not keep_old:
+        client.delete_collection(source)
+        logger.info(f"Deleted old collection '{source}'")
+    return target
+
+
+def promote_tenant(client: QdrantClient, name: str, user_id: str,
+                   switch_wait: float = TENANT_REFRESH_SECONDS + SWITCH_GRACE_SECONDS) -> str:
+    """Moves one user's points from the shared collection into their dedicated collection."""
+    router = TenantRouter(name)
+    if router.is_dedicated(user_id):
+        raise SystemExit(f"User {user_id} is in DEDICATED_TENANTS already; the app does not read their points from '{name}'.")
+    target = router.dedicated_collection(user_id)
+    if not client.collection_exists(target):
+        vector_dim = client.get_collection(name).config.params.vectors.size
+        client.create_collection(collection_name=target, timeout=60, **collection_settings(vector_dim, dedicated=True))
+        for field_name in PAYLOAD_INDEX_FIELDS:
+            client.create_payload_index(target, field_name=field_name, field_schema=payload_schema(field_name, dedicated=True))
+    tenant_filter = document_filter(user_id)
+    if user_id in dedicated_tenants():
+        # Promoted before: target is live, so only move what is left behind in the shared collection
+        moved = catch_up(client, name, target, set(), tenant_filter)
+    else:
+        for points in iter_points(client, name, scroll_filter=tenant_filter):
+            _upsert(client, target, points)
+        seen = reconcile(client, name, target, tenant_filter)
+
+        add_dedicated_tenant(user_id)
+        logger.info(f"Routing user {user_id} to '{target}'; waiting {switch_wait:.0f}s for every worker to switch")
+        time.sleep(switch_wait)
+        moved = catch_up(client, name, target, seen, tenant_filter)
+
+    # Only the points accounted for above; anything else is left in place rather than lost
+    delete_ids(client, name, list(moved))
+    left = point_ids(client, name, tenant_filter)
+    if left:
+        logger.warning(f"{len(left)} points of user {user_id} reached '{name}' after the catch-up and were left there; "
+                       f"run --promote {user_id} again to move them.")
+    logger.info(f"Moved {len(moved)} points of user {user_id} from '{name}' to '{target}'.")
+    return target
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Rebuild the Qdrant collection into the configured layout.")
+    parser.add_argument("--collection", default=QDRANT_COLLECTION, help="alias the app uses (QDRANT_COLLECTION)")
+    parser.add_argument("--keep-old", action="store_true", help="keep the previous collection after switching")
+    parser.add_argument("--create-alias", metavar="ALIAS", help="point a new alias at --collection instead of migrating")
+    parser.add_argument("--promote", metavar="USER_ID", help="move this user's points into a dedicated collection instead")
+    parser.add_argument("--switch-wait", type=float, default=TENANT_REFRESH_SECONDS + SWITCH_GRACE_SECONDS,
+                        help="seconds to wait for workers to route a promoted user to their collection")
+    args = parser.parse_args()
+    client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"), timeout=120)
+    if args.create_alias:
+        create_alias(client, args.collection, args.create_alias)
+    elif args.promote:
+        promote_tenant(client, args.collection, args.promote, switch_wait=args.switch_wait)
+    else:
+        migrate(client, args.collection, keep_old=args.keep_old)
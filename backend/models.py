@@ -1,4 +1,6 @@
-from sqlalchemy import Column, String
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import relationship
 from database import Base 
 
 class User(Base):
@@ -9,4 +11,81 @@ class User(Base):
     picture = Column(String)
 
     def __repr__(self):
-        return f"<User(id='{self.id}', email='{self.email}')>"
\ No newline at end of file
+        return f"<User(id='{self.id}', email='{self.email}')>"
+
+
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+    id = Column(String, primary_key=True)  # uuid4
+    user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
+    status = Column(String, index=True, nullable=False, default="queued")  # queued | running | completed | failed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow)  # Bumped while running; a stale heartbeat means the worker died
+    files = relationship("IngestionJobFile", back_populates="job", order_by="IngestionJobFile.id", cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return f"<IngestionJob(id='{self.id}', status='{self.status}')>"
+
+
+class IngestionJobFile(Base):
+    __tablename__ = "ingestion_job_files"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, ForeignKey("ingestion_jobs.id"), index=True, nullable=False)
+    filename = Column(String, nullable=False)
+    spool_path = Column(String)  # Upload spooled to disk; removed once the file is done
+    status = Column(String, nullable=False, default="queued")  # queued | running | done | failed
+    pages = Column(Integer, default=0)
+    chunks = Column(Integer, default=0)
+    points = Column(Integer, default=0)  # Chunks confirmed in Qdrant
+    error = Column(String)
+    job = relationship("IngestionJob", back_populates="files")
+
+    def __repr__(self):
+        return f"<IngestionJobFile(filename='{self.filename}', status='{self.status}')>"
+
+
+class Document(Base):
+    """One row per indexed file: the manifest /documents lists without touching Qdrant."""
+    __tablename__ = "documents"
+    __table_args__ = (UniqueConstraint("user_id", "filename", name="uq_documents_user_filename"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
+    filename = Column(String, nullable=False)
+    file_hash = Column(String)  # sha256 of the uploaded PDF
+    pages = Column(Integer, default=0)
+    chunks = Column(Integer, default=0)  # Chunks indexed in Qdrant
+    uploaded_at = Column(DateTime, default=datetime.utcnow)  # First upload of this filename
+    updated_at = Column(DateTime, default=datetime.utcnow)  # Last successful (re-)index
+
+    def __repr__(self):
+        return f"<Document(filename='{self.filename}', chunks={self.chunks})>"
+
+
+class Tombstone(Base):
+    """A pending delete: hidden from /ask at once, purged from Qdrant in the background, then removed."""
+    __tablename__ = "tombstones"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
+    filename = Column(String)  # None: all of the user's documents
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Tombstone(user_id='{self.user_id}', filename='{self.filename}')>"
+
+
+class DocumentGeneration(Base):
+    """
+    Bumped (a new row, older ones pruned) with every change to a user's documents; the user's
+    generation is their highest id. Cached answers remember the generation they were built on.
+    """
+    __tablename__ = "document_generations"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DedicatedTenant(Base):
+    """Users whose chunks live in a collection of their own, in addition to DEDICATED_TENANTS."""
+    __tablename__ = "dedicated_tenants"
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,135 @@
+import logging
+import os
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Rerank cascade ---
+# The cross-encoder is the most expensive step of a query after the LLM call. The cascade
+# spends it only where it changes the answer:
+# 1. Skip: if the dense scores already separate the top-k from the rest by RERANK_SKIP_MARGIN
+#    (and the fused ranking agrees on that top-k), the dense order is kept as is. Not taken when
+#    there are lexical-only hits: the dense scores say nothing about them, so they are scored.
+# 2. Truncate: dense candidates scoring more than RERANK_TRUNCATE_GAP below the best dense hit
+#    are dropped; lexical-only hits are always kept, they exist to catch exact identifiers.
+# 3. Budget: the pool is cut to what RERANK_BUDGET_MS allows at the measured cost per pair.
+# 4. Early exit: candidates are scored RERANK_CHUNK_SIZE at a time in retrieval order, and
+#    scoring stops once a chunk leaves the top-k unchanged. Each chunk is sent to the model
+#    at once rather than waiting out the micro-batch window, and the cost per pair is the
+#    model time of its batch, so queueing behind other requests does not shrink the budget.
+RERANK_CASCADE = os.getenv("RERANK_CASCADE", "true").lower() != "false"
+RERANK_SKIP_MARGIN = float(os.getenv("RERANK_SKIP_MARGIN", "0.15"))
+RERANK_TRUNCATE_GAP = float(os.getenv("RERANK_TRUNCATE_GAP", "0.3"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "250"))  # 0 = no budget
+RERANK_CHUNK_SIZE = int(os.getenv("RERANK_CHUNK_SIZE", "4"))
+
+
+class RerankCascade:
+    """
+    Ranks retrieval candidates with the cross-encoder, scoring as few of them as it can.
+
+    `score_pairs` is an async callable taking [(question, text)] and returning one score per
+    pair; the rerank micro-batcher's `submit`, whose `flush` and `timed` options the cascade
+    uses to skip the batching window and to measure model time per pair. Candidates come in retrieval order, each with its dense
+    similarity or None for lexical-only hits. Every decision is logged and counted in
+    docquery_rerank_decisions_total so the thresholds can be tuned against answer quality.
+    """
+
+    def __init__(self, score_pairs, enabled: bool = RERANK_CASCADE, skip_margin: float = RERANK_SKIP_MARGIN,
+                 truncate_gap: float = RERANK_TRUNCATE_GAP, budget_ms: float = RERANK_BUDGET_MS,
+                 chunk_size: int = RERANK_CHUNK_SIZE):
+        self.score_pairs = score_pairs
+        self.enabled = enabled
+        self.skip_margin = skip_margin
+        self.truncate_gap = truncate_gap
+        self.budget_ms = budget_ms
+        self.chunk_size = max(1, chunk_size)
+        self.ms_per_pair = None  # moving average of the measured cost of one pair
+        self.decisions = {}
+        self.pairs_scored = 0
+        self.pairs_skipped = 0
+
+    def _record(self, decision: str, scored: int, total: int):
+        self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        self.pairs_scored += scored
+        self.pairs_skipped += total - scored
+        metrics.rerank_decisions.inc(decision)
+
+    def stats(self) -> dict:
+        return {
+            "decisions": dict(self.decisions),
+            "pairs_scored": self.pairs_scored,
+            "pairs_skipped": self.pairs_skipped,
+            "ms_per_pair": round(self.ms_per_pair, 3) if self.ms_per_pair is not None else None,
+        }
+
+    async def _score(self, question: str, texts: list[str], flush: bool = False) -> list[float]:
+        scores, seconds_per_pair = await self.score_pairs([(question, text) for text in texts], flush=flush, timed=True)
+        ms_per_pair = seconds_per_pair * 1000
+        self.ms_per_pair = ms_per_pair if self.ms_per_pair is None else 0.8 * self.ms_per_pair + 0.2 * ms_per_pair
+        return [float(score) for score in scores]
+
+    async def rank(self, question: str, texts: list[str], dense_scores: list, top_k: int, budget_ms: float = None) -> list[int]:
+        """Returns the indexes into `texts` of the top-k candidates, best first."""
+        total = len(texts)
+        if total == 0:
+            return []
+        if not self.enabled:
+            scores = await self._score(question, texts)
+            self._record("full", total, total)
+            return sorted(range(total), key=lambda i: scores[i], reverse=True)[:top_k]
+
+        started = time.perf_counter()
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        dense = sorted((i for i in range(total) if dense_scores[i] is not None), key=lambda i: dense_scores[i], reverse=True)
+
+        # 1. Skip when every candidate is dense, the dense top-k is clearly ahead and the fused order agrees
+        if len(dense) == total and total > top_k:
+            margin = dense_scores[dense[top_k - 1]] - dense_scores[dense[top_k]]
+            if margin >= self.skip_margin and set(dense[:top_k]) == set(range(top_k)):
+                self._record("skipped", 0, total)
+                logger.info(f"Rerank cascade: skipped the cross-encoder, dense margin at top-{top_k} is {margin:.3f} "
+                            f"(>= {self.skip_margin}); kept the dense order of {total} candidates.")
+                return dense[:top_k]
+
+        # 2. Truncate dense candidates far below the best dense hit
+        pool = list(range(total))
+        if dense:
+            floor = dense_scores[dense[0]] - self.truncate_gap
+            kept = [i for i in pool if dense_scores[i] is None or dense_scores[i] >= floor]
+            pool = kept if len(kept) >= top_k else pool[:top_k]
+
+        # 3. Fit the pool to the latency budget at the measured cost per pair
+        budget_pool = len(pool)
+        if budget_ms and self.ms_per_pair:
+            budget_pool = max(top_k, int(budget_ms / self.ms_per_pair))
+        decision = "budget" if budget_pool < len(pool) else "full"
+        pool = pool[:budget_pool]
+
+        # 4. Score in chunks until a chunk leaves the top-k unchanged or the budget is spent
+        scores = {}
+        top = None
+        position = 0
+        while position < len(pool):
+            size = max(top_k, self.chunk_size) if position == 0 else self.chunk_size
+            chunk = pool[position:position + size]
+            position += len(chunk)
+            for i, score in zip(chunk, await self._score(question, [texts[i] for i in chunk], flush=True)):
+                scores[i] = score
+            ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+            if position < len(pool):
+                if top is not None and set(ranked) == top:
+                    decision = "early_stop"
+                    break
+                if budget_ms and (time.perf_counter() - started) * 1000 >= budget_ms:
+                    decision = "budget"
+                    break
+            top = set(ranked)
+
+        self._record(decision, len(scores), total)
+        logger.info(f"Rerank cascade: {decision}, scored {len(scores)}/{total} candidates "
+                    f"(pool {len(pool)}, {len(dense)} dense, {self.ms_per_pair:.2f}ms/pair) in "
+                    f"{(time.perf_counter() - started) * 1000:.0f}ms.")
+        return sorted(scores, key=scores.get, reverse=True)[:top_k]
@@ -0,0 +1,280 @@
+"""
+Local inference sidecar: one process owns the embedder and reranker and serves them to every
+web worker over a Unix socket.
+
+    python sidecar.py                                      # loads the models, listens on INFERENCE_SOCKET
+    INFERENCE_SIDECAR=true uvicorn main:app --workers 4   # web workers connect instead of loading models
+
+With `uvicorn --workers N` each worker would otherwise hold its own copy of both models and
+its own torch thread pool, so memory grows with N and N pools fight over the same cores.
+The sidecar holds one copy, runs one batch per model at a time on INFERENCE_THREADS torch
+threads, and batches requests arriving from different workers together; the workers keep
+their own micro-batchers, so a sidecar batch is a batch of batches.
+
+Protocol: every message is a frame (4-byte big-endian length, then the body). A request is a
+JSON frame {"op": "hello" | "embed" | "rerank", ...}. A reply is a JSON header frame, followed
+for embed/rerank by one frame of raw float32 values in the shape given by the header.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+INFERENCE_SIDECAR = os.getenv("INFERENCE_SIDECAR", "false").lower() == "true"
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET", "/tmp/docquery-inference.sock")
+# Torch intra-op threads in the sidecar; web workers in sidecar mode run no model threads at all
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", str(os.cpu_count() or 1)))
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "60"))
+# How long web workers wait for the sidecar to come up before startup fails
+INFERENCE_CONNECT_WAIT = float(os.getenv("INFERENCE_CONNECT_WAIT", "120"))
+
+_HEADER = struct.Struct(">I")
+
+
+class InferenceError(RuntimeError):
+    pass
+
+
+# --- Framing ---
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        block = sock.recv(size - len(data))
+        if not block:
+            raise ConnectionError("Inference sidecar closed the connection")
+        data.extend(block)
+    return bytes(data)
+
+
+def _send_frames(sock: socket.socket, *frames: bytes):
+    sock.sendall(b"".join(_HEADER.pack(len(frame)) + frame for frame in frames))
+
+
+def _recv_frame(sock: socket.socket) -> bytes:
+    (size,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return _recv_exactly(sock, size)
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> bytes:
+    (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return await reader.readexactly(size)
+
+
+def _write_frames(writer: asyncio.StreamWriter, *frames: bytes):
+    for frame in frames:
+        writer.write(_HEADER.pack(len(frame)) + frame)
+
+
+# --- Client (web workers) ---
+
+class SidecarClient:
+    """
+    Blocking client, called from executor threads like the local models it replaces.
+    Each thread keeps its own connection; a broken connection is reopened once per call.
+    """
+
+    def __init__(self, path: str = INFERENCE_SOCKET, timeout: float = INFERENCE_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def call(self, request: dict) -> tuple[dict, np.ndarray | None]:
+        for attempt in (1, 2):
+            try:
+                if getattr(self._local, "sock", None) is None:
+                    self._local.sock = self._connect()
+                sock = self._local.sock
+                _send_frames(sock, json.dumps(request).encode("utf-8"))
+                header = json.loads(_recv_frame(sock))
+                values = None
+                if "shape" in header:
+                    values = np.frombuffer(_recv_frame(sock), dtype=np.float32).reshape(header["shape"])
+                break
+            except (ConnectionError, socket.timeout, OSError) as e:
+                self._close()
+                if attempt == 2:
+                    raise InferenceError(f"Inference sidecar at {self.path} is unavailable: {e}") from e
+        if not header.get("ok"):
+            raise InferenceError(f"Inference sidecar error: {header.get('error')}")
+        return header, values
+
+    def wait_until_up(self, timeout: float = INFERENCE_CONNECT_WAIT) -> dict:
+        """Polls the socket until the sidecar has loaded its models; returns its hello."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.call({"op": "hello"})[0]
+            except InferenceError as e:
+                if time.monotonic() > deadline:
+                    raise
+                logger.info(f"Waiting for the inference sidecar: {e}")
+                time.sleep(1)
+
+
+def _load_tokenizer(directory: str | None):
+    """The sidecar saves its tokenizer next to the socket; chunking counts tokens locally with it."""
+    if not directory or not os.path.exists(os.path.join(directory, "tokenizer.json")):
+        return None
+    try:
+        from tokenizers import Tokenizer
+        return Tokenizer.from_file(os.path.join(directory, "tokenizer.json"))
+    except Exception as e:
+        logger.warning(f"Could not load the sidecar's tokenizer, token counts will be approximate: {e}")
+        return None
+
+
+class RemoteEmbedder:
+    """Stands in for the SentenceTransformer in web workers."""
+
+    def __init__(self, client: SidecarClient, hello: dict):
+        self.client = client
+        self.dimension = hello["dimension"]
+        self.max_seq_length = hello.get("max_seq_length")
+        self.tokenizer = _load_tokenizer(hello.get("tokenizer_dir"))
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, texts: list[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        return self.client.call({"op": "embed", "texts": list(texts)})[1]
+
+
+class RemoteReranker:
+    """Stands in for the CrossEncoder in web workers."""
+
+    def __init__(self, client: SidecarClient):
+        self.client = client
+
+    def predict(self, pairs: list[tuple[str, str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        return self.client.call({"op": "rerank", "pairs": [list(pair) for pair in pairs]})[1]
+
+
+def connect_models(path: str = INFERENCE_SOCKET):
+    """Returns (embedder, reranker, backend) proxies for the sidecar's models, waiting for it to start."""
+    client = SidecarClient(path)
+    hello = client.wait_until_up()
+    logger.info(f"Connected to the inference sidecar at {path} ({hello['backend']}, {hello['threads']} threads).")
+    return RemoteEmbedder(client, hello), RemoteReranker(client), hello["backend"]
+
+
+# --- Server (sidecar process) ---
+
+async def serve(path: str = INFERENCE_SOCKET):
+    # Imported here so the executor picks up the concurrency defaults set in __main__
+    import torch
+
+    from batching import MicroBatcher
+    from inference import load_models
+
+    torch.set_num_threads(INFERENCE_THREADS)
+    embedder_name, reranker_name = "all-MiniLM-L12-v2", "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    embedder, reranker, backend = await asyncio.to_thread(load_models, embedder_name, reranker_name)
+
+    tokenizer_dir = None
+    if hasattr(getattr(embedder, "tokenizer", None), "save_pretrained"):
+        tokenizer_dir = f"{path}.tokenizer"
+        embedder.tokenizer.save_pretrained(tokenizer_dir)
+
+    def embed_groups(groups: list[list[str]]) -> list[np.ndarray]:
+        flat = [text for group in groups for text in group]
+        vectors = np.asarray(embedder.encode(flat, batch_size=max(1, len(flat))), dtype=np.float32)
+        return _split(vectors, groups)
+
+    def rerank_groups(groups: list[list[list[str]]]) -> list[np.ndarray]:
+        flat = [tuple(pair) for group in groups for pair in group]
+        scores = np.asarray(reranker.predict(flat, batch_size=max(1, len(flat))), dtype=np.float32)
+        return _split(scores, groups)
+
+    # Requests from all web workers are batched together; sizes count texts and pairs
+    embed_batcher = MicroBatcher(
+        "sidecar_embed", embed_groups, stage="embed", size_fn=len,
+        max_batch_size=int(os.getenv("SIDECAR_EMBED_BATCH_MAX_SIZE", "64")),
+        max_wait_ms=float(os.getenv("SIDECAR_EMBED_BATCH_MAX_WAIT_MS", "2")),
+    )
+    rerank_batcher = MicroBatcher(
+        "sidecar_rerank", rerank_groups, stage="rerank", size_fn=len,
+        max_batch_size=int(os.getenv("SIDECAR_RERANK_BATCH_MAX_PAIRS", "512")),
+        max_wait_ms=float(os.getenv("SIDECAR_RERANK_BATCH_MAX_WAIT_MS", "2")),
+    )
+    hello = {
+        "ok": True,
+        "backend": backend,
+        "threads": INFERENCE_THREADS,
+        "dimension": embedder.get_sentence_embedding_dimension(),
+        "max_seq_length": getattr(embedder, "max_seq_length", None),
+        "tokenizer_dir": tokenizer_dir,
+    }
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = json.loads(await _read_frame(reader))
+                except asyncio.IncompleteReadError:
+                    return
+                op = request.get("op")
+                try:
+                    if op == "hello":
+                        _write_frames(writer, json.dumps(hello).encode("utf-8"))
+                    elif op in ("embed", "rerank"):
+                        if op == "embed":
+                            values = await embed_batcher.submit(request["texts"])
+                        else:
+                            values = await rerank_batcher.submit(request["pairs"])
+                        header = {"ok": True, "shape": list(values.shape)}
+                        _write_frames(writer, json.dumps(header).encode("utf-8"), values.tobytes())
+                    else:
+                        _write_frames(writer, json.dumps({"ok": False, "error": f"unknown op '{op}'"}).encode("utf-8"))
+                except Exception as e:
+                    logger.error(f"Inference request '{op}' failed: {e}", exc_info=True)
+                    _write_frames(writer, json.dumps({"ok": False, "error": str(e)}).encode("utf-8"))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)  # left behind by a previous run
+    server = await asyncio.start_unix_server(handle, path=path)
+    logger.info(f"Inference sidecar ({backend}, {INFERENCE_THREADS} torch threads) listening on {path}")
+    async with server:
+        await server.serve_forever()
+
+
+def _split(values: np.ndarray, groups: list) -> list[np.ndarray]:
+    results, offset = [], 0
+    for group in groups:
+        results.append(values[offset:offset + len(group)])
+        offset += len(group)
+    return results
+
+
+if __name__ == "__main__":
+    # One batch per model at a time: each already uses all INFERENCE_THREADS torch threads
+    os.environ.setdefault("EMBED_CONCURRENCY", "1")
+    os.environ.setdefault("RERANK_CONCURRENCY", "1")
+    os.environ.setdefault("CPU_POOL_SIZE", "2")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(serve())
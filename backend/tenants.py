@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import os
+
+from database import SessionLocal
+from executor import run_in_stage
+from models import DedicatedTenant
+
+logger = logging.getLogger(__name__)
+
+# --- Dedicated tenants ---
+# Users listed in DEDICATED_TENANTS or in the dedicated_tenants table get a collection of their
+# own. Every worker re-reads the table every TENANT_REFRESH_SECONDS, so `migrate_collection.py
+# --promote` can switch a user's routing without a restart: it adds the row, waits for one
+# refresh interval, and only then removes the user's points from the shared collection.
+TENANT_REFRESH_SECONDS = float(os.getenv("TENANT_REFRESH_SECONDS", "15"))
+
+
+def dedicated_tenants() -> set[str]:
+    db = SessionLocal()
+    try:
+        return {row.user_id for row in db.query(DedicatedTenant.user_id)}
+    finally:
+        db.close()
+
+
+def add_dedicated_tenant(user_id: str):
+    db = SessionLocal()
+    try:
+        if db.query(DedicatedTenant).filter(DedicatedTenant.user_id == user_id).first() is None:
+            db.add(DedicatedTenant(user_id=user_id))
+            db.commit()
+    finally:
+        db.close()
+
+
+class TenantRefresher:
+    """Keeps a TenantRouter's dedicated tenants in sync with the environment plus the database."""
+
+    def __init__(self, router, interval: float = TENANT_REFRESH_SECONDS):
+        self.router = router
+        self.interval = interval
+        self.configured = set(router.dedicated_tenants)
+        self._task = None
+
+    async def start(self):
+        # Route correctly from the first request on
+        await self.refresh()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Dedicated tenant refresher started (every {self.interval:.0f}s).")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def refresh(self):
+        tenants = self.configured | await run_in_stage("db", dedicated_tenants)
+        added = tenants - self.router.dedicated_tenants
+        if added:
+            logger.info(f"Routing {len(added)} more users to dedicated collections: {sorted(added)}")
+        self.router.dedicated_tenants = tenants
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Dedicated tenant refresh failed: {e}", exc_info=True)
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from sqlalchemy import func, literal, null, or_, select, union_all
+
+from admission import BULK, set_flow
+from database import SessionLocal
+from executor import run_in_stage
+from manifest import bump_generation
+from models import Document, DocumentGeneration, IngestionJob, IngestionJobFile, Tombstone
+
+logger = logging.getLogger(__name__)
+
+# --- Soft delete ---
+# Deleting a document used to wait for Qdrant to count and delete every chunk of it, which
+# takes seconds for a large file and longer for "delete all". Now a delete only writes a
+# tombstone and drops the manifest rows, in one transaction, and returns. /ask reads the
+# user's tombstones and leaves the deleted files out of both retrievers, so the document
+# disappears at once. A Purger in every worker then deletes the chunks in batches of
+# PURGE_BATCH_SIZE points and removes the tombstone; it is woken by each delete and otherwise
+# sweeps every TOMBSTONE_PURGE_INTERVAL_SECONDS, which also picks up tombstones left behind by
+# a restart. Purging is idempotent, so workers racing on the same tombstone are harmless.
+# A file still being ingested is not purged by the sweep: its ingestion notices the tombstone
+# after the next batch (or when it completes), stops without recording the manifest row and
+# settles the delete itself, so no batch written after the purge can bring the file back.
+# Purges of one user's tombstones never overlap within a worker: a "delete all" purge still
+# scrolling the user's points would otherwise remove chunks that another file of the same job
+# started writing once an earlier settle had cleared that tombstone.
+TOMBSTONE_PURGE_INTERVAL = float(os.getenv("TOMBSTONE_PURGE_INTERVAL_SECONDS", "30"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+PURGE_SWEEP_LIMIT = 100  # tombstones handled per sweep, oldest first
+
+
+# --- Database helpers (blocking; run on the "db" executor stage) ---
+
+def mark_deleted(user_id: str, filename: str = None) -> int | None:
+    """
+    Tombstones one of the user's documents, or all of them when `filename` is None, and removes
+    their manifest rows in the same transaction. Returns the number of chunks the rows listed,
+    or None, writing nothing, if the user has no document called `filename`.
+    """
+    db = SessionLocal()
+    try:
+        query = db.query(Document).filter(Document.user_id == user_id)
+        if filename is not None:
+            query = query.filter(Document.filename == filename)
+        documents = query.all()
+        if filename is not None and not documents:
+            return None
+        chunks = sum(document.chunks or 0 for document in documents)
+        query.delete(synchronize_session=False)
+        db.add(Tombstone(user_id=user_id, filename=filename))
+        bump_generation(db, user_id)
+        db.commit()
+        return chunks
+    finally:
+        db.close()
+
+
+def document_state(user_id: str) -> tuple[int, bool, list[str]]:
+    """
+    What /ask needs to know about the user's documents, in a single round trip: their
+    generation (see manifest.bump_generation), whether all of them are deleted, and which
+    files are, pending purge.
+    """
+    generation = select(
+        literal("generation").label("kind"), null().label("filename"), func.max(DocumentGeneration.id).label("generation")
+    ).where(DocumentGeneration.user_id == user_id)
+    deleted = select(literal("tombstone"), Tombstone.filename, null()).where(Tombstone.user_id == user_id)
+    db = SessionLocal()
+    try:
+        rows = db.execute(union_all(generation, deleted)).all()
+    finally:
+        db.close()
+    filenames = [row.filename for row in rows if row.kind == "tombstone"]
+    current = next((row.generation for row in rows if row.kind == "generation"), None) or 0
+    return current, any(f is None for f in filenames), sorted({f for f in filenames if f is not None})
+
+
+def covering(db, user_id: str, filename: str):
+    """Query for the user's tombstones that cover `filename`: its own, and any "delete all"."""
+    return db.query(Tombstone).filter(
+        Tombstone.user_id == user_id,
+        or_(Tombstone.filename == filename, Tombstone.filename.is_(None)),
+    )
+
+
+def is_deleted(user_id: str, filename: str) -> bool:
+    db = SessionLocal()
+    try:
+        return covering(db, user_id, filename).first() is not None
+    finally:
+        db.close()
+
+
+def _oldest(limit: int) -> list[tuple[int, str, str]]:
+    """The oldest tombstones, minus those covering a file that is being ingested."""
+    db = SessionLocal()
+    try:
+        ingesting = set(
+            db.query(IngestionJob.user_id, IngestionJobFile.filename)
+            .join(IngestionJobFile, IngestionJobFile.job_id == IngestionJob.id)
+            .filter(IngestionJobFile.status == "running")
+            .all()
+        )
+        users_ingesting = {user_id for user_id, _ in ingesting}
+        rows = db.query(Tombstone).order_by(Tombstone.id).limit(limit).all()
+        return [
+            (row.id, row.user_id, row.filename)
+            for row in rows
+            if (row.user_id, row.filename) not in ingesting and not (row.filename is None and row.user_id in users_ingesting)
+        ]
+    finally:
+        db.close()
+
+
+def _covering(user_id: str, filename: str) -> list[tuple[int, str, str]]:
+    db = SessionLocal()
+    try:
+        rows = covering(db, user_id, filename).order_by(Tombstone.id).all()
+        return [(row.id, row.user_id, row.filename) for row in rows]
+    finally:
+        db.close()
+
+
+def _exists(tombstone_id: int) -> bool:
+    db = SessionLocal()
+    try:
+        return db.query(Tombstone.id).filter(Tombstone.id == tombstone_id).first() is not None
+    finally:
+        db.close()
+
+
+def _clear(tombstone_id: int):
+    db = SessionLocal()
+    try:
+        db.query(Tombstone).filter(Tombstone.id == tombstone_id).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+class Purger:
+    """Removes tombstoned documents from the chunk store in the background, then their tombstones."""
+
+    def __init__(self, store, interval: float = TOMBSTONE_PURGE_INTERVAL, batch_size: int = PURGE_BATCH_SIZE):
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self._wake = asyncio.Event()
+        self._task = None
+        self._locks = {}  # user_id -> [asyncio.Lock, holders and waiters]
+        self.purged = 0
+        self.purged_chunks = 0
+        self.failures = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Tombstone purger started (sweep every {self.interval:.0f}s, batches of {self.batch_size} points).")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        self._wake.set()
+
+    def stats(self) -> dict:
+        return {"purged": self.purged, "purged_chunks": self.purged_chunks, "failures": self.failures}
+
+    @asynccontextmanager
+    async def _user_lock(self, user_id: str):
+        entry = self._locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+    async def _run(self):
+        # Purging is bulk work, queued behind interactive queries on the db stage
+        set_flow("purger", BULK)
+        while True:
+            self._wake.clear()
+            try:
+                for tombstone in await run_in_stage("db", _oldest, PURGE_SWEEP_LIMIT):
+                    async with self._user_lock(tombstone[1]):
+                        # A settle may have purged it meanwhile, and the user may be writing again
+                        if await run_in_stage("db", _exists, tombstone[0]):
+                            await self._purge(*tombstone)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Tombstone purge sweep failed: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _purge(self, tombstone_id: int, user_id: str, filename: str):
+        try:
+            removed = await self.store.purge_documents(user_id, filename, batch_size=self.batch_size)
+        except Exception:
+            self.failures += 1
+            raise
+        await run_in_stage("db", _clear, tombstone_id)
+        self.purged += 1
+        self.purged_chunks += removed
+        what = f"document '{filename}'" if filename is not None else "all documents"
+        logger.info(f"Purged {what} of user {user_id}: {removed} chunks removed.")
+
+    async def settle(self, user_id: str, filename: str = None):
+        """
+        Purges the tombstones covering `filename` (only "delete all" when it is None) right
+        away. Ingestion calls this before it indexes a file, so a tombstone never hides (or
+        purges) chunks written after it, and after a delete stopped it, so nothing it wrote
+        is left behind.
+        """
+        async with self._user_lock(user_id):
+            for tombstone in await run_in_stage("db", _covering, user_id, filename):
+                await self._purge(*tombstone)
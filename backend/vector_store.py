@@ -0,0 +1,322 @@
+import logging
+import os
+import re
+
+from executor import run_in_stage
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    Distance,
+    Filter,
+    MatchValue,
+    FieldCondition,
+    HasIdCondition,
+    HnswConfigDiff,
+    KeywordIndexParams,
+    KeywordIndexType,
+    MatchAny,
+    PointStruct,
+    PointIdsList,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    SetPayload,
+    SetPayloadOperation,
+    VectorParams,
+)
+
+logger = logging.getLogger(__name__)
+
+SCROLL_PAGE_SIZE = 1000
+DELETE_BATCH_SIZE = 500
+
+# --- Collection layout ---
+# Full-precision vectors live on disk and only a compressed copy is kept in RAM for the HNSW
+# search; the top `limit * QUANTIZATION_OVERSAMPLING` candidates are then rescored with the
+# original vectors. "scalar" (int8) cuts vector RAM ~4x with near-identical ranking; "binary"
+# cuts it ~32x but loses more on 384-dim MiniLM vectors, so pair it with oversampling >= 3.
+# Applies to newly created collections; migrate_collection.py rebuilds an existing one.
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "scalar").lower()  # none | scalar | binary
+VECTORS_ON_DISK = os.getenv("VECTORS_ON_DISK", "true").lower() != "false"
+QUANTIZATION_OVERSAMPLING = float(os.getenv("QUANTIZATION_OVERSAMPLING", "2.0"))
+PAYLOAD_INDEX_FIELDS = ["source", "user_id", "filename"]
+# The name the app reads and writes chunks through. Point it at an alias (e.g. general_docs_live)
+# so migrate_collection.py can rebuild the collection behind it and swap it atomically.
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "general_docs")
+
+# --- Multi-tenancy ---
+# "partitioned" marks user_id as the tenant key (is_tenant), so Qdrant co-locates each user's
+# points, and builds one small HNSW graph per user (payload_m) instead of one global graph
+# (m=0), which filtered searches over many small tenants degrade. Every query here filters on
+# user_id, so the global graph is never needed. "shared" keeps one global graph.
+TENANT_LAYOUT = os.getenv("TENANT_LAYOUT", "partitioned").lower()  # partitioned | shared
+HNSW_PAYLOAD_M = int(os.getenv("HNSW_PAYLOAD_M", "16"))
+# Large tenants can be given a collection of their own: comma-separated user ids. Their
+# collections are named <TENANT_COLLECTION_PREFIX>_tenant_<user>, whatever QDRANT_COLLECTION is.
+DEDICATED_TENANTS = [t.strip() for t in os.getenv("DEDICATED_TENANTS", "").split(",") if t.strip()]
+TENANT_COLLECTION_PREFIX = os.getenv("TENANT_COLLECTION_PREFIX", "general_docs")
+
+
+def vectors_config(vector_dim: int) -> VectorParams:
+    return VectorParams(size=vector_dim, distance=Distance.COSINE, on_disk=VECTORS_ON_DISK)
+
+
+def quantization_config(kind: str = VECTOR_QUANTIZATION):
+    if kind == "scalar":
+        return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True))
+    if kind == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    if kind != "none":
+        logger.warning(f"Unknown VECTOR_QUANTIZATION '{kind}'; vectors will not be quantized.")
+    return None
+
+
+def search_params(kind: str = VECTOR_QUANTIZATION) -> SearchParams | None:
+    """Oversample on the quantized vectors and rescore with the originals. Ignored by unquantized collections."""
+    if quantization_config(kind) is None:
+        return None
+    return SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=QUANTIZATION_OVERSAMPLING))
+
+
+def collection_settings(vector_dim: int, dedicated: bool = False) -> dict:
+    """create_collection() arguments for the configured layout; a dedicated tenant collection keeps a global graph."""
+    settings = {
+        "vectors_config": vectors_config(vector_dim),
+        "quantization_config": quantization_config(),
+    }
+    if TENANT_LAYOUT == "partitioned" and not dedicated:
+        settings["hnsw_config"] = HnswConfigDiff(m=0, payload_m=HNSW_PAYLOAD_M)
+    return settings
+
+
+def payload_schema(field_name: str, dedicated: bool = False):
+    if field_name == "user_id" and TENANT_LAYOUT == "partitioned" and not dedicated:
+        return KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True)
+    return "keyword"
+
+
+def create_collection(client, collection_name: str, vector_dim: int):
+    """Creates a collection with the configured layout and its payload indexes (sync client)."""
+    client.create_collection(collection_name=collection_name, timeout=60, **collection_settings(vector_dim))
+    create_payload_indexes(client, collection_name)
+    logger.info(f"Created Qdrant collection '{collection_name}' (quantization: {VECTOR_QUANTIZATION}, "
+                f"vectors on disk: {VECTORS_ON_DISK}, tenant layout: {TENANT_LAYOUT}).")
+
+
+def create_payload_indexes(client, collection_name: str):
+    for field_name in PAYLOAD_INDEX_FIELDS:
+        try:
+            client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field_name,
+                field_schema=payload_schema(field_name)
+            )
+            logger.info(f"Payload index for '{field_name}' field created or already exists in collection '{collection_name}'.")
+        except UnexpectedResponse as e:
+            # Check if the error is due to the index already existing (status code 409 Conflict)
+            if e.status_code == 409 or "already exists" in str(e):
+                logger.info(f"Payload index for '{field_name}' field already exists in collection '{collection_name}'.")
+            else:
+                logger.warning(f"Could not create payload index for '{field_name}' field (UnexpectedResponse): {e}", exc_info=True)
+        except Exception as e:
+            logger.warning(f"Could not create payload index for '{field_name}' field: {e}", exc_info=True)
+
+
+def document_filter(user_id: str, filename: str = None, exclude_filenames: list[str] = None) -> Filter:
+    must = [
+        FieldCondition(key="source", match=MatchValue(value="document")),
+        FieldCondition(key="user_id", match=MatchValue(value=user_id)),
+    ]
+    if filename is not None:
+        must.append(FieldCondition(key="filename", match=MatchValue(value=filename)))
+    if exclude_filenames:
+        return Filter(must=must, must_not=[FieldCondition(key="filename", match=MatchAny(any=list(exclude_filenames)))])
+    return Filter(must=must)
+
+
+class TenantRouter:
+    """
+    Maps a user to the collection holding their chunks: the shared collection, or for users
+    listed in `dedicated_tenants`, a collection of their own named `<prefix>_tenant_<user>`.
+    """
+
+    def __init__(self, shared_collection: str, dedicated_tenants=DEDICATED_TENANTS, prefix: str = TENANT_COLLECTION_PREFIX):
+        self.shared_collection = shared_collection
+        self.dedicated_tenants = set(dedicated_tenants)
+        self.prefix = prefix
+
+    def is_dedicated(self, user_id: str) -> bool:
+        return user_id in self.dedicated_tenants
+
+    def dedicated_collection(self, user_id: str) -> str:
+        return f"{self.prefix}_tenant_{re.sub(r'[^A-Za-z0-9_-]', '_', user_id)}"
+
+    def collection_for(self, user_id: str) -> str:
+        return self.dedicated_collection(user_id) if self.is_dedicated(user_id) else self.shared_collection
+
+
+class ChunkStore:
+    """
+    All reads and writes of document chunks, routed to the collection that holds the user's data.
+    Dedicated tenant collections are created on first use. When a lexical index is given,
+    every write is mirrored into it after Qdrant accepts it.
+    """
+
+    def __init__(self, client: AsyncQdrantClient, router: TenantRouter, vector_dim: int, lexical=None):
+        self.client = client
+        self.router = router
+        self.vector_dim = vector_dim
+        self.lexical = lexical  # lexical_index.LexicalIndex or None
+        self._ready = {router.shared_collection}  # collections known to exist
+
+    async def _collection(self, user_id: str) -> str:
+        name = self.router.collection_for(user_id)
+        if name not in self._ready:
+            if not await self.client.collection_exists(name):
+                await self.client.create_collection(collection_name=name, **collection_settings(self.vector_dim, dedicated=True))
+                for field_name in PAYLOAD_INDEX_FIELDS:
+                    await self.client.create_payload_index(
+                        collection_name=name, field_name=field_name, field_schema=payload_schema(field_name, dedicated=True)
+                    )
+                logger.info(f"Created dedicated Qdrant collection '{name}' for user {user_id}")
+            self._ready.add(name)
+        return name
+
+    async def search(self, user_id: str, vector: list[float], limit: int, with_vectors: bool = False,
+                     exclude_filenames: list[str] = None):
+        """Dense search over the user's chunks, minus `exclude_filenames`; returns Qdrant's ScoredPoints, best first."""
+        response = await self.client.query_points(
+            collection_name=await self._collection(user_id),
+            query=vector,
+            limit=limit,
+            with_payload=True,
+            with_vectors=with_vectors,
+            search_params=search_params(),
+            query_filter=document_filter(user_id, exclude_filenames=exclude_filenames),
+        )
+        return response.points
+
+    async def existing_ids(self, user_id: str, point_ids: list[str], exclude_filenames: list[str] = None) -> set[str]:
+        """The ids among `point_ids` that are chunks of the user in Qdrant, outside `exclude_filenames`."""
+        if not point_ids:
+            return set()
+        query_filter = document_filter(user_id, exclude_filenames=exclude_filenames)
+        query_filter.must.append(HasIdCondition(has_id=point_ids))
+        points, _ = await self.client.scroll(
+            collection_name=await self._collection(user_id),
+            scroll_filter=query_filter,
+            limit=len(point_ids),
+            with_payload=False,
+            with_vectors=False,
+        )
+        return {str(point.id) for point in points}
+
+    async def upsert_points(self, points: list[PointStruct]) -> int:
+        """Upserts one ingestion batch (all points of one user); returns how many points were indexed."""
+        if not points:
+            return 0
+        collection_name = await self._collection(points[0].payload["user_id"])
+        upsert_result = await self.client.upsert(collection_name=collection_name, points=points, wait=True)
+        if upsert_result.status == 'completed':
+            if self.lexical is not None:
+                await run_in_stage("db", self.lexical.add, [
+                    (str(p.id), p.payload["user_id"], p.payload["filename"], p.payload["text"], p.payload["chunk_index"])
+                    for p in points
+                ])
+            logger.info(f"Successfully indexed batch with {len(points)} points")
+            return len(points)
+        logger.error(f"Qdrant upsert status not completed for batch: {upsert_result.status}")
+        return 0
+
+    async def scroll_payloads(self, user_id: str, filename: str = None, fields: list[str] = None):
+        """Yields (point_id, payload) for every chunk of the user (or of one file). Pages through all of them."""
+        collection_name = await self._collection(user_id)
+        offset = None
+        while True:
+            points, offset = await self.client.scroll(
+                collection_name=collection_name,
+                scroll_filter=document_filter(user_id, filename),
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+                with_payload=fields if fields is not None else True,
+                with_vectors=False,
+            )
+            for point in points:
+                yield str(point.id), point.payload or {}
+            if offset is None:
+                return
+
+    async def existing_chunks(self, user_id: str, filename: str) -> dict[str, int]:
+        """Maps point id -> chunk_index for every chunk already indexed for this file."""
+        return {
+            point_id: payload.get("chunk_index")
+            async for point_id, payload in self.scroll_payloads(user_id, filename, ["chunk_index"])
+        }
+
+    async def delete_points(self, user_id: str, point_ids: list[str]) -> int:
+        collection_name = await self._collection(user_id)
+        for i in range(0, len(point_ids), DELETE_BATCH_SIZE):
+            await self.client.delete(
+                collection_name=collection_name,
+                points_selector=PointIdsList(points=point_ids[i:i + DELETE_BATCH_SIZE]),
+                wait=True,
+            )
+        if self.lexical is not None:
+            await run_in_stage("db", self.lexical.delete_ids, point_ids)
+        return len(point_ids)
+
+    async def set_chunk_indexes(self, user_id: str, chunk_indexes: dict[str, int]):
+        """Moves unchanged chunks to their new position in a single batched request."""
+        if not chunk_indexes:
+            return
+        await self.client.batch_update_points(
+            collection_name=await self._collection(user_id),
+            update_operations=[
+                SetPayloadOperation(set_payload=SetPayload(payload={"chunk_index": index}, points=[point_id]))
+                for point_id, index in chunk_indexes.items()
+            ],
+            wait=True,
+        )
+        if self.lexical is not None:
+            await run_in_stage("db", self.lexical.set_chunk_indexes, chunk_indexes)
+
+    async def purge_documents(self, user_id: str, filename: str = None, batch_size: int = DELETE_BATCH_SIZE) -> int:
+        """
+        Deletes one of the user's documents, or all of them when `filename` is None; returns
+        the number of chunks removed. Points go in batches of `batch_size` ids, so a large
+        document never ties Qdrant up in one long filtered delete. Deleting everything for a
+        dedicated tenant drops their collection instead.
+        """
+        collection_name = await self._collection(user_id)
+        if filename is None and self.router.is_dedicated(user_id):
+            removed = (await self.client.count(
+                collection_name=collection_name, count_filter=document_filter(user_id), exact=True
+            )).count
+            await self.client.delete_collection(collection_name)
+            self._ready.discard(collection_name)
+        else:
+            removed = 0
+            while True:
+                # Deleted points drop out of the filter, so every page starts from the beginning
+                points, _ = await self.client.scroll(
+                    collection_name=collection_name,
+                    scroll_filter=document_filter(user_id, filename),
+                    limit=batch_size,
+                    with_payload=False,
+                    with_vectors=False,
+                )
+                if not points:
+                    break
+                await self.client.delete(
+                    collection_name=collection_name,
+                    points_selector=PointIdsList(points=[point.id for point in points]),
+                    wait=True,
+                )
+                removed += len(points)
+        if self.lexical is not None:
+            await run_in_stage("db", self.lexical.delete_document, user_id, filename)
+        return removed
@@ -389,7 +389,7 @@ async function uploadDocuments() {
 
         if (response.ok) {
             uploadStatus.textContent = data.detail;
-            uploadStatus.style.color = '#6EE7B7';
+            uploadStatus.style.color = '#F59E0B';
             
             // Clear the file input and reset UI
             document.getElementById('fileInput').value = '';
@@ -401,8 +401,8 @@ async function uploadDocuments() {
                 selectedFilesDisplay.style.display = 'none';
             }
             
-            // Refresh documents list
-            setTimeout(() => loadDocuments(), 1000);
+            // Indexing runs in the background; follow the job until it finishes
+            await pollIngestionJob(data.job_id, token, uploadStatus);
         } else {
             uploadStatus.textContent = `❌ Upload failed: ${data.detail || 'Unknown error'}`;
             uploadStatus.style.color = '#EF4444';
@@ -414,6 +414,60 @@ async function uploadDocuments() {
     }
 }
 
+// Polls /jobs/{id} and shows per-file indexing progress until the job is finished
+async function pollIngestionJob(jobId, token, uploadStatus) {
+    const pollIntervalMs = 1500;
+
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, pollIntervalMs));
+
+        let job;
+        try {
+            const response = await fetch(`${backendUrl}/jobs/${encodeURIComponent(jobId)}`, {
+                headers: {
+                    'Authorization': `Bearer ${token}`
+                }
+            });
+            job = await response.json();
+            if (!response.ok) {
+                uploadStatus.textContent = `❌ Could not check upload progress: ${job.detail || 'Unknown error'}`;
+                uploadStatus.style.color = '#EF4444';
+                return;
+            }
+        } catch (error) {
+            console.error('Error polling ingestion job:', error);
+            continue; // Transient network error; keep polling
+        }
+
+        const progress = job.files.map(file => {
+            if (file.status === 'failed') {
+                return `${file.filename}: ❌ ${file.error || 'failed'}`;
+            }
+            if (file.status === 'done') {
+                return `${file.filename}: ✅ ${file.points} chunks`;
+            }
+            return `${file.filename}: ${file.pages} pages, ${file.points} chunks indexed`;
+        });
+
+        if (job.status === 'completed' || job.status === 'failed') {
+            const succeeded = job.files.filter(file => file.status === 'done').length;
+            const failed = job.files.filter(file => file.status === 'failed');
+            let message = job.status === 'completed'
+                ? `✅ Successfully uploaded ${succeeded} documents with ${job.total_points} total chunks!`
+                : '❌ No documents could be processed successfully.';
+            if (failed.length > 0) {
+                message += `\n⚠️ Failed uploads: ${failed.map(file => `${file.filename}: ${file.error}`).join(', ')}`;
+            }
+            uploadStatus.textContent = message;
+            uploadStatus.style.color = job.status === 'completed' ? '#6EE7B7' : '#EF4444';
+            loadDocuments();
+            return;
+        }
+
+        uploadStatus.textContent = `Indexing... ⏳ ${progress.join(' • ')}`;
+    }
+}
+
 // Translation utility function
 async function translateText(text, targetLanguage) {
     // Using Google Translate API through a free proxy
@@ -503,6 +557,38 @@ function loadScript(src) {
     });
 }
 
+// Reads a text/event-stream response body and calls onEvent(eventName, parsedData) per event
+async function readServerSentEvents(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = 'message';
+            const dataLines = [];
+            for (const line of rawEvent.split('\n')) {
+                if (line.startsWith('event:')) {
+                    eventName = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).trim());
+                }
+            }
+            if (dataLines.length > 0) {
+                onEvent(eventName, JSON.parse(dataLines.join('\n')));
+            }
+        }
+    }
+}
+
 async function askQuestion() {
     const questionInput = document.getElementById('questionInput');
     const questionStatus = document.getElementById('questionStatus');
@@ -535,7 +621,7 @@ async function askQuestion() {
     if (downloadButtons) downloadButtons.style.display = 'none';
 
     try {
-        const response = await fetch(`${backendUrl}/ask`, {
+        const response = await fetch(`${backendUrl}/ask/stream`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -544,33 +630,56 @@ async function askQuestion() {
             body: JSON.stringify({ question: question }),
         });
 
-        const data = await response.json();
-
-        if (response.ok) {
-            // Store the original answer for translation and download
-            currentAnswer = data.answer;
-            answerText.textContent = currentAnswer;
-            questionStatus.textContent = "Answer ready! 🎉";
-            questionStatus.style.color = '#6EE7B7';
-
-            // Show translation, download, and speech buttons
-            if (translationButtons) translationButtons.style.display = 'flex';
-            if (downloadButtons) downloadButtons.style.display = 'flex';
-            
-            // Show speech buttons
-            const speakButtons = document.getElementById('speakButtons');
-            if (speakButtons) speakButtons.style.display = 'flex';
-
-            answerText.scrollIntoView({
-                behavior: 'smooth',
-                block: 'center'
-            });
-
-        } else {
+        if (!response.ok) {
+            const data = await response.json();
             answerText.textContent = `Error: ${data.detail || 'Unknown error'}`;
             questionStatus.textContent = `❌ Failed to get answer: ${data.detail || 'Unknown error'}`;
             questionStatus.style.color = '#EF4444';
+            return;
+        }
+
+        // Render the answer token by token as the server streams it
+        currentAnswer = '';
+        let streamError = null;
+        let finished = false;
+        await readServerSentEvents(response, (event, data) => {
+            if (event === 'meta') {
+                questionStatus.textContent = data.cached
+                    ? "Answer ready (from cache)! ⚡"
+                    : `Writing answer from ${data.sources.length} document${data.sources.length !== 1 ? 's' : ''}... ✍️`;
+            } else if (event === 'token') {
+                currentAnswer += data.text;
+                answerText.textContent = currentAnswer;
+            } else if (event === 'error') {
+                streamError = data.detail || 'Unknown error';
+            } else if (event === 'done') {
+                finished = true;
+            }
+        });
+
+        if (streamError || !finished) {
+            const detail = streamError || 'The answer stream ended unexpectedly.';
+            answerText.textContent = currentAnswer || `Error: ${detail}`;
+            questionStatus.textContent = `❌ Failed to get answer: ${detail}`;
+            questionStatus.style.color = '#EF4444';
+            return;
         }
+
+        questionStatus.textContent = "Answer ready! 🎉";
+        questionStatus.style.color = '#6EE7B7';
+
+        // Show translation, download, and speech buttons
+        if (translationButtons) translationButtons.style.display = 'flex';
+        if (downloadButtons) downloadButtons.style.display = 'flex';
+        
+        // Show speech buttons
+        const speakButtons = document.getElementById('speakButtons');
+        if (speakButtons) speakButtons.style.display = 'flex';
+
+        answerText.scrollIntoView({
+            behavior: 'smooth',
+            block: 'center'
+        });
     } catch (error) {
         console.error('Error during question:', error);
         questionStatus.textContent = `❌ Network error: ${error.message}`;
@@ -719,7 +828,7 @@ function displayDocuments(documents) {
         documentItem.innerHTML = `
             <div class="document-info">
                 <div class="document-name">${doc.filename}</div>
-                <div class="document-meta">${doc.total_chunks} chunks • Uploaded ${new Date(parseInt(doc.upload_timestamp)).toLocaleDateString()}</div>
+                <div class="document-meta">${doc.total_chunks} chunks • Uploaded ${new Date(doc.upload_timestamp).toLocaleDateString()}</div>
             </div>
             <div class="document-actions">
                 <button class="btn btn-small btn-outline-danger" onclick="deleteDocument('${doc.filename}')">